@@ -0,0 +1,78 @@
+# Driver layer for the ADS1115 ADC
+# cyberdork33 <cyberdork33@gmail.com>
+
+import threading
+
+# Modules to interface with the ADC
+import adafruit_ads1x15.ads1115 as ADS
+from adafruit_ads1x15.ads1x15 import Mode
+from adafruit_ads1x15.analog_in import AnalogIn
+
+##------------------------------------------------------------------------------
+## Global Vars
+I2C_ADDRESS = 0x48 # 0x48 is the default
+DATA_RATE = 860 # Samples per second. One of 8, 16, 32, 64, 128, 250, 475, 860
+GAIN = 1 # Programmable gain. One of 2/3, 1, 2, 4, 8, 16
+CONTINUOUS = True # Convert continuously instead of one conversion per read
+
+# Full scale voltage for each gain setting (from the ADS1115 datasheet)
+PGA_RANGE = {2/3: 6.144, 1: 4.096, 2: 2.048, 4: 1.024, 8: 0.512, 16: 0.256}
+# Largest raw value the ADC reports (16-bit signed)
+MAX_RAW = 32767
+
+##------------------------------------------------------------------------------
+## Reads a single-ended input of the ADS1115.
+##
+## The AnalogIn `value` and `voltage` properties each start their own
+## conversion when the ADC is in single-shot mode, so reading both takes two
+## conversions and the two numbers come from different instants. Instead, the
+## raw value is read once and the voltage is calculated from it.
+##
+## In continuous mode the ADC converts on its own at the data rate and a read
+## just fetches the latest conversion result, so there is no waiting on a
+## conversion to finish and only one I2C transaction per read.
+##
+## The other inputs can be read with scan(). The ADC has a single converter
+## that is switched between its inputs, so each switch waits on a fresh
+## conversion of the new input (about 1.2 ms at 860 samples per second).
+class ADS1115Driver:
+	def __init__(self, i2c, address:int = I2C_ADDRESS, pin:int = ADS.P0,
+							 data_rate:int = DATA_RATE, gain = GAIN,
+							 continuous:bool = CONTINUOUS):
+		self.ads = ADS.ADS1115(i2c, address=address, gain=gain, data_rate=data_rate,
+													 mode=Mode.CONTINUOUS if continuous else Mode.SINGLE)
+		self.pin = pin
+		self.channel = AnalogIn(self.ads, pin)
+		self.channels = {pin: self.channel}
+		self.volts_per_count = PGA_RANGE[gain]/MAX_RAW
+		# Seconds between new conversion results in continuous mode
+		self.conversion_time = 1/data_rate
+		# Switching inputs isn't atomic, so only one thread talks to the ADC
+		self._lock = threading.Lock()
+
+	## Returns the latest raw conversion result.
+	def read_raw(self) -> int:
+		with self._lock:
+			return self.channel.value
+
+	## Returns (raw value, voltage) pairs for each of the given inputs, read back
+	## to back in one pass.
+	def scan(self, pins) -> list:
+		results = []
+		with self._lock:
+			for pin in pins:
+				channel = self.channels.get(pin)
+				if channel is None:
+					channel = self.channels[pin] = AnalogIn(self.ads, pin)
+				raw_value = channel.value
+				results.append((raw_value, self.to_voltage(raw_value)))
+		return results
+
+	## Converts a raw value into the voltage at the input.
+	def to_voltage(self, raw_value) -> float:
+		return raw_value*self.volts_per_count
+
+	## Returns a (raw value, voltage) pair from a single conversion.
+	def read(self):
+		raw_value = self.read_raw()
+		return raw_value, self.to_voltage(raw_value)
@@ -0,0 +1,174 @@
+# Sensor backends
+# cyberdork33 <cyberdork33@gmail.com>
+
+# Everything that reads the pressure goes through one of these, so the rest of
+# pi_app doesn't care whether there is an actual ADC attached. The backend is
+# picked with the SENSOR_BACKEND environment variable:
+#   ads1115   - the real ADC on the I2C bus (default)
+#   simulated - made up on/off pressure profiles with noise, no hardware needed
+#   replay    - plays back a recorded CSV file (REPLAY_FILE) at REPLAY_SPEED
+# This lets the endpoints (and the webhost polling them) be run and load tested
+# on any Linux box.
+
+import os, csv, math, random, time
+from abc import ABC, abstractmethod
+from dateutil import parser
+
+##------------------------------------------------------------------------------
+## Global Vars
+SENSOR_BACKEND = 'ads1115'
+REPLAY_FILE = 'monitor.csv'
+REPLAY_SPEED = 1 # How many times faster than real time to replay or simulate
+DATA_RATE = 860 # Samples per second the simulated ADCs pretend to convert at
+SIM_ON_HOURS = ((4, 8), (20, 22)) # Hours of the (simulated) day the water is on
+SIM_ON_PRESSURE = 55 # psi while the water is on
+SIM_OFF_PRESSURE = 0.5 # psi while the water is off
+SIM_RAMP_SECONDS = 90 # How long the pressure takes to come up or drop off
+SIM_NOISE = 0.3 # psi standard deviation of the noise
+SIM_GLITCH_CHANCE = 0.001 # Chance of a single wild reading
+SIM_CHANNEL_OFFSET = 1 # Hours each simulated input lags the one before it
+VOLTS_PER_COUNT = 4.096/32767 # Matches the ADS1115 at a gain of 1
+
+##------------------------------------------------------------------------------
+## Returns the backend named by the SENSOR_BACKEND environment variable (or
+## `name`). The calibration is needed by the fake backends to turn the
+## pressures they make up into raw values.
+def create_backend(name:str = None, cal_slope:float = 1, cal_intercept:float = 0,
+									 **options):
+	name = name or os.environ.get('SENSOR_BACKEND', SENSOR_BACKEND)
+	if name == 'ads1115':
+		# Only touch the hardware libraries when they are actually wanted
+		import board, busio
+		from adc import ADS1115Driver
+		i2c = busio.I2C(board.SCL, board.SDA)
+		return ADS1115Driver(i2c, **options)
+	if name == 'simulated':
+		speed = float(os.environ.get('REPLAY_SPEED', REPLAY_SPEED))
+		return SimulatedADC(cal_slope, cal_intercept, speed=speed,
+												data_rate=options.get('data_rate', DATA_RATE))
+	if name == 'replay':
+		filename = os.environ.get('REPLAY_FILE', REPLAY_FILE)
+		speed = float(os.environ.get('REPLAY_SPEED', REPLAY_SPEED))
+		return ReplayADC(filename, cal_slope, cal_intercept, speed=speed,
+										 data_rate=options.get('data_rate', DATA_RATE))
+	raise ValueError(f"Unknown sensor backend: {name}")
+
+##------------------------------------------------------------------------------
+## Shared parts of the fake ADCs. They behave like ADS1115Driver: read_raw()
+## returns a raw value and the voltage is calculated from it. Each fake makes
+## its raw values up its own way by implementing read_raw().
+class FakeADC(ABC):
+	volts_per_count = VOLTS_PER_COUNT
+
+	def __init__(self, cal_slope:float, cal_intercept:float, data_rate:int = DATA_RATE):
+		self.cal_slope = cal_slope
+		self.cal_intercept = cal_intercept
+		self.conversion_time = 1/data_rate
+
+	@abstractmethod
+	def read_raw(self, pin:int = 0) -> int:
+		pass
+
+	def to_voltage(self, raw_value) -> float:
+		return raw_value*self.volts_per_count
+
+	def read(self):
+		raw_value = self.read_raw()
+		return raw_value, self.to_voltage(raw_value)
+
+	def scan(self, pins) -> list:
+		raw_values = [self.read_raw(pin) for pin in pins]
+		return [(raw_value, self.to_voltage(raw_value)) for raw_value in raw_values]
+
+	## Raw value that the calibration turns into this pressure
+	def to_raw(self, pressure:float) -> int:
+		return round((pressure - self.cal_intercept)/self.cal_slope)
+
+##------------------------------------------------------------------------------
+## Makes up the pressure of a water supply that turns on during SIM_ON_HOURS
+## of each day. The pressure ramps up and down at the edges and has noise and
+## the odd glitch on top. With speed above 1 the simulated day goes by faster.
+class SimulatedADC(FakeADC):
+	def __init__(self, cal_slope:float, cal_intercept:float, speed:float = REPLAY_SPEED,
+							 on_hours = SIM_ON_HOURS, seed = None, data_rate:int = DATA_RATE):
+		super().__init__(cal_slope, cal_intercept, data_rate)
+		self.speed = speed
+		self.on_hours = on_hours
+		self.random = random.Random(seed)
+		self.started = time.monotonic()
+		# Start the simulated day at the current time of day
+		now = time.localtime()
+		self.start_of_day = now.tm_hour*3600 + now.tm_min*60 + now.tm_sec
+
+	## Each input after the first runs SIM_CHANNEL_OFFSET hours behind the one
+	## before it, so the channels can be told apart.
+	def read_raw(self, pin:int = 0) -> int:
+		elapsed = (time.monotonic() - self.started)*self.speed
+		second = self.start_of_day + elapsed - pin*SIM_CHANNEL_OFFSET*3600
+		return self.to_raw(self.pressure_at(second % 86400))
+
+	## The pressure (psi) at the given second of the day
+	def pressure_at(self, second:float) -> float:
+		level = 0
+		for first, last in self.on_hours:
+			# 0 to 1 while ramping up after `first`, 1 to 0 ramping down at `last`
+			up = (second - first*3600)/SIM_RAMP_SECONDS
+			down = (last*3600 - second)/SIM_RAMP_SECONDS
+			level = max(level, min(1, up, down))
+		# Ease in and out of the ramps rather than a straight line
+		level = (1 - math.cos(math.pi*max(level, 0)))/2
+		pressure = SIM_OFF_PRESSURE + (SIM_ON_PRESSURE - SIM_OFF_PRESSURE)*level
+		pressure += self.random.gauss(0, SIM_NOISE)
+		if self.random.random() < SIM_GLITCH_CHANCE:
+			pressure += self.random.uniform(-20, 20)
+		return pressure
+
+##------------------------------------------------------------------------------
+## Plays back readings recorded in a CSV file (like the ones written by
+## monitor.py or take_reading.py), at `speed` times the rate they were
+## recorded. Starts over from the beginning at the end of the file.
+class ReplayADC(FakeADC):
+	def __init__(self, filename:str, cal_slope:float, cal_intercept:float,
+							 speed:float = REPLAY_SPEED, data_rate:int = DATA_RATE):
+		super().__init__(cal_slope, cal_intercept, data_rate)
+		self.speed = speed
+		self.times, self.values = load_recording(filename, self)
+		if not self.values:
+			raise ValueError(f"No readings to replay in {filename}")
+		# The last reading gets as long as the one before it before starting over
+		gap = self.times[-1] - self.times[-2] if len(self.times) > 1 else 1
+		self.duration = self.times[-1] + gap
+		self.started = time.monotonic()
+		self.position = 0
+
+	## Only one input was recorded, so every input replays the same file.
+	def read_raw(self, pin:int = 0) -> int:
+		elapsed = ((time.monotonic() - self.started)*self.speed) % self.duration
+		if elapsed < self.times[self.position]:
+			# Went around to the start of the file again
+			self.position = 0
+		while (self.position + 1 < len(self.times) and
+					 self.times[self.position + 1] <= elapsed):
+			self.position += 1
+		return self.values[self.position]
+
+##------------------------------------------------------------------------------
+## Reads a recorded CSV into lists of seconds since the first reading and raw
+## values. Files without a raw value column get one from the pressure.
+def load_recording(filename:str, adc:FakeADC):
+	times, values = [], []
+	with open(filename, newline='', encoding='utf-8') as file:
+		reader = csv.DictReader(file)
+		start = None
+		for row in reader:
+			when = parser.parse(row['Timestamp']).timestamp()
+			if start is None:
+				start = when
+			raw = row.get('Raw Value') or row.get('Read Value')
+			if raw:
+				raw = round(float(raw))
+			else:
+				raw = adc.to_raw(float(row['Pressure [psi]']))
+			times.append(when - start)
+			values.append(raw)
+	return times, values
@@ -0,0 +1,234 @@
+# Fits the calibration of the pressure transducer to gauge readings.
+# cyberdork33 <cyberdork33@gmail.com>
+
+# The captures are the <psi>.csv files written by take_reading.py (or by
+# `flask export-calibration` on the webhost). Every capture given is fitted at
+# once with a least squares fit of raw ADC value to gauge pressure, and the
+# fit is kept, with a report of its residuals, as a new version in
+# calibration.json. Activating a version compiles it into a lookup table of
+# the pressure for every raw value the ADS1115 can return, which
+# pressInterface.getPressure() then just indexes, so even a curved fit costs
+# the same as a straight line.
+#
+#   python calibration.py fit 0.csv 20.csv 40.csv 60.csv --kind polynomial --degree 2
+#   python calibration.py list
+#   python calibration.py activate 3
+#
+# Restart the app after activating a fit so it loads the new table.
+
+import argparse, csv, datetime, json, os, sys
+from os import path
+
+try:
+	import numpy as np
+except ImportError:
+	np = None # needed to fit and compile tables, but not for the table layout
+
+##------------------------------------------------------------------------------
+## Global Vars
+# The layout of the lookup table, which pressInterface reads
+RAW_MIN = -32768 # ADS1115 conversions are signed 16 bit
+TABLE_SIZE = 65536 # one entry for every raw value
+HERE = path.dirname(path.abspath(__file__))
+FITS_FILE = path.join(HERE, 'calibration.json') # every fit made, by version
+TABLE_FILE = path.join(HERE, 'calibration.table') # the active fit, compiled
+KINDS = ('linear', 'polynomial', 'piecewise')
+DEFAULT_DEGREE = 2 # of polynomial fits
+DEFAULT_SEGMENTS = 3 # of piecewise fits without breakpoints given
+
+##------------------------------------------------------------------------------
+## Returns the raw values and gauge pressures of every reading in the given
+## capture files, as arrays.
+def load_captures(filenames) -> tuple:
+	raw, pressure = [], []
+	for filename in filenames:
+		with open(filename, newline='', encoding='utf-8') as file:
+			for record in csv.DictReader(file):
+				raw.append(float(record['Read Value']))
+				pressure.append(float(record['Pressure [psi]']))
+	return np.array(raw), np.array(pressure)
+
+##------------------------------------------------------------------------------
+## Fitting
+## A fit is a dict that can go straight into calibration.json:
+##  kind         - 'linear', 'polynomial' or 'piecewise'
+##  coefficients - for linear and polynomial fits, of the powers of the raw
+##                 value, highest first (as np.polyval() takes them). A linear
+##                 fit is [CAL_SLOPE, CAL_INTERCEPT].
+##                 For piecewise fits, the intercept and slope of the first
+##                 segment followed by the change in slope at each breakpoint.
+##  breakpoints  - raw values where the segments of a piecewise fit meet
+
+## The columns the coefficients multiply, one row per raw value
+def design_matrix(fit:dict, raw):
+	raw = np.asarray(raw, dtype=float)
+	if fit['kind'] == 'piecewise':
+		# Hinges at each breakpoint keep the segments joined up
+		columns = [np.ones_like(raw), raw]
+		columns += [np.maximum(raw - b, 0) for b in fit['breakpoints']]
+		return np.column_stack(columns)
+	return np.vander(raw, fit['degree'] + 1)
+
+## Least squares fit of pressure to raw value. Returns the fit, with its
+## residual report.
+def fit_captures(raw, pressure, kind:str = 'linear', degree:int = DEFAULT_DEGREE,
+								 breakpoints=None, segments:int = DEFAULT_SEGMENTS) -> dict:
+	if kind not in KINDS:
+		raise ValueError(f"Unknown kind of fit: {kind}")
+	fit = {'kind': kind, 'degree': 1 if kind == 'linear' else degree}
+	if kind == 'piecewise':
+		if breakpoints is None:
+			# Split the captured range into segments with as many readings each
+			breakpoints = np.quantile(raw, np.linspace(0, 1, segments + 1)[1:-1])
+		fit['breakpoints'] = sorted(float(b) for b in breakpoints)
+
+	a = design_matrix(fit, raw)
+	if len(raw) < a.shape[1]:
+		raise ValueError(f"A {kind} fit needs at least {a.shape[1]} readings")
+	# Scale the columns to the same size so high powers of the raw value don't
+	# swamp the rest, then scale the solution back.
+	norms = np.linalg.norm(a, axis=0)
+	norms[norms == 0] = 1
+	solution = np.linalg.lstsq(a/norms, pressure, rcond=None)[0]
+	fit['coefficients'] = (solution/norms).tolist()
+	fit['report'] = residual_report(fit, raw, pressure)
+	return fit
+
+## The pressures a fit gives for raw values (a number or an array)
+def evaluate(fit:dict, raw):
+	return design_matrix(fit, np.atleast_1d(raw)) @ np.array(fit['coefficients'])
+
+## How well a fit matches the captures. The residuals are gauge pressure less
+## fitted pressure, overall and for each gauge pressure captured.
+def residual_report(fit:dict, raw, pressure) -> dict:
+	residuals = pressure - evaluate(fit, raw)
+	spread = np.sum((pressure - pressure.mean())**2)
+	levels = []
+	for level in np.unique(pressure):
+		at_level = pressure == level
+		levels.append({'pressure': float(level),
+									 'readings': int(at_level.sum()),
+									 'mean_raw': float(raw[at_level].mean()),
+									 'mean_residual': float(residuals[at_level].mean()),
+									 'stddev_residual': float(residuals[at_level].std())})
+	return {'readings': int(len(raw)),
+					'rms_residual': float(np.sqrt(np.mean(residuals**2))),
+					'max_residual': float(np.abs(residuals).max()),
+					'r_squared': float(1 - np.sum(residuals**2)/spread) if spread else 1.0,
+					'levels': levels}
+
+##------------------------------------------------------------------------------
+## Versions
+## calibration.json holds every fit made, numbered from 1, and which one is
+## active: {"active": 2, "fits": [{"version": 1, ...}, ...]}
+
+def load_fits() -> dict:
+	if not path.exists(FITS_FILE):
+		return {'active': None, 'fits': []}
+	with open(FITS_FILE, encoding='utf-8') as file:
+		return json.load(file)
+
+def save_fits(fits:dict):
+	replace_file(FITS_FILE, json.dumps(fits, indent=2).encode('utf-8'))
+
+## Keep a new fit as the next version. Returns the version.
+def add_fit(fit:dict, sources=()) -> int:
+	fits = load_fits()
+	version = max((f['version'] for f in fits['fits']), default=0) + 1
+	fit = dict(fit, version=version,
+						 created=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+						 sources=[path.basename(s) for s in sources])
+	fits['fits'].append(fit)
+	save_fits(fits)
+	return version
+
+def get_fit(version:int) -> dict:
+	for fit in load_fits()['fits']:
+		if fit['version'] == version:
+			return fit
+	raise KeyError(f"No calibration version {version}")
+
+## Make a version the active one and compile it into the lookup table
+def activate(version:int):
+	fit = get_fit(version)
+	write_table(compile_table(fit))
+	fits = load_fits()
+	fits['active'] = version
+	save_fits(fits)
+
+##------------------------------------------------------------------------------
+## Lookup table
+## The table is the pressure for every raw value from RAW_MIN up, as little
+## endian doubles, so pressInterface can load it without numpy.
+
+def compile_table(fit:dict):
+	return evaluate(fit, np.arange(RAW_MIN, RAW_MIN + TABLE_SIZE))
+
+def write_table(table):
+	replace_file(TABLE_FILE, table.astype('<f8').tobytes())
+
+# Write a file in one go, so a reader never sees half of it
+def replace_file(filename:str, data:bytes):
+	temporary = filename + '.tmp'
+	with open(temporary, 'wb') as file:
+		file.write(data)
+	os.replace(temporary, filename)
+
+##------------------------------------------------------------------------------
+def print_report(fit:dict):
+	report = fit['report']
+	print(f"{fit['kind']} fit of {report['readings']} readings, "
+				f"coefficients {fit['coefficients']}"
+				+ (f", breakpoints {fit['breakpoints']}" if 'breakpoints' in fit else ''))
+	print(f"RMS residual {report['rms_residual']:.4f} psi, "
+				f"max {report['max_residual']:.4f} psi, R^2 {report['r_squared']:.6f}")
+	print(f"{'psi':>8} {'readings':>8} {'mean raw':>10} {'residual':>9} {'stddev':>8}")
+	for level in report['levels']:
+		print(f"{level['pressure']:>8.2f} {level['readings']:>8} "
+					f"{level['mean_raw']:>10.1f} {level['mean_residual']:>9.4f} "
+					f"{level['stddev_residual']:>8.4f}")
+
+def main():
+	arg_parser = argparse.ArgumentParser(description="Fit and manage calibrations.")
+	commands = arg_parser.add_subparsers(dest='command', required=True)
+	fit_parser = commands.add_parser('fit', help="fit the captures in FILES")
+	fit_parser.add_argument('files', nargs='+')
+	fit_parser.add_argument('--kind', choices=KINDS, default='linear')
+	fit_parser.add_argument('--degree', type=int, default=DEFAULT_DEGREE,
+													help="of a polynomial fit")
+	fit_parser.add_argument('--breakpoints', type=float, nargs='+',
+													help="raw values where a piecewise fit bends")
+	fit_parser.add_argument('--segments', type=int, default=DEFAULT_SEGMENTS,
+													help="of a piecewise fit without breakpoints")
+	fit_parser.add_argument('--activate', action='store_true',
+													help="make the new fit the active one")
+	commands.add_parser('list', help="list the fits made")
+	activate_parser = commands.add_parser('activate', help="make VERSION the active fit")
+	activate_parser.add_argument('version', type=int)
+	args = arg_parser.parse_args()
+	if np is None and args.command != 'list':
+		return "Fitting and activating calibrations needs NumPy."
+
+	if args.command == 'fit':
+		raw, pressure = load_captures(args.files)
+		fit = fit_captures(raw, pressure, args.kind, args.degree,
+											 args.breakpoints, args.segments)
+		version = add_fit(fit, args.files)
+		print(f"Version {version}:")
+		print_report(fit)
+		if args.activate:
+			activate(version)
+			print(f"Version {version} is active. Restart the app to use it.")
+	elif args.command == 'list':
+		fits = load_fits()
+		for fit in fits['fits']:
+			marker = '*' if fit['version'] == fits['active'] else ' '
+			print(f"{marker}{fit['version']:>3} {fit['created'][:19]} {fit['kind']:<10} "
+						f"RMS {fit['report']['rms_residual']:.4f} psi "
+						f"({fit['report']['readings']} readings)")
+	elif args.command == 'activate':
+		activate(args.version)
+		print(f"Version {args.version} is active. Restart the app to use it.")
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,59 @@
+# Single-flight calls
+# cyberdork33 <cyberdork33@gmail.com>
+
+# When several requests want the same slow thing at once (a burst of readings
+# off the I2C bus, say), only the first one does it. The rest wait for it and
+# get the same result. A result is also handed to anyone asking within
+# COALESCE_WINDOW seconds after it came in, so a crowd of clients costs one
+# burst instead of one each.
+
+import threading, time
+
+##------------------------------------------------------------------------------
+## Global Vars
+COALESCE_WINDOW = 0.25 # seconds a result is shared after it comes in
+
+##------------------------------------------------------------------------------
+## One call of the function, shared by everyone who asked for it
+class Call:
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+		self.finished = None
+
+class SingleFlight:
+	def __init__(self, window:float = COALESCE_WINDOW):
+		self.window = window
+		self._calls = {}
+		self._lock = threading.Lock()
+
+	## Returns func(*args), sharing the call with anyone else asking with the
+	## same key while it runs (or for `window` seconds after). Errors and false
+	## results aren't shared after the call, so the next caller tries again.
+	def do(self, key, func, *args):
+		with self._lock:
+			call = self._calls.get(key)
+			leader = call is None or (call.done.is_set()
+																and time.monotonic() - call.finished >= self.window)
+			if leader:
+				call = self._calls[key] = Call()
+
+		if leader:
+			try:
+				call.result = func(*args)
+			except Exception as e:
+				call.error = e
+			finally:
+				call.finished = time.monotonic()
+				if call.error is not None or not call.result:
+					with self._lock:
+						if self._calls.get(key) is call:
+							del self._calls[key]
+				call.done.set()
+		else:
+			call.done.wait()
+
+		if call.error is not None:
+			raise call.error
+		return call.result
@@ -0,0 +1,178 @@
+# Filters for the raw values read from the ADC
+# cyberdork33 <cyberdork33@gmail.com>
+
+# A single I2C glitch or pressure spike drags a plain average a long way, so
+# the raw values go through a pipeline of filters first. The pipeline is
+# given as a comma separated list of stages, applied in order:
+#   hampel - replaces a value that is far outside the recent ones (more than
+#            HAMPEL_THRESHOLD times their spread from their median) with
+#            their median
+#   median - the median of the last MEDIAN_WINDOW values
+#   ema    - exponential smoothing, each value pulled EMA_ALPHA of the way
+#            from the last output
+# An empty pipeline passes the values through untouched.
+#
+# The streaming filters take one value at a time, for the sampler, and only
+# ever look at their fixed window, so each value costs the same however long
+# they have been running. filter_batch() runs a whole burst of values at once
+# with NumPy, if it is installed.
+
+from bisect import bisect_left, insort
+from collections import deque
+
+try:
+	import numpy as np
+except ImportError:
+	np = None # filter_batch() falls back to the streaming filters
+
+##------------------------------------------------------------------------------
+## Global Vars
+MEDIAN_WINDOW = 5 # values the rolling median is taken over
+HAMPEL_WINDOW = 7 # values the outlier test compares against
+HAMPEL_THRESHOLD = 3 # spreads from the median before a value is an outlier
+HAMPEL_MIN_SPREAD = 2 # raw counts. Stops flat (quantized) data flagging everything.
+MAD_SCALE = 1.4826 # turns the median absolute deviation into a standard deviation
+EMA_ALPHA = 0.3 # weight of each new value in the exponential smoothing
+
+##------------------------------------------------------------------------------
+## The median of the last `size` values. The window is kept sorted as well as
+## in order, so each value is one insert and one removal.
+class RollingMedian:
+	def __init__(self, size:int = MEDIAN_WINDOW):
+		self.size = size
+		self.reset()
+
+	def reset(self):
+		self.values = deque()
+		self.sorted = []
+
+	def add(self, value:float) -> float:
+		self.push(value)
+		return self.median()
+
+	def push(self, value:float):
+		if len(self.values) == self.size:
+			del self.sorted[bisect_left(self.sorted, self.values.popleft())]
+		self.values.append(value)
+		insort(self.sorted, value)
+
+	def median(self) -> float:
+		n = len(self.sorted)
+		middle = n//2
+		if n % 2:
+			return self.sorted[middle]
+		return (self.sorted[middle - 1] + self.sorted[middle])/2
+
+##------------------------------------------------------------------------------
+## Hampel filter. A value is compared with the median and median absolute
+## deviation of the `size` values before it, and replaced by the median if it
+## is too far out. Real steps (the water turning on) get through once they
+## make up half of the window.
+class Hampel:
+	def __init__(self, size:int = HAMPEL_WINDOW, threshold:float = HAMPEL_THRESHOLD):
+		self.threshold = threshold
+		self.window = RollingMedian(size)
+
+	def reset(self):
+		self.window.reset()
+
+	def add(self, value:float) -> float:
+		result = value
+		if len(self.window.sorted) >= 3:
+			median = self.window.median()
+			deviation = sorted(abs(v - median) for v in self.window.sorted)
+			spread = max(MAD_SCALE*deviation[len(deviation)//2], HAMPEL_MIN_SPREAD)
+			if abs(value - median) > self.threshold*spread:
+				result = median
+		# The window keeps the value as read. Its median isn't thrown by outliers.
+		self.window.push(value)
+		return result
+
+##------------------------------------------------------------------------------
+## Exponentially weighted moving average
+class ExponentialSmoothing:
+	def __init__(self, alpha:float = EMA_ALPHA):
+		self.alpha = alpha
+		self.reset()
+
+	def reset(self):
+		self.value = None
+
+	def add(self, value:float) -> float:
+		if self.value is None:
+			self.value = value
+		else:
+			self.value += self.alpha*(value - self.value)
+		return self.value
+
+FILTERS = {
+	'median': RollingMedian,
+	'hampel': Hampel,
+	'ema': ExponentialSmoothing,
+}
+
+##------------------------------------------------------------------------------
+## A chain of streaming filters, each feeding the next
+class Pipeline:
+	def __init__(self, stages:list):
+		self.stages = stages
+
+	def add(self, value:float) -> float:
+		for stage in self.stages:
+			value = stage.add(value)
+		return value
+
+	def reset(self):
+		for stage in self.stages:
+			stage.reset()
+
+## Returns the names of the stages in a pipeline spec like 'hampel,ema'.
+## Unknown stages raise a ValueError.
+def parse_spec(spec:str) -> list:
+	names = [name.strip() for name in (spec or '').split(',') if name.strip()]
+	for name in names:
+		if name not in FILTERS:
+			raise ValueError(f"Unknown filter: {name}")
+	return names
+
+def make_pipeline(spec:str) -> Pipeline:
+	return Pipeline([FILTERS[name]() for name in parse_spec(spec)])
+
+##------------------------------------------------------------------------------
+## Runs a burst of values through the pipeline at once. Returns the filtered
+## values. The whole burst is known, so the median and Hampel windows are
+## centred on each value (rather than only looking back as the streaming ones
+## do) and are worked out for every value in one go.
+def filter_batch(values, spec:str) -> list:
+	names = parse_spec(spec)
+	if np is None:
+		pipeline = make_pipeline(spec)
+		return [pipeline.add(value) for value in values]
+
+	values = np.asarray(values, dtype=float)
+	for name in names:
+		if name == 'ema':
+			# Each output depends on the one before, so this one goes in order
+			ema = ExponentialSmoothing()
+			values = np.array([ema.add(value) for value in values])
+		elif len(values) >= 3:
+			size = MEDIAN_WINDOW if name == 'median' else HAMPEL_WINDOW
+			windows = centred_windows(values, size)
+			medians = np.median(windows, axis=1)
+			if name == 'median':
+				values = medians
+			else:
+				deviations = np.median(np.abs(windows - medians[:, None]), axis=1)
+				spreads = np.maximum(MAD_SCALE*deviations, HAMPEL_MIN_SPREAD)
+				outliers = np.abs(values - medians) > HAMPEL_THRESHOLD*spreads
+				values = np.where(outliers, medians, values)
+	return values.tolist()
+
+# Every window of `size` values (or fewer, if there aren't that many) centred
+# on each value, with the ends repeated to fill the windows at the edges
+def centred_windows(values, size:int):
+	size = min(size, len(values))
+	size -= 1 - size % 2 # odd, so there is a middle
+	half = size//2
+	padded = np.pad(values, half, mode='edge')
+	return np.lib.stride_tricks.sliding_window_view(padded, size)
@@ -1,8 +1,12 @@
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, abort
 from os import path
+import argparse
 from dateutil import tz, parser
 # import monitor
 import pressInterface
+import metrics
+from sampler import Sampler
+from store import ReadingStore
 
 # General App Setup
 app = Flask(__name__)
@@ -11,11 +15,42 @@ app.config['SECRET_KEY'] = 'I7JYZmBVX610l15tkv5Ldc7Vnak347auzeXm8tECJS4'
 # Constants
 READ_COUNT = 10
 
+HISTORY_LIMIT = 1000 # Readings returned by /history unless asked for more
+PORT = 5000
+
+# Keep the readings on the Pi so the webhost can catch up after an outage
+store = ReadingStore()
+
+# Sample the sensor continuously in the background so that requests are
+# answered from the latest readings instead of waiting on the ADC.
+sampler = Sampler(window=READ_COUNT, listeners=[store.add])
+sampler.start()
+
+## Returns the rolling average of the latest readings of a channel (the main
+## one if None). Falls back to reading the sensor directly if the sampler
+## hasn't collected anything yet, and gives a 503 if that fails too.
+def current_reading(channel:int = None) -> pressInterface.Reading:
+	r = sampler.reading(channel)
+	if r is None:
+		r = pressInterface.get_shared_reading_ave(READ_COUNT, channel)
+	if not r:
+		# The sensor couldn't be read
+		abort(503)
+	return r
+
+## The channel asked for with ?channel=, or None for the main one. Channels
+## that aren't in pressInterface.CHANNELS get a 404.
+def requested_channel() -> int:
+	channel = request.args.get('channel', type=int)
+	if channel is not None and channel not in pressInterface.CHANNELS:
+		abort(404)
+	return channel
+
 @app.route('/')
 def home():
 	# Read current pressure from sensor
 	# r = monitor.take_reading()
-	r = pressInterface.get_reading_ave(READ_COUNT)
+	r = current_reading()
 
 	# Make it pretty
 	printable_pressure = f"{r.pressure:5.2f}"
@@ -32,7 +67,7 @@ def home():
 
 	# Determine if water is "on"
 	on_now = False
-	if r.pressure > 30:
+	if r.pressure > pressInterface.MIN_PRESSURE_FOR_ON:
 		on_now = True
 
 	return render_template("home.html.j2",
@@ -43,11 +78,49 @@ def home():
 
 @app.route('/json')
 def json():
-	return pressInterface.reading_json()
+	return pressInterface.reading_json(current_reading(requested_channel()))
+
+@app.route('/stats')
+def stats():
+	# Mean, min, max and standard deviation over the latest readings
+	s = sampler.stats(requested_channel())
+	if s is None:
+		return {}, 503
+	return s._asdict()
+
+## Readings stored since the given UNIX time (in seconds), oldest first.
+## Each reading is in the same form as /json. Pass `since` from the response
+## back in to get the next batch.
+@app.route('/history')
+def history():
+	since = request.args.get('since', 0, type=float)
+	limit = request.args.get('limit', HISTORY_LIMIT, type=int)
+	store.flush()
+	readings, last = store.history(since, limit)
+	return {'readings': readings, 'since': last}
 
 @app.route('/calibrate')
 def calibrate():
-	return pressInterface.reading_calibration()
+	readings = sampler.latest(pressInterface.CAL_READINGS, requested_channel())
+	if len(readings) < pressInterface.CAL_READINGS:
+		readings = None
+	return pressInterface.reading_calibration(readings)
+
+## Timings and counts of the sensor reads, for Prometheus to scrape
+@app.route('/metrics')
+def metrics_page():
+	return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
 
+## For production, serve with uWSGI and uwsgi-app.ini. Running this file
+## directly serves each request in a thread of its own with the debugger off,
+## unless --debug is given.
 if __name__ == "__main__":
-	app.run(host='0.0.0.0', debug=True)
+	arg_parser = argparse.ArgumentParser(description="Serve the pressure readings.")
+	arg_parser.add_argument('--debug', action='store_true',
+													help="turn on the Flask debugger (never where others can reach it)")
+	arg_parser.add_argument('--port', type=int, default=PORT)
+	args = arg_parser.parse_args()
+	# The reloader would import this module twice and start a second sampler
+	# on the same I2C bus, so disable it.
+	app.run(host='0.0.0.0', port=args.port, debug=args.debug,
+					threaded=True, use_reloader=False)
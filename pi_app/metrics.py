@@ -0,0 +1,26 @@
+import prometheus_client
+from functools import partial
+from prometheus_client import Counter, generate_latest, CONTENT_TYPE_LATEST
+
+##------------------------------------------------------------------------------
+## Metrics for /metrics, in the Prometheus text exposition format, kept by
+## prometheus_client. Recording a value is an add under a lock, so it is cheap
+## enough to leave in the hot paths.
+## Each process keeps its own metrics and a scrape only sees the process that
+## answers it. That is one more reason the app runs as a single process (see
+## uwsgi-app.ini).
+
+##------------------------------------------------------------------------------
+## Global Vars
+# Upper bounds (seconds) of the histogram buckets. Fine at the bottom for I2C
+# reads, up to whole seconds for averaged readings.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+					 1, 2.5, 5, 10)
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# Histograms of durations, with the buckets above
+Histogram = partial(prometheus_client.Histogram, buckets=BUCKETS)
+
+## Returns every metric in the text format
+def render() -> bytes:
+	return generate_latest()
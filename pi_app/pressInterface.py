@@ -1,41 +1,100 @@
-import board, busio # Modules to interface with I2C
-import datetime, json # Modules for handling readings
+import datetime, json, time, os # Modules for handling readings
+import threading, math, sys
+from array import array
 from collections import namedtuple
+from os import path
 
-# Modules to interface with the ADC
-import adafruit_ads1x15.ads1115 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
+# Module that picks the ADC (or a stand in for it). See backends.py.
+import backends
+import metrics
+# Outlier rejection and smoothing of the raw values. See filters.py.
+import filters
+# The layout of the calibration lookup table. See calibration.py.
+import calibration
+# Lets concurrent requests share one burst of readings. See coalesce.py.
+from coalesce import SingleFlight
 
 ##------------------------------------------------------------------------------
 ## Global Vars
 I2C_ADDRESS = 0x48 # 0x48 is the default
+DATA_RATE = 860 # ADC samples per second. See adc.py for the allowed values.
 CAL_READINGS = 10
+# ADC inputs (0 to 3) with a pressure sensor attached. All of them are read
+# in one pass by scan(). The first one is the main sensor, which is what
+# get_reading() reads.
+CHANNELS = (0,)
+MIN_PRESSURE_FOR_ON = 30 # psi. Below this the water is considered off.
+TRANSITION_BAND = 10 # psi either side of MIN_PRESSURE_FOR_ON while turning on/off
 CAL_SLOPE = 0.00471823169 # Line Slope from calibration
 CAL_INTERCEPT = -2.117998617 # Intercept from calibration
+# The pressure for every raw value is looked up in calibration.TABLE_FILE, a
+# table compiled from the active fit by calibration.py. Without it CAL_SLOPE
+# and CAL_INTERCEPT are used.
+# Filters the raw values go through before they are averaged (and in the
+# sampler). See filters.py for the stages. The READING_FILTERS environment
+# variable overrides this.
+FILTERS = os.environ.get('READING_FILTERS', 'hampel')
+
+##------------------------------------------------------------------------------
+## Metrics (served on /metrics)
+ADC_READ_SECONDS = metrics.Histogram('pi_adc_read_seconds',
+	"Time taken to read conversions from the ADC over I2C.")
+ADC_READ_FAILURES = metrics.Counter('pi_adc_read_failures_total',
+	"Readings or scans of the ADC that failed.")
+AVERAGE_SECONDS = metrics.Histogram('pi_reading_average_seconds',
+	"Time taken by get_reading_ave() to take and average its readings.")
 
 ##------------------------------------------------------------------------------
 ## Setup interface with ADC
-	# Create the I2C bus object
-i2c = busio.I2C(board.SCL, board.SDA)
-# Create the ADC object using the I2C bus
-ads = ADS.ADS1115(i2c, address=I2C_ADDRESS)
-# Create single-ended input on channel 0
-channel0 = AnalogIn(ads, ADS.P0)
+# On the Pi this is the ADC driver for single-ended input on channel 0. It
+# converts continuously so each reading is a single I2C read of the latest
+# result. Set SENSOR_BACKEND to run without the hardware.
+# Every script that reads the sensor shares this one ADC. It isn't set up
+# until the first reading, so importing this module is quick and works even
+# while the I2C bus is unavailable.
+adc = None
+adc_lock = threading.Lock()
+
+## Returns the ADC, setting it up on first use. If setting it up fails (the
+## bus isn't there yet, for instance) the error is raised and the next call
+## tries again.
+def get_adc():
+	global adc
+	if adc is None:
+		with adc_lock:
+			# Another thread may have set it up while this one waited
+			if adc is None:
+				adc = backends.create_backend(cal_slope=CAL_SLOPE,
+																			cal_intercept=CAL_INTERCEPT,
+																			address=I2C_ADDRESS,
+																			pin=CHANNELS[0],
+																			data_rate=DATA_RATE)
+	return adc
 
 ##------------------------------------------------------------------------------
-## Define a named tuple to hold data for a particular reading
-Reading = namedtuple("Reading", "datetime rawvalue voltage pressure")
+## Define a named tuple to hold data for a particular reading. channel is the
+## ADC input it was read from. It is last so that readings from before there
+## were several channels (and anything that only looks at the first four
+## fields) still work.
+Reading = namedtuple("Reading", "datetime rawvalue voltage pressure channel",
+										 defaults=(CHANNELS[0],))
 
 ##------------------------------------------------------------------------------
 ## Every reading taken should report
 ##		1. When it was taken
 ##		2. Raw ADC value
 ##		2. The voltage read
-def get_reading() -> Reading:
+def get_reading(channel:int = None) -> Reading:
+	if channel is None:
+		channel = CHANNELS[0]
 	try:
-		# read raw data from from ADC
-		raw_value = channel0.value
-		voltage = channel0.voltage
+		# read raw data from from ADC. The voltage is calculated from the same
+		# conversion rather than read again.
+		with ADC_READ_SECONDS.time():
+			if channel == CHANNELS[0]:
+				raw_value, voltage = get_adc().read()
+			else:
+				raw_value, voltage = get_adc().scan([channel])[0]
 
 		# Get the current UTC date and time, and include timezone info.
 		ct = datetime.datetime.now(datetime.timezone.utc)
@@ -43,32 +102,84 @@ def get_reading() -> Reading:
 		this_reading = Reading(datetime=ct.strftime('%Y-%m-%d %H:%M:%S %Z'),
 													rawvalue=raw_value,
 													voltage=voltage,
-													pressure=getPressure(raw_value))
+													pressure=getPressure(raw_value),
+													channel=channel)
 
 		return this_reading
 	except:
+		ADC_READ_FAILURES.inc()
 		print("There was an error while taking the reading.")
 		return False
 
-def get_reading_ave(count:int) -> Reading:
-	valuesTotal = 0
-	voltagesTotal = 0
+##------------------------------------------------------------------------------
+## Reads every input in CHANNELS back to back, in one pass. Returns a list of
+## readings (in the order of CHANNELS) that all have the same timestamp, or
+## False if the scan failed.
+def scan() -> list:
+	try:
+		ct = datetime.datetime.now(datetime.timezone.utc)
+		timestamp = ct.strftime('%Y-%m-%d %H:%M:%S %Z')
+		with ADC_READ_SECONDS.time():
+			values = get_adc().scan(CHANNELS)
+		return [Reading(datetime=timestamp,
+										rawvalue=raw_value,
+										voltage=voltage,
+										pressure=getPressure(raw_value),
+										channel=channel)
+						for channel, (raw_value, voltage) in zip(CHANNELS, values)]
+	except:
+		ADC_READ_FAILURES.inc()
+		print("There was an error while scanning the sensors.")
+		return False
+
+##------------------------------------------------------------------------------
+## Takes count readings of a channel in a burst and returns their average,
+## after running them through FILTERS so a glitch doesn't skew it. Readings
+## that fail are left out. Returns False if they all fail.
+def get_reading_ave(count:int, channel:int = None) -> Reading:
+	started = time.perf_counter()
+	if channel is None:
+		channel = CHANNELS[0]
 	ct = datetime.datetime.now(datetime.timezone.utc)
+	values = []
 	for i in range(count):
-		r = get_reading()
-		valuesTotal += r.rawvalue
-		voltagesTotal += r.voltage
+		if i > 0:
+			# Give the ADC time to finish a new conversion so that each
+			# reading is a different sample.
+			time.sleep(get_adc().conversion_time)
+		r = get_reading(channel)
+		if r:
+			values.append(r.rawvalue)
+	if not values:
+		return False
+
+	values = filters.filter_batch(values, FILTERS)
+	rawvalue = sum(values)/len(values)
 	this_reading = Reading(datetime=ct.strftime('%Y-%m-%d %H:%M:%S %Z'),
-												rawvalue=valuesTotal/count,
-												voltage=voltagesTotal/count,
-												pressure=getPressure(valuesTotal/count))
+												rawvalue=rawvalue,
+												voltage=get_adc().to_voltage(rawvalue),
+												pressure=getPressure(rawvalue),
+												channel=channel)
+	AVERAGE_SECONDS.observe(time.perf_counter() - started)
 	return this_reading
 
+##------------------------------------------------------------------------------
+## The same as get_reading_ave(), but callers asking for the same burst at the
+## same time (or just after) all get the one burst, instead of each taking
+## their own turns on the I2C bus.
+bursts = SingleFlight()
+
+def get_shared_reading_ave(count:int, channel:int = None) -> Reading:
+	if channel is None:
+		channel = CHANNELS[0]
+	return bursts.do((count, channel), get_reading_ave, count, channel)
+
 ##------------------------------------------------------------------------------
 ## Returns reading data as a JSON string
-def reading_json() -> str:
+def reading_json(r: Reading = None) -> str:
 	# r = get_reading()
-	r = get_reading_ave(CAL_READINGS)
+	if r is None:
+		r = get_shared_reading_ave(CAL_READINGS)
 	return json.dumps(r)
 
 ##------------------------------------------------------------------------------
@@ -80,18 +191,54 @@ def reading_string() -> str:
 
 ##------------------------------------------------------------------------------
 ## Returns several reading in a format that can be used for calibration
-def reading_calibration() -> str:
+def reading_calibration(readings: list = None) -> str:
 	# print("Timestamp, Raw Value, Voltage [V]")
+	if readings is None:
+		readings = [get_reading() for i in range(CAL_READINGS)]
 	result = ''
-	for i in range(CAL_READINGS):
-		r = get_reading()
+	for r in readings:
 		result += f"{r.datetime:25}{r.rawvalue:5} {r.voltage:7.5f}<br />\n"
 	return result
 
 ##------------------------------------------------------------------------------
-## The linear curve fit to convert the raw integer to pressure.
+## Whether the pressure is close enough to MIN_PRESSURE_FOR_ON that the water
+## is probably turning on or off. Readings are taken and kept more often then.
+def near_transition(pressure) -> bool:
+	return abs(pressure - MIN_PRESSURE_FOR_ON) < TRANSITION_BAND
+
+##------------------------------------------------------------------------------
+## Returns the lookup table in calibration.TABLE_FILE, or None if there isn't
+## one (or it isn't the right size).
+def load_pressure_table() -> array:
+	if not path.exists(calibration.TABLE_FILE):
+		return None
+	table = array('d')
+	with open(calibration.TABLE_FILE, 'rb') as file:
+		table.frombytes(file.read())
+	if len(table) != calibration.TABLE_SIZE:
+		print(f"Ignoring {calibration.TABLE_FILE}: it has {len(table)} entries.")
+		return None
+	if sys.byteorder == 'big':
+		table.byteswap() # the file is little endian
+	return table
+
+pressure_table = load_pressure_table()
+
+##------------------------------------------------------------------------------
+## Convert the raw value to pressure with the calibration. With a lookup table
+## a raw value is a single index. Averaged raw values fall between entries, so
+## they are interpolated between the two either side.
 def getPressure(rawvalue) -> float:
-	return CAL_SLOPE*rawvalue+CAL_INTERCEPT
+	if pressure_table is None:
+		return CAL_SLOPE*rawvalue+CAL_INTERCEPT
+	index = min(max(rawvalue - calibration.RAW_MIN, 0), calibration.TABLE_SIZE - 1)
+	if isinstance(index, int):
+		return pressure_table[index]
+	lower = math.floor(index)
+	fraction = index - lower
+	if fraction == 0:
+		return pressure_table[lower]
+	return pressure_table[lower] + fraction*(pressure_table[lower + 1] - pressure_table[lower])
 
 if __name__ == "__main__":
 	# print("Timestamp, Raw Value, Voltage [V]")
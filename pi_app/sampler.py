@@ -0,0 +1,193 @@
+import threading, time, math
+from collections import deque, namedtuple
+
+import pressInterface
+import metrics
+import filters
+
+##------------------------------------------------------------------------------
+## Global Vars
+SAMPLE_RATE = 10 # Readings per second taken by the sampler thread
+FAST_SAMPLE_RATE = 50 # Readings per second while the water turns on or off
+BUFFER_SIZE = 600 # Readings kept in the ring buffer (1 minute at 10 /s)
+WINDOW_SIZE = 10 # Readings the rolling statistics are calculated over
+OVERRUNS = metrics.Counter('pi_sampler_overruns_total',
+	"Sampler passes that took longer than the sampling period.")
+
+##------------------------------------------------------------------------------
+## Define a named tuple to hold the rolling statistics over the last readings.
+## datetime is the time of the newest reading in the window, the rest are
+## calculated from the raw values and pressures of every reading in the window.
+Stats = namedtuple("Stats", "datetime count rawvalue voltage pressure "
+                            "min_pressure max_pressure stddev_pressure")
+
+##------------------------------------------------------------------------------
+## Rolling statistics over the latest `size` readings of one channel. The
+## totals are updated as each reading comes in and drops out of the window,
+## so the statistics never have to go back over the whole window.
+class RollingStats:
+	def __init__(self, size=WINDOW_SIZE):
+		self.window = deque(maxlen=size)
+		self.stats = None
+		self._raw_total = 0
+		self._voltage_total = 0
+		self._pressure_total = 0
+		self._pressure_squares = 0
+
+	def add(self, r) -> Stats:
+		# Drop the oldest reading from the running totals
+		if len(self.window) == self.window.maxlen:
+			old = self.window[0]
+			self._raw_total -= old.rawvalue
+			self._voltage_total -= old.voltage
+			self._pressure_total -= old.pressure
+			self._pressure_squares -= old.pressure**2
+		self.window.append(r)
+		self._raw_total += r.rawvalue
+		self._voltage_total += r.voltage
+		self._pressure_total += r.pressure
+		self._pressure_squares += r.pressure**2
+
+		count = len(self.window)
+		mean_raw = self._raw_total/count
+		mean_pressure = self._pressure_total/count
+		variance = max(self._pressure_squares/count - mean_pressure**2, 0)
+		pressures = [w.pressure for w in self.window]
+		self.stats = Stats(datetime=r.datetime,
+											 count=count,
+											 rawvalue=mean_raw,
+											 voltage=self._voltage_total/count,
+											 pressure=pressInterface.getPressure(mean_raw),
+											 min_pressure=min(pressures),
+											 max_pressure=max(pressures),
+											 stddev_pressure=math.sqrt(variance))
+		return self.stats
+
+##------------------------------------------------------------------------------
+## Continuously samples the ADC in a background thread so that web requests
+## never have to wait on an I2C conversion. Each pass reads every channel in
+## pressInterface.CHANNELS. Readings go into a fixed-size ring buffer per
+## channel and the rolling statistics are recalculated as each reading
+## arrives, so asking for them is just returning the last calculated value.
+## The raw values of each channel go through a streaming filter pipeline (see
+## filters.py) before they are kept, so glitches never reach the statistics.
+## Methods that take a channel default to the main one (the first in CHANNELS).
+class Sampler:
+	def __init__(self, read=pressInterface.scan, rate=SAMPLE_RATE,
+							 size=BUFFER_SIZE, window=WINDOW_SIZE, listeners=(),
+							 fast_rate=FAST_SAMPLE_RATE, filter_spec=None):
+		# Returns a list of readings, one per channel (or False on failure)
+		self.read = read
+		self.rate = rate
+		self.fast_rate = fast_rate
+		self.size = size
+		self.window_size = window
+		# Called from the sampler thread with the rolling average Reading of each
+		# channel after every new reading.
+		self.listeners = list(listeners)
+		# Stages of the filter pipeline, pressInterface.FILTERS by default
+		self.filter_spec = pressInterface.FILTERS if filter_spec is None else filter_spec
+		filters.parse_spec(self.filter_spec) # fail now on a bad spec
+		self.buffers = {}
+		self.windows = {}
+		self.pipelines = {}
+		self._lock = threading.Lock()
+		self._stop = threading.Event()
+		self._thread = None
+
+	def start(self):
+		if self._thread is not None and self._thread.is_alive():
+			return
+		self._stop.clear()
+		self._thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+
+	def is_running(self) -> bool:
+		return self._thread is not None and self._thread.is_alive()
+
+	## Returns the rolling statistics of a channel, or None before its first
+	## reading.
+	def stats(self, channel:int = None) -> Stats:
+		window = self.windows.get(main_channel(channel))
+		return window.stats if window else None
+
+	## Returns the latest readings (newest last), up to count of them.
+	def latest(self, count:int, channel:int = None) -> list:
+		with self._lock:
+			buffer = self.buffers.get(main_channel(channel), ())
+			count = min(count, len(buffer))
+			return [buffer[-i] for i in range(count, 0, -1)]
+
+	## Returns the rolling statistics as a Reading, the same as
+	## pressInterface.get_reading_ave() would.
+	def reading(self, channel:int = None) -> pressInterface.Reading:
+		channel = main_channel(channel)
+		s = self.stats(channel)
+		if s is None:
+			return None
+		return pressInterface.Reading(datetime=s.datetime,
+																	rawvalue=s.rawvalue,
+																	voltage=s.voltage,
+																	pressure=s.pressure,
+																	channel=channel)
+
+	## Sample faster while the water is turning on or off (on any channel) so
+	## that the edges are sharp, and slower the rest of the time when the
+	## pressure is flat.
+	def current_rate(self) -> float:
+		for window in list(self.windows.values()):
+			s = window.stats
+			if s is not None and pressInterface.near_transition(s.pressure):
+				return self.fast_rate
+		return self.rate
+
+	def _run(self):
+		next_time = time.monotonic()
+		while not self._stop.is_set():
+			readings = self.read()
+			if readings:
+				for r in readings:
+					self._add(r)
+				for r in readings:
+					self._notify(r.channel)
+
+			# Keep a steady rate no matter how long the reading took
+			next_time += 1/self.current_rate()
+			delay = next_time - time.monotonic()
+			if delay > 0:
+				self._stop.wait(delay)
+			else:
+				# We fell behind. Don't try to catch up with a burst of readings.
+				OVERRUNS.inc()
+				next_time = time.monotonic()
+
+	def _notify(self, channel:int):
+		average = self.reading(channel)
+		for listener in self.listeners:
+			try:
+				listener(average)
+			except Exception as e:
+				print(f"Sampler listener failed: {e}")
+
+	def _add(self, r):
+		with self._lock:
+			if r.channel not in self.windows:
+				self.windows[r.channel] = RollingStats(self.window_size)
+				self.buffers[r.channel] = deque(maxlen=self.size)
+				self.pipelines[r.channel] = filters.make_pipeline(self.filter_spec)
+			raw_value = self.pipelines[r.channel].add(r.rawvalue)
+			if raw_value != r.rawvalue:
+				r = r._replace(rawvalue=raw_value,
+											 voltage=pressInterface.get_adc().to_voltage(raw_value),
+											 pressure=pressInterface.getPressure(raw_value))
+			self.buffers[r.channel].append(r)
+			self.windows[r.channel].add(r)
+
+# The given channel, or the main one if None
+def main_channel(channel:int = None) -> int:
+	return pressInterface.CHANNELS[0] if channel is None else channel
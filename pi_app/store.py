@@ -0,0 +1,139 @@
+# Local storage of readings on the Pi
+# cyberdork33 <cyberdork33@gmail.com>
+
+import sqlite3, threading, time, datetime
+from os import path
+
+import pressInterface
+
+##------------------------------------------------------------------------------
+## Global Vars
+STORE_PATH = path.join(path.dirname(path.abspath(__file__)), 'readings.sqlite3')
+STORE_INTERVAL = 60 # Seconds between stored readings. 0 stores every reading.
+FAST_STORE_INTERVAL = 5 # Seconds between stored readings while turning on/off
+FLUSH_INTERVAL = 5 # Seconds readings are held in memory before being written
+RETENTION_DAYS = 90 # Readings older than this are deleted
+PRUNE_INTERVAL = 60*60 # Seconds between checks for old readings
+PRUNE_CHUNK = 5000 # Most rows deleted per statement when pruning
+HISTORY_LIMIT = 10000 # Most readings returned by one history() call
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
+
+##------------------------------------------------------------------------------
+## Keeps every reading the Pi takes in an SQLite database so that nothing is
+## lost while the webhost is down. The webhost can catch up afterwards by
+## asking for everything since the last reading it has (see history()).
+##
+## The database runs in WAL mode so the web requests reading history never
+## block the sampler writing to it. Writes are buffered and done in batches,
+## and readings older than RETENTION_DAYS are deleted a chunk at a time.
+class ReadingStore:
+	def __init__(self, filename:str = STORE_PATH, interval:float = STORE_INTERVAL,
+							 fast_interval:float = FAST_STORE_INTERVAL):
+		self.filename = filename
+		self.interval = interval
+		self.fast_interval = fast_interval
+		self._pending = []
+		self._last_stored = {} # channel -> when its last reading was stored
+		self._last_ts = 0
+		self._last_flush = time.monotonic()
+		self._last_prune = 0
+		self._lock = threading.Lock()
+		self._local = threading.local()
+
+		db = self._connection()
+		db.execute("PRAGMA journal_mode=WAL")
+		db.execute("CREATE TABLE IF NOT EXISTS readings ("
+							 "ts REAL NOT NULL, "
+							 "datetime TEXT NOT NULL, "
+							 "rawvalue REAL, "
+							 "voltage REAL, "
+							 "pressure REAL, "
+							 "channel INTEGER NOT NULL DEFAULT 0)")
+		columns = [row[1] for row in db.execute("PRAGMA table_info(readings)")]
+		if 'channel' not in columns:
+			# Stores from before there were several channels only had the main one
+			db.execute("ALTER TABLE readings ADD COLUMN channel INTEGER NOT NULL "
+								 f"DEFAULT {pressInterface.CHANNELS[0]}")
+		db.execute("CREATE INDEX IF NOT EXISTS readings_ts ON readings (ts)")
+		db.commit()
+
+	## Each thread gets its own connection to the database.
+	def _connection(self) -> sqlite3.Connection:
+		db = getattr(self._local, 'db', None)
+		if db is None:
+			db = self._local.db = sqlite3.connect(self.filename)
+			db.execute("PRAGMA synchronous=NORMAL")
+		return db
+
+	## Queue a reading to be stored. Readings that come in less than `interval`
+	## seconds after the last stored reading of the same channel are skipped.
+	## While the water is turning on or off, `fast_interval` is used instead.
+	def add(self, r: pressInterface.Reading):
+		if not r:
+			return
+		ts = parse_timestamp(r.datetime)
+		interval = self.interval
+		if pressInterface.near_transition(r.pressure):
+			interval = min(interval, self.fast_interval)
+		with self._lock:
+			if interval and ts - self._last_stored.get(r.channel, 0) < interval:
+				return
+			# Timestamps only have whole seconds, so readings taken within the same
+			# second (or on other channels in the same scan) are nudged apart to
+			# keep them in order when paging history.
+			ts = max(ts, self._last_ts + 1e-6)
+			self._last_ts = self._last_stored[r.channel] = ts
+			self._pending.append((ts, r.datetime, r.rawvalue, r.voltage, r.pressure,
+														r.channel))
+
+		now = time.monotonic()
+		if now - self._last_flush >= FLUSH_INTERVAL:
+			self.flush()
+		if now - self._last_prune >= PRUNE_INTERVAL:
+			self._last_prune = now
+			self.prune()
+
+	## Write any queued readings to the database in one transaction.
+	def flush(self):
+		with self._lock:
+			pending, self._pending = self._pending, []
+			self._last_flush = time.monotonic()
+		if not pending:
+			return
+		db = self._connection()
+		with db:
+			db.executemany("INSERT INTO readings (ts, datetime, rawvalue, voltage, "
+										 "pressure, channel) VALUES (?, ?, ?, ?, ?, ?)", pending)
+
+	## Delete readings older than the retention period, a chunk at a time so
+	## that the database is never locked for long.
+	def prune(self, days:float = RETENTION_DAYS) -> int:
+		cutoff = time.time() - days*24*60*60
+		db = self._connection()
+		deleted = 0
+		while True:
+			with db:
+				count = db.execute("DELETE FROM readings WHERE rowid IN "
+													 "(SELECT rowid FROM readings WHERE ts < ? LIMIT ?)",
+													 (cutoff, PRUNE_CHUNK)).rowcount
+			deleted += count
+			if count < PRUNE_CHUNK:
+				return deleted
+
+	## Returns up to `limit` readings (of every channel) taken after `since`
+	## (UNIX time in seconds), oldest first, along with the time of the last one
+	## returned.
+	def history(self, since:float = 0, limit:int = HISTORY_LIMIT):
+		limit = max(0, min(limit, HISTORY_LIMIT))
+		rows = self._connection().execute(
+			"SELECT ts, datetime, rawvalue, voltage, pressure, channel FROM readings "
+			"WHERE ts > ? ORDER BY ts LIMIT ?", (since, limit)).fetchall()
+		readings = [pressInterface.Reading(*row[1:]) for row in rows]
+		last = rows[-1][0] if rows else since
+		return readings, last
+
+##------------------------------------------------------------------------------
+## Reading timestamps are strings (see pressInterface.get_reading)
+def parse_timestamp(timestamp:str) -> float:
+	ct = datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+	return ct.replace(tzinfo=datetime.timezone.utc).timestamp()
@@ -6,23 +6,9 @@
 import time
 import datetime
 import csv
-import board
-import busio
-import adafruit_ads1x15.ads1115 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
 
-# Global Vars
-supply_voltage = 3.3# Volts
-TIME_BETWEEN_READINGS = 0.5
-
-# Create the I2C bus object
-i2c = busio.I2C(board.SCL, board.SDA)
-
-# Create the ADC object using the I2C bus
-ads = ADS.ADS1115(i2c, address=0x48)
-
-# Create single-ended input on channel 0
-channel0 = AnalogIn(ads, ADS.P0)
+# The shared sensor module. It owns the ADC.
+import pressInterface
 
 ## GLOBAL VARS
 READINGS = 10 # how many readings to take.
@@ -45,8 +31,7 @@ with open(pressure+'.csv', 'w', newline='', encoding='utf-8') as file:
 		# Read the specified ADC channel using the previously set gain value.
 		# Values read will be a 16-bit signed integer value
 		
-		read_value = channel0.value
-		read_voltage = channel0.voltage
+		read_value, read_voltage = pressInterface.get_adc().read()
 		
 		# Print the ADC values.
 		print(' {:>5} {:>5.3f}'.format(read_value, read_voltage))
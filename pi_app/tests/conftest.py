@@ -0,0 +1,7 @@
+import os, sys
+
+# The modules of pi_app import each other by name, as when it runs from its
+# own directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# There is no ADC here
+os.environ.setdefault('SENSOR_BACKEND', 'simulated')
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+import calibration
+import pressInterface
+
+SLOPE = pressInterface.CAL_SLOPE
+INTERCEPT = pressInterface.CAL_INTERCEPT
+
+# The lookup table of a linear fit with the default calibration constants
+@pytest.fixture
+def linear_table(tmp_path, monkeypatch):
+	table_file = str(tmp_path/'calibration.table')
+	monkeypatch.setattr(calibration, 'TABLE_FILE', table_file)
+	fit = {'kind': 'linear', 'degree': 1, 'coefficients': [SLOPE, INTERCEPT]}
+	calibration.write_table(calibration.compile_table(fit))
+	monkeypatch.setattr(pressInterface, 'pressure_table',
+											pressInterface.load_pressure_table())
+
+def test_without_table_uses_constants(monkeypatch):
+	monkeypatch.setattr(pressInterface, 'pressure_table', None)
+	assert pressInterface.getPressure(9000) == pytest.approx(SLOPE*9000 + INTERCEPT)
+
+@pytest.mark.parametrize('raw', [-32768, -1, 0, 449, 9000, 12345, 32767])
+def test_table_matches_constants(linear_table, raw):
+	assert pressInterface.pressure_table is not None
+	assert pressInterface.getPressure(raw) == pytest.approx(SLOPE*raw + INTERCEPT)
+
+@pytest.mark.parametrize('raw', [-0.5, 0.25, 9000.5, 12345.9, 32766.01])
+def test_averaged_values_are_interpolated(linear_table, raw):
+	assert pressInterface.getPressure(raw) == pytest.approx(SLOPE*raw + INTERCEPT)
+
+def test_linear_fit_recovers_constants():
+	raw = np.repeat([450.0, 4700.0, 8950.0, 13200.0], 10)
+	pressure = SLOPE*raw + INTERCEPT
+	fit = calibration.fit_captures(raw, pressure, 'linear')
+	assert fit['coefficients'] == pytest.approx([SLOPE, INTERCEPT])
+	assert fit['report']['rms_residual'] == pytest.approx(0, abs=1e-9)
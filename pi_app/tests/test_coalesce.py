@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+from coalesce import SingleFlight
+
+def test_concurrent_calls_share_one_result():
+	flight = SingleFlight(window=60)
+	started, release = threading.Event(), threading.Event()
+	calls = []
+	def burst():
+		calls.append(1)
+		started.set()
+		release.wait(5)
+		return len(calls)
+
+	results = []
+	def ask():
+		results.append(flight.do('burst', burst))
+	threads = [threading.Thread(target=ask) for i in range(5)]
+	threads[0].start()
+	started.wait(5)
+	for thread in threads[1:]:
+		thread.start()
+	release.set()
+	for thread in threads:
+		thread.join(5)
+
+	assert len(calls) == 1
+	assert results == [1]*5
+
+def test_result_shared_within_window_only():
+	calls = []
+	def count():
+		calls.append(1)
+		return len(calls)
+
+	flight = SingleFlight(window=60)
+	assert flight.do('key', count) == 1
+	assert flight.do('key', count) == 1
+	assert flight.do('other', count) == 2
+
+	flight = SingleFlight(window=0)
+	assert flight.do('key', count) == 3
+	assert flight.do('key', count) == 4
+
+def test_error_is_not_shared_after_the_call():
+	flight = SingleFlight(window=60)
+	attempts = []
+	def flaky():
+		attempts.append(1)
+		if len(attempts) == 1:
+			raise OSError("I2C read failed")
+		return 42
+
+	with pytest.raises(OSError):
+		flight.do('key', flaky)
+	assert flight.do('key', flaky) == 42
+	assert len(attempts) == 2
+
+def test_failed_reading_is_not_shared_after_the_call():
+	flight = SingleFlight(window=60)
+	results = iter([False, 7])
+	assert flight.do('key', lambda: next(results)) is False
+	assert flight.do('key', lambda: next(results)) == 7
@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+import filters
+
+# A steady pressure with one wild reading (an I2C glitch) in the middle
+GLITCHED = [10.0]*10 + [100.0] + [10.0]*10
+
+def stream(values, spec:str) -> list:
+	pipeline = filters.make_pipeline(spec)
+	return [pipeline.add(value) for value in values]
+
+def noisy_ramp(count:int = 200) -> list:
+	rng = random.Random(1)
+	return [i*0.25 + rng.gauss(0, 1) for i in range(count)]
+
+# Worked out by hand for MEDIAN_WINDOW = 5 and EMA_ALPHA = 0.3
+VALUES = [1, 5, 2, 8, 3, 9, 4]
+# Of the values so far, up to the last 5
+STREAM_MEDIANS = [1, 3, 2, 3.5, 3, 5, 4]
+# Of 5 values centred on each one, with the ends repeated
+BATCH_MEDIANS = [1, 2, 3, 5, 4, 4, 4]
+SMOOTHED = [0, 3, 5.1, 6.57]
+
+def test_stream_median():
+	assert stream(VALUES, 'median') == STREAM_MEDIANS
+
+def test_batch_median():
+	assert filters.filter_batch(VALUES, 'median') == BATCH_MEDIANS
+
+def test_batch_median_without_numpy(monkeypatch):
+	# Falls back to the streaming filters
+	monkeypatch.setattr(filters, 'np', None)
+	assert filters.filter_batch(VALUES, 'median') == STREAM_MEDIANS
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_ema(batch):
+	values = [0, 10, 10, 10]
+	result = filters.filter_batch(values, 'ema') if batch else stream(values, 'ema')
+	assert result == pytest.approx(SMOOTHED)
+
+def test_empty_pipeline_passes_values_through():
+	assert filters.filter_batch(VALUES, '') == VALUES
+	assert stream(VALUES, '') == VALUES
+
+@pytest.mark.parametrize('spec', ['hampel', 'median', 'hampel,median,ema'])
+def test_batch_and_stream_drop_glitch(spec):
+	# The centred and trailing windows agree on a steady value, so both take
+	# the glitch out completely
+	assert filters.filter_batch(GLITCHED, spec) == pytest.approx([10.0]*len(GLITCHED))
+	assert stream(GLITCHED, spec) == pytest.approx([10.0]*len(GLITCHED))
+
+def test_batch_keeps_length():
+	values = noisy_ramp(2)
+	for spec in ['hampel', 'median', 'hampel,median,ema']:
+		assert len(filters.filter_batch(values, spec)) == len(values)
+
+def test_unknown_stage():
+	with pytest.raises(ValueError):
+		filters.parse_spec('hampel,mean')
@@ -0,0 +1,251 @@
+## Benchmarks for the hot paths of the webhost: serving the home page, the
+## pieces it is built from, and recording new readings. Each run seeds a
+## separate SQLite database with synthetic readings (the production database
+## is never touched) and reports latency percentiles, throughput and peak
+## memory, as JSON lines in bench_output.txt and as a table on the console.
+##
+## Run from this directory:
+##   python benchmark.py                       # 10k, 1M and 10M readings
+##   python benchmark.py --sizes 10000 100000 --repeat 20
+## Seeding 10M readings takes a while, so seeded databases are kept in
+## --database-dir and reused by later runs.
+##
+## record_new_reading normally fetches from the Pi. Unless --source is given
+## (for example a pi_app running with SENSOR_BACKEND=simulated), the fetch is
+## replaced with a synthetic reading so only the webhost side is measured.
+
+import argparse, json, os, random, resource, tempfile, time, tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from website import create_app, db, DEFAULT_SENSOR_ID
+from website import data_fetch, views
+from website.models import MonitorReading
+from website.rollups import rebuild_rollups
+from website.analytics import rebuild_intervals
+from website.render_cache import plot_cache
+
+## GLOBALS
+SIZES = [10_000, 1_000_000, 10_000_000]
+REPEAT = 50 # timed runs of each benchmark
+INGEST_BATCH = 1000 # readings per record_readings call when timing ingest
+INGEST_BATCHES = 10
+SEED_INTERVAL = timedelta(minutes=1) # time between synthetic readings
+SEED_CHUNK = 50_000 # readings inserted per statement while seeding
+ON_HOURS = ((4, 8), (20, 22)) # UTC hours the synthetic water is on
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTPUT = os.path.join(BENCH_DIR, '..', 'bench_output.txt')
+DATABASE_DIR = os.path.join(tempfile.gettempdir(), 'pressure_monitor_bench')
+
+##------------------------------------------------------------------------------
+## Synthetic readings
+
+# Readings every SEED_INTERVAL up to `end`, as dicts of MonitorReading
+# columns, a chunk at a time. The water is on during ON_HOURS, with noise.
+def synthetic_readings(count: int, end: datetime, seed: int = 0):
+  rng = np.random.default_rng(seed)
+  step = int(SEED_INTERVAL.total_seconds())
+  start = end - SEED_INTERVAL*(count - 1)
+  for first in range(0, count, SEED_CHUNK):
+    n = min(SEED_CHUNK, count - first)
+    seconds = (first + np.arange(n))*step
+    dates = [start + timedelta(seconds=int(s)) for s in seconds]
+    hours = np.array([d.hour for d in dates])
+    on = np.zeros(n, dtype=bool)
+    for first_hour, last_hour in ON_HOURS:
+      on |= (hours >= first_hour) & (hours < last_hour)
+    pressures = np.where(on, 55.0, 0.5) + rng.normal(0, 0.3, n)
+    yield [synthetic_row(d, p) for d, p in zip(dates, pressures.tolist())]
+
+def synthetic_row(when: datetime, pressure: float) -> dict:
+  rawvalue = (pressure + 2.117998617)/0.00471823169
+  return {'datetime': when,
+          'rawvalue': rawvalue,
+          'voltage': rawvalue*4.096/32767,
+          'pressure': pressure}
+
+# Fill the database with `count` readings ending now, and build the rollups
+# and intervals from them. Databases that already hold the readings are left
+# alone. Returns the seconds spent seeding (0 if nothing was done).
+def seed(count: int) -> float:
+  if MonitorReading.query.count() >= count:
+    return 0
+  MonitorReading.query.delete()
+  started = time.perf_counter()
+  for rows in synthetic_readings(count, datetime.utcnow()):
+    db.session.execute(MonitorReading.__table__.insert(), rows)
+    db.session.commit()
+  rebuild_rollups()
+  rebuild_intervals()
+  return time.perf_counter() - started
+
+##------------------------------------------------------------------------------
+## Measuring
+
+# Seconds taken by each of `repeat` calls of func, after one warm up call.
+# `before` is called ahead of each run, outside of the timing.
+def timings(func, repeat: int, before=None) -> np.ndarray:
+  if before:
+    before()
+  func()
+  times = []
+  for _ in range(repeat):
+    if before:
+      before()
+    started = time.perf_counter()
+    func()
+    times.append(time.perf_counter() - started)
+  return np.array(times)
+
+# Largest amount of memory (bytes) allocated by Python while running func
+def peak_memory(func) -> int:
+  tracemalloc.start()
+  try:
+    func()
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+def latency_result(size: int, name: str, times: np.ndarray, func=None) -> dict:
+  result = {'size': size,
+            'benchmark': name,
+            'runs': len(times),
+            'p50_ms': float(np.percentile(times, 50)*1000),
+            'p99_ms': float(np.percentile(times, 99)*1000),
+            'mean_ms': float(times.mean()*1000),
+            'max_ms': float(times.max()*1000)}
+  if func is not None:
+    result['peak_memory_bytes'] = peak_memory(func)
+  return result
+
+##------------------------------------------------------------------------------
+## A source of new readings for record_new_reading. Each one comes a minute
+## after the last, starting from now (or the newest reading in the database if
+## that is later).
+class SyntheticSource:
+  def __init__(self):
+    self.rng = random.Random(0)
+    self.last = None
+
+  def __call__(self, address: str, sensor_id: int = DEFAULT_SENSOR_ID) -> MonitorReading:
+    if self.last is None:
+      self.last = datetime.utcnow() - SEED_INTERVAL
+      newest = MonitorReading.query.order_by(MonitorReading.datetime.desc()).first()
+      if newest and newest.datetime > self.last:
+        self.last = newest.datetime
+    self.last += SEED_INTERVAL
+    row = synthetic_row(self.last, 55 + self.rng.gauss(0, 0.3))
+    return MonitorReading(sensor_id=sensor_id, **row)
+
+  # A batch of new readings as dicts for record_readings
+  def batch(self, count: int) -> list:
+    return [{column: getattr(reading, column)
+             for column in ('datetime', 'rawvalue', 'voltage', 'pressure')}
+            for reading in (self(None) for _ in range(count))]
+
+##------------------------------------------------------------------------------
+## Run every benchmark against a database of `size` readings
+def run_size(size: int, args) -> list:
+  filename = os.path.join(args.database_dir, f'bench_{size}.sqlite3')
+  app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{filename}'})
+  results = []
+  with app.app_context():
+    seconds = seed(size)
+    if seconds:
+      results.append({'size': size, 'benchmark': 'seed',
+                      'seconds': seconds, 'readings_per_s': size/seconds})
+
+    source = SyntheticSource()
+    address = args.source
+    if address is None:
+      data_fetch.get_new_reading = source
+      address = 'synthetic'
+    # Start from a fresh reading so the page doesn't think the data is stale
+    data_fetch.record_readings(source.batch(1))
+
+    client = app.test_client()
+    results.append(latency_result(size, 'home (cold)',
+                                  timings(lambda: client.get('/'), args.repeat,
+                                          plot_cache.clear),
+                                  lambda: (plot_cache.clear(), client.get('/'))))
+    results.append(latency_result(size, 'home (cached plots)',
+                                  timings(lambda: client.get('/'), args.repeat)))
+
+    with app.test_request_context('/'):
+      results.append(latency_result(size, 'common_page_data',
+                                    timings(views.common_page_data, args.repeat),
+                                    views.common_page_data))
+
+    def query():
+      dates, pressures = views.query_plot_window(views.PLOT_WINDOW)
+      peaks = views.query_daily_peaks(views.PEAK_WINDOW)
+      return dates, pressures, peaks[0], peaks[1]
+    results.append(latency_result(size, 'plot queries',
+                                  timings(query, args.repeat), query))
+    data = query()
+    render = lambda: views.generate_plots(*data)
+    results.append(latency_result(size, 'generate_plots',
+                                  timings(render, args.repeat), render))
+
+    fetch = lambda: data_fetch.record_new_reading(address)
+    results.append(latency_result(size, 'record_new_reading',
+                                  timings(fetch, args.repeat), fetch))
+
+    ingest_times = timings(lambda: data_fetch.record_readings(source.batch(INGEST_BATCH)),
+                           INGEST_BATCHES)
+    result = latency_result(size, f'record_readings ({INGEST_BATCH})', ingest_times,
+                            lambda: data_fetch.record_readings(source.batch(INGEST_BATCH)))
+    result['readings_per_s'] = INGEST_BATCH/float(np.median(ingest_times))
+    results.append(result)
+
+    db.session.remove()
+    db.get_engine(app).dispose()
+
+  # Peak resident memory of the whole process so far
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  for result in results:
+    result['max_rss_kib'] = max_rss
+  return results
+
+def print_results(results):
+  print(f"{'size':>10} {'benchmark':<26} {'p50 ms':>9} {'p99 ms':>9} "
+        f"{'peak MiB':>9} {'per s':>10}")
+  for r in results:
+    peak = r.get('peak_memory_bytes')
+    rate = r.get('readings_per_s')
+    print(f"{r['size']:>10} {r['benchmark']:<26} "
+          f"{r.get('p50_ms', r.get('seconds', 0)*1000):>9.2f} "
+          f"{r.get('p99_ms', 0):>9.2f} "
+          f"{peak/2**20 if peak else 0:>9.2f} "
+          f"{rate or 0:>10.0f}")
+
+def main():
+  arg_parser = argparse.ArgumentParser(
+    description="Benchmark the webhost against synthetic reading histories.")
+  arg_parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                          help="numbers of readings to seed the database with")
+  arg_parser.add_argument('--repeat', type=int, default=REPEAT,
+                          help="timed runs of each benchmark")
+  arg_parser.add_argument('--output', default=OUTPUT,
+                          help="file to write the results to, as JSON lines")
+  arg_parser.add_argument('--database-dir', default=DATABASE_DIR,
+                          help="where the seeded databases are kept")
+  arg_parser.add_argument('--source', default=None,
+                          help="URL of a Pi (or simulated Pi) to fetch from")
+  args = arg_parser.parse_args()
+
+  os.makedirs(args.database_dir, exist_ok=True)
+  results = []
+  for size in args.sizes:
+    print(f"Benchmarking with {size} readings...")
+    results += run_size(size, args)
+
+  with open(args.output, 'w') as output:
+    for r in results:
+      output.write(json.dumps(r) + '\n')
+  print_results(results)
+  print(f"Results written to {os.path.abspath(args.output)}")
+
+if __name__ == '__main__':
+  main()
@@ -1,19 +1,37 @@
 import atexit
-from website import create_app, create_scheduler
+from website import create_app, create_poller, create_retention_worker
 
 app = create_app()
 
-scheduler = create_scheduler(app)
-scheduler.start()
-print("scheduler started...")
+# The poller runs in this process, which also serves the live streams it
+# publishes to, so uwsgi runs a single process (see uwsgi-app.ini).
+def start_workers():
+  poller = create_poller(app)
+  poller.start()
+  print("poller started...")
+
+  retention = create_retention_worker(app)
+  retention.start()
+
+  # Shut down the poller when exiting the app
+  atexit.register(lambda: poller.stop())
+  atexit.register(lambda: retention.stop())
+
+# The workers only run when serving the site, under uwsgi or run directly
+# below. Anything else that imports the app, like `flask` commands, doesn't
+# start them.
+try:
+  import uwsgi
+except ImportError:
+  pass
+else:
+  start_workers()
 
 if __name__ == '__main__':
+  start_workers()
   # 0.0.0.0 host allows connections from everwhere
   # debug mode loads Flask app twice for some reason, and this
-  # causes issues with flask_apscheduler so, disable reloader.
+  # would start a second poller so, disable reloader.
   # https://stackoverflow.com/questions/9449101/how-to-stop-flask-from-initialising-twice-in-debug-mode
   # app.run(host='0.0.0.0', debug=True, use_reloader=False)
   app.run(debug=True, use_reloader=False)
-
-# Shut down the scheduler when exiting the app
-atexit.register(lambda: scheduler.shutdown())
@@ -0,0 +1,38 @@
+import os, sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from website import create_app, db, compression
+
+## An app with an empty database of its own, with an app context pushed
+@pytest.fixture
+def app(tmp_path):
+  app = create_app({'SECRET_KEY': 'test',
+                    'TESTING': True,
+                    'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path/'test.sqlite3'}"})
+  # The swinging doors belong to the process, not the database
+  compression.doors.clear()
+  with app.app_context():
+    yield app
+    db.session.remove()
+  compression.doors.clear()
+
+## A day of readings of the main sensor a minute apart, as dicts of
+## MonitorReading columns. The water is on for a few hours twice a day, with
+## a little noise on top.
+@pytest.fixture
+def readings():
+  start = datetime(2026, 3, 2)
+  rows = []
+  for i in range(24*60):
+    when = start + timedelta(minutes=i)
+    on = 4 <= when.hour < 8 or 20 <= when.hour < 22
+    pressure = (55 if on else 0.5) + 0.4*((i*7919) % 11 - 5)/5
+    rows.append({'datetime': when,
+                 'rawvalue': (pressure + 2.118)/0.004718,
+                 'voltage': 1.0,
+                 'pressure': pressure})
+  return rows
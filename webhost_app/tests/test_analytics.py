@@ -0,0 +1,32 @@
+from datetime import datetime, timedelta
+
+from website import db
+from website.models import HourlyRollup
+from website.data_fetch import record_readings
+from website.analytics import availability_heatmap, schedule_deviations, to_local
+
+def test_heatmap_only_counts_the_time_there_were_readings(app, readings):
+  # The monitor was down for the second half of an hour the water was on
+  hour = [row for row in readings if row['datetime'].hour == 5]
+  record_readings(hour[:30])
+  when = to_local(hour[0]['datetime'])
+  heatmap = availability_heatmap()
+  assert heatmap[when.weekday(), when.hour] == 1
+
+def test_heatmap_counts_older_rollups_as_a_whole_hour(app):
+  start = datetime(2026, 3, 2, 5)
+  db.session.add(HourlyRollup(start=start, count=2, minutes_on=30, minutes=None))
+  db.session.commit()
+  when = to_local(start)
+  assert availability_heatmap()[when.weekday(), when.hour] == 0.5
+
+def test_deviations_follow_the_schedule_given(app, readings):
+  # An hour the water was off but was supposed to be on
+  record_readings(readings[:60])
+  heatmap = availability_heatmap()
+  assert schedule_deviations(heatmap, {}) == []
+  when = to_local(readings[0]['datetime'])
+  schedule = {when.weekday(): [(when.hour, when.hour + 1)]}
+  assert schedule_deviations(heatmap, schedule) == [
+    {'weekday': when.strftime('%A'), 'hour': when.hour,
+     'expected': True, 'availability': 0.0}]
@@ -0,0 +1,56 @@
+import json
+
+from website import db
+from website.models import MonitorReading, HourlyRollup, DailyRollup, WaterInterval
+from website.data_fetch import record_readings
+from website.archive import export_archive, import_archive
+
+def table_rows() -> dict:
+  return {model: sorted(tuple(getattr(row, column.name)
+                              for column in model.__table__.columns
+                              # provisional is the swinging door's, not archived
+                              if column.name not in ('id', 'provisional'))
+                        for row in model.query)
+          for model in (MonitorReading, HourlyRollup, DailyRollup, WaterInterval)}
+
+def empty_database():
+  for model in (MonitorReading, HourlyRollup, DailyRollup, WaterInterval):
+    model.query.delete()
+  db.session.commit()
+
+def test_archive_round_trip(app, readings, tmp_path):
+  record_readings(readings)
+  before = table_rows()
+  # The rollups count readings that compression didn't keep
+  assert len(before[MonitorReading]) < len(readings)
+  assert sum(r.count for r in HourlyRollup.query) == len(readings)
+
+  export_archive(str(tmp_path/'archive'))
+  empty_database()
+  import_archive(str(tmp_path/'archive'))
+  assert table_rows() == before
+
+def test_compressed_archive_round_trip(app, readings, tmp_path):
+  record_readings(readings)
+  before = table_rows()
+
+  export_archive(str(tmp_path/'archive.npz'), compress=True)
+  empty_database()
+  import_archive(str(tmp_path/'archive.npz'))
+  assert table_rows() == before
+
+def test_readings_without_rollups_are_merged(app, readings, tmp_path):
+  record_readings(readings)
+  export_archive(str(tmp_path/'archive'))
+  empty_database()
+
+  # An archive from before the rollups were archived only has the readings
+  manifest = tmp_path/'archive'/'manifest.json'
+  info = json.loads(manifest.read_text())
+  for table in ('hourly_rollup', 'daily_rollup'):
+    del info['tables'][table]
+  manifest.write_text(json.dumps(info))
+
+  counts = import_archive(str(tmp_path/'archive'))
+  assert sum(r.count for r in HourlyRollup.query) == counts['monitor_reading']
+  assert sum(r.count for r in DailyRollup.query) == counts['monitor_reading']
@@ -0,0 +1,38 @@
+from datetime import timezone
+
+from website import data_fetch, DEFAULT_SENSOR_ID
+from website.models import MonitorReading, HourlyRollup
+from website.data_fetch import record_readings, catch_up_sensor, background_refresh
+
+## A Pi that recorded `readings` and serves them from /history
+def fake_pi(monkeypatch, readings):
+  def fetch_json(address, params=None):
+    assert address.endswith('/history')
+    times = [row['datetime'].replace(tzinfo=timezone.utc).timestamp()
+             for row in readings]
+    sent = [(when, row) for when, row in zip(times, readings)
+            if when > params['since']][:params['limit']]
+    return {'readings': [[row['datetime'].strftime('%Y-%m-%d %H:%M:%S UTC'),
+                          row['rawvalue'], row['voltage'], row['pressure'], 0]
+                         for when, row in sent],
+            'since': sent[-1][0] if sent else params['since']}
+  monkeypatch.setattr(data_fetch, 'fetch_json', fetch_json)
+
+def test_catch_up_fetches_everything_since_the_newest_reading(app, readings, monkeypatch):
+  record_readings(readings[:100])
+  fake_pi(monkeypatch, readings)
+  monkeypatch.setattr(data_fetch, 'HISTORY_BATCH_SIZE', 300)
+  assert catch_up_sensor() == len(readings) - 100
+  assert sum(r.count for r in HourlyRollup.query) == len(readings)
+  assert catch_up_sensor() == 0
+
+def test_refresh_picks_up_an_outage(app, readings, monkeypatch):
+  # The Pi kept recording while it couldn't be reached
+  record_readings(readings[:100])
+  fake_pi(monkeypatch, readings)
+  data_fetch.refresh_lock.acquire()
+  background_refresh(app, DEFAULT_SENSOR_ID)
+  assert not data_fetch.refresh_lock.locked()
+  assert sum(r.count for r in HourlyRollup.query) == len(readings)
+  newest = MonitorReading.query.order_by(MonitorReading.datetime.desc()).first()
+  assert newest.datetime == readings[-1]['datetime']
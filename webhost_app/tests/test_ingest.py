@@ -0,0 +1,70 @@
+from website import db
+from website.models import MonitorReading, HourlyRollup, DailyRollup, WaterInterval
+from website.data_fetch import record_readings
+from website.rollups import aggregate, rebuild_rollups
+from website.analytics import rebuild_intervals
+
+def summaries() -> tuple:
+  rollups = [sorted((r.start, r.count, r.min_pressure, r.max_pressure,
+                     round(r.mean_pressure, 9), round(r.minutes_on, 9),
+                     round(r.minutes, 9))
+                    for r in model.query)
+             for model in (HourlyRollup, DailyRollup)]
+  intervals = sorted((i.start, i.end, i.on) for i in WaterInterval.query)
+  return rollups[0], rollups[1], intervals
+
+def record_in_batches(rows, size: int) -> int:
+  return sum(record_readings(rows[i:i + size]) for i in range(0, len(rows), size))
+
+def test_rollups_count_every_reading(app, readings):
+  assert record_in_batches(readings, 7) == len(readings)
+  # Most readings are compressed away, but the rollups still have them all
+  assert MonitorReading.query.count() < len(readings)/10
+  expected = aggregate([(row['datetime'], row['pressure']) for row in readings])
+  hourly, daily, intervals = summaries()
+  for model, stored in ((HourlyRollup, hourly), (DailyRollup, daily)):
+    assert stored == sorted((r.start, r.count, r.min_pressure, r.max_pressure,
+                             round(r.mean_pressure, 9), round(r.minutes_on, 9),
+                             round(r.minutes, 9))
+                            for r in expected[model].values())
+  assert [on for start, end, on in intervals] == [False, True, False, True, False]
+
+def test_reingesting_readings_changes_nothing(app, readings):
+  record_in_batches(readings, 60)
+  before = summaries()
+  stored = MonitorReading.query.count()
+
+  # A retried catch up sends readings that were received already
+  assert record_readings(readings) == 0
+  assert record_in_batches(readings[100:400], 60) == 0
+  assert summaries() == before
+  assert MonitorReading.query.count() == stored
+
+def test_batch_repeats_are_dropped(app, readings):
+  assert record_readings(readings[:10] + readings[5:15]) == 15
+  assert sum(r.count for r in HourlyRollup.query) == 15
+
+def test_rebuilds_leave_stored_summaries_alone(app, readings):
+  record_readings(readings)
+  before = summaries()
+  assert rebuild_rollups() == (0, 0)
+  assert rebuild_intervals() == len(before[2])
+  assert summaries() == before
+
+def test_rebuilds_fill_in_missing_summaries(app, readings):
+  record_readings(readings)
+  hourly, daily, intervals = summaries()
+  HourlyRollup.query.filter(HourlyRollup.start >= hourly[12][0]).delete()
+  WaterInterval.query.filter(WaterInterval.start > intervals[0][0]).delete()
+  db.session.commit()
+
+  # Only the hours with a reading compression kept come back
+  hours, days = rebuild_rollups()
+  assert 0 < hours <= 12 and days == 0
+  rebuilt = summaries()
+  assert rebuilt[0][:12] == hourly[:12]
+  assert len(rebuilt[0]) == 12 + hours
+  assert rebuilt[1] == daily
+
+  rebuild_intervals()
+  assert [on for start, end, on in summaries()[2]] == [on for start, end, on in intervals]
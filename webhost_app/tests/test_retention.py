@@ -0,0 +1,18 @@
+from datetime import datetime, timedelta
+
+from website import db, DEFAULT_SENSOR_ID
+from website.models import MonitorReading, Sensor
+from website.retention import apply_retention, RAW_RETENTION_DAYS
+
+def test_only_readings_of_the_main_sensor_expire(app):
+  db.session.add(Sensor(id=2, name='Tank', url='http://tank-pi', channel=0))
+  now = datetime.utcnow()
+  for days in (1, RAW_RETENTION_DAYS + 1):
+    for sensor_id in (DEFAULT_SENSOR_ID, 2):
+      db.session.add(MonitorReading(sensor_id=sensor_id, pressure=50,
+                                    datetime=now - timedelta(days=days)))
+  db.session.commit()
+
+  assert apply_retention(now)['readings'] == 1
+  assert MonitorReading.query.filter_by(sensor_id=DEFAULT_SENSOR_ID).count() == 1
+  assert MonitorReading.query.filter_by(sensor_id=2).count() == 2
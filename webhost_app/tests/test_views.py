@@ -0,0 +1,18 @@
+from datetime import datetime, timedelta
+
+from website import db
+from website.models import MonitorReading
+from website.views import common_page_data, query_plot_window
+
+def test_readings_without_a_pressure_are_skipped(app):
+  now = datetime.utcnow()
+  db.session.add(MonitorReading(datetime=now - timedelta(minutes=2), pressure=50))
+  db.session.add(MonitorReading(datetime=now - timedelta(minutes=1), pressure=None))
+  db.session.commit()
+
+  with app.test_request_context():
+    data = common_page_data()
+  assert data.printable_pressure == "50.00"
+  assert data.on_now
+  dates, pressures = query_plot_window(timedelta(hours=1))
+  assert pressures == [50]
@@ -1,20 +1,45 @@
+import sqlite3
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_apscheduler import APScheduler
 from os import path
 from flask_login import LoginManager
+from sqlalchemy import inspect, event
+from sqlalchemy.engine import Engine
 
 db = SQLAlchemy()
 DB_NAME = "database/site_db.sqlite3"
 READING_DELTA = 15 #minutes
+MIN_PRESSURE_FOR_ON = 30 #psi
+DEFAULT_SENSOR_ID = 1 # the main water supply. See sensors.py
 
-def create_app():
+## Settings for every connection to the SQLite database:
+##  - Incremental auto vacuum lets old readings be deleted without the file
+##    staying the same size (see retention.py). It only takes on a new
+##    database, before anything else is written to it, so it goes first.
+##  - The write-ahead log lets the pages read (a long export, say) while the
+##    poller writes new readings, where otherwise each would wait for the
+##    other. The log is kept next to the database, as site_db.sqlite3-wal.
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(connection, connection_record):
+  if isinstance(connection, sqlite3.Connection):
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.close()
+
+## `config` overrides the default settings, for example to point the app at a
+## different database (see benchmark.py).
+def create_app(config: dict = None):
 
   # General App Setup
   app = Flask(__name__)
-  app.config.from_pyfile('.env.py')
+  # The secret key is kept out of the repository in .env.py (see
+  # .env.py.example). Tests pass their own.
+  app.config.from_pyfile('.env.py', silent='SECRET_KEY' in (config or {}))
   app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_NAME}'
   app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False #Suppress Deprecation Warning
+  if config:
+    app.config.update(config)
   db.init_app(app)
 
   # Setup the site Blueprints
@@ -25,9 +50,27 @@ def create_app():
   app.register_blueprint(auth, url_prefix='/')
 
   # Setup the site databse
-  from .models import User, CalibrationReading, MonitorReading
+  from .models import User, CalibrationReading, MonitorReading, Sensor
+  from .models import HourlyRollup, DailyRollup, WaterInterval
   create_database(app)
 
+  # Setup the command line tools (run with `flask <command>`)
+  from .rollups import rebuild_rollups_command
+  from .analytics import rebuild_intervals_command
+  from .sensors import add_sensor_command, list_sensors_command
+  from .retention import apply_retention_command
+  from .archive import export_archive_command, import_archive_command
+  from .archive import import_calibration_command, export_calibration_command
+  app.cli.add_command(rebuild_rollups_command)
+  app.cli.add_command(rebuild_intervals_command)
+  app.cli.add_command(add_sensor_command)
+  app.cli.add_command(list_sensors_command)
+  app.cli.add_command(apply_retention_command)
+  app.cli.add_command(export_archive_command)
+  app.cli.add_command(import_archive_command)
+  app.cli.add_command(import_calibration_command)
+  app.cli.add_command(export_calibration_command)
+
   # Setup the Login Manager
   login_manager = LoginManager()
   login_manager.login_view = 'auth.login'
@@ -39,18 +82,54 @@ def create_app():
 
   return app
 
-def create_scheduler(app):
-  from .data_fetch import cron_reading
-  scheduler = APScheduler()
-  scheduler.add_job(id='Scheduled Task',
-                    func=cron_reading,
-                    kwargs={'app':app},
-                    trigger="interval",
-                    minutes=READING_DELTA)
-  return scheduler
+## The poller fetches new readings from every registered Pi in the background.
+## It is kept in app.extensions so pages can report on it. See poller.py
+def create_poller(app):
+  from .poller import Poller
+  poller = Poller(app)
+  app.extensions['poller'] = poller
+  return poller
+
+## Deletes old readings in the background. See retention.py
+def create_retention_worker(app):
+  from .retention import RetentionWorker
+  worker = RetentionWorker(app)
+  app.extensions['retention'] = worker
+  return worker
 
 def create_database(app):
   if not path.exists('website/' + DB_NAME):
     db.create_all(app=app)
     # TODO Inject fake data if creatng new?
     print("Created Database!")
+  else:
+    # Add any tables that are missing from databases created by an older
+    # version. create_all() only builds indexes along with new tables, so make
+    # sure databases created before an index was added get it as well.
+    db.create_all(app=app)
+    from .models import MonitorReading, HourlyRollup, DailyRollup
+    with app.app_context():
+      # Readings recorded before there were several sensors are all from the
+      # main one.
+      columns = inspect(db.engine).get_columns('monitor_reading')
+      columns = [column['name'] for column in columns]
+      if 'sensor_id' not in columns:
+        db.engine.execute("ALTER TABLE monitor_reading ADD COLUMN sensor_id "
+                          f"INTEGER NOT NULL DEFAULT {DEFAULT_SENSOR_ID} "
+                          "REFERENCES sensor (id)")
+      if 'provisional' not in columns:
+        db.engine.execute("ALTER TABLE monitor_reading ADD COLUMN provisional "
+                          "BOOLEAN NOT NULL DEFAULT 0")
+      for index in MonitorReading.__table__.indexes:
+        index.create(bind=db.engine, checkfirst=True)
+      # Rollups built before the time they cover was kept have it as NULL (see
+      # analytics.availability_heatmap()).
+      for model in (HourlyRollup, DailyRollup):
+        columns = inspect(db.engine).get_columns(model.__tablename__)
+        if 'minutes' not in [column['name'] for column in columns]:
+          db.engine.execute(f"ALTER TABLE {model.__tablename__} "
+                            "ADD COLUMN minutes FLOAT")
+
+  from .sensors import register_default_sensor
+  with app.app_context():
+    register_default_sensor()
@@ -0,0 +1,244 @@
+from datetime import datetime
+from itertools import islice
+from dateutil import tz
+import numpy as np
+import click
+from flask.cli import with_appcontext
+
+from . import db, MIN_PRESSURE_FOR_ON, DEFAULT_SENSOR_ID
+from .models import MonitorReading, HourlyRollup, WaterInterval
+from .rollups import ROLLUP_TIMEZONE, naive_utc
+
+## Analysis of when the water is actually available.
+## The readings are turned into on/off intervals (kept in the WaterInterval
+## table and extended as readings come in) and the hourly rollups are folded
+## into availability per weekday and hour of the day. From those come the
+## outage durations and how far the supply strays from the published schedule.
+
+## GLOBALS
+# The water has to rise above MIN_PRESSURE_FOR_ON + HYSTERESIS to count as
+# turned on, and drop below MIN_PRESSURE_FOR_ON - HYSTERESIS to count as
+# turned off, so noise around the threshold doesn't flip it back and forth.
+HYSTERESIS = 2 # psi
+ON_PRESSURE = MIN_PRESSURE_FOR_ON + HYSTERESIS
+OFF_PRESSURE = MIN_PRESSURE_FOR_ON - HYSTERESIS
+# An hour is reported as deviating from the schedule when the share of the
+# time the water was on differs from the schedule by more than this.
+DEVIATION_THRESHOLD = 0.5
+ROW_CHUNK = 10000 # rows read from the database at a time
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+            'Saturday', 'Sunday']
+
+##------------------------------------------------------------------------------
+## On (1) or off (0) for each pressure, with hysteresis. Pressures between the
+## two thresholds keep the state of the reading before them. `initial` is the
+## state going into the first reading (None if unknown, in which case the
+## plain MIN_PRESSURE_FOR_ON threshold decides until the state is known).
+def hysteresis_states(pressures, initial: bool = None) -> np.ndarray:
+  pressures = np.asarray(pressures, dtype=float)
+  states = np.full(pressures.shape, -1, dtype=np.int8)
+  states[pressures > ON_PRESSURE] = 1
+  states[pressures < OFF_PRESSURE] = 0
+
+  # Carry the last decided state forward over the undecided readings
+  decided = np.where(states >= 0, np.arange(len(states)), -1)
+  np.maximum.accumulate(decided, out=decided)
+  filled = states[np.maximum(decided, 0)]
+  if initial is None:
+    fallback = (pressures > MIN_PRESSURE_FOR_ON).astype(np.int8)
+  else:
+    fallback = np.full(pressures.shape, int(initial), dtype=np.int8)
+  return np.where(decided >= 0, filled, fallback)
+
+##------------------------------------------------------------------------------
+## Split sorted readings into stretches of the same state. Returns a list of
+## (start, end, on) with the times of the first and last reading of each.
+def find_intervals(dates, pressures, initial: bool = None) -> list:
+  if len(dates) == 0:
+    return []
+  states = hysteresis_states(pressures, initial)
+  starts = np.concatenate(([0], np.flatnonzero(np.diff(states)) + 1))
+  ends = np.concatenate((starts[1:] - 1, [len(states) - 1]))
+  return [(dates[s], dates[e], bool(states[s])) for s, e in zip(starts, ends)]
+
+##------------------------------------------------------------------------------
+## Extend the stored intervals with a batch of (datetime, pressure) readings,
+## sorted oldest first. Readings from before the end of the last interval (a
+## backfill that overlaps it) are left out, since the intervals already cover
+## that time. This does not commit. The caller commits along with the readings.
+def update_intervals(rows):
+  last = WaterInterval.query.order_by(WaterInterval.start.desc()).first()
+  dates = [naive_utc(when) for when, pressure in rows]
+  pressures = [pressure for when, pressure in rows]
+  if last is not None:
+    keep = [i for i, when in enumerate(dates) if when > last.end]
+    dates = [dates[i] for i in keep]
+    pressures = [pressures[i] for i in keep]
+  if not dates:
+    return
+
+  intervals = find_intervals(dates, pressures, last.on if last else None)
+  if last is not None and intervals[0][2] == last.on:
+    # Still in the same state, so the last interval just gets longer
+    last.end = intervals.pop(0)[1]
+  db.session.add_all(WaterInterval(start=start, end=end, on=on)
+                     for start, end, on in intervals)
+
+##------------------------------------------------------------------------------
+## Work out the intervals missing from the readings in the database: those
+## from before the first interval stored (readings recorded before there were
+## intervals) and after the last one. The stored intervals are left as they
+## are, since the readings they were found from may have been dropped by
+## compression or deleted by retention (see retention.py) since.
+## The readings are read and added ROW_CHUNK at a time, so this takes the same
+## memory however many there are. Returns the number of intervals there are.
+def rebuild_intervals() -> int:
+  first = WaterInterval.query.order_by(WaterInterval.start).first()
+  last = WaterInterval.query.order_by(WaterInterval.start.desc()).first()
+  if first is not None:
+    earlier = []
+    for chunk in reading_chunks(MonitorReading.datetime < first.start):
+      intervals = find_intervals([naive_utc(when) for when, pressure in chunk],
+                                 [pressure for when, pressure in chunk],
+                                 earlier[-1][2] if earlier else None)
+      if earlier and intervals[0][2] == earlier[-1][2]:
+        start, end, on = earlier.pop()
+        intervals[0] = (start, intervals[0][1], on)
+      earlier.extend(intervals)
+    if earlier and earlier[-1][2] == first.on:
+      first.start = earlier.pop()[0]
+    db.session.add_all(WaterInterval(start=start, end=end, on=on)
+                       for start, end, on in earlier)
+    db.session.flush()
+
+  later = reading_chunks(MonitorReading.datetime > last.end) if last is not None\
+          else reading_chunks()
+  for chunk in later:
+    update_intervals(chunk)
+    db.session.flush()
+  db.session.commit()
+  return WaterInterval.query.count()
+
+# The (datetime, pressure) readings of the main sensor matching the criteria,
+# oldest first, in lists of ROW_CHUNK
+def reading_chunks(*criteria):
+  rows = db.session.query(MonitorReading.datetime, MonitorReading.pressure)\
+                   .filter(MonitorReading.sensor_id == DEFAULT_SENSOR_ID)\
+                   .filter(MonitorReading.pressure.isnot(None))\
+                   .filter(*criteria)\
+                   .order_by(MonitorReading.datetime)\
+                   .yield_per(ROW_CHUNK)
+  rows = iter(rows)
+  while True:
+    chunk = list(islice(rows, ROW_CHUNK))
+    if not chunk:
+      return
+    yield chunk
+
+@click.command('rebuild-intervals')
+@with_appcontext
+def rebuild_intervals_command():
+  """Work out the on/off intervals missing over the recorded readings."""
+  count = rebuild_intervals()
+  click.echo(f"There are now {count} on/off intervals.")
+
+##------------------------------------------------------------------------------
+## Share of the time the water was on for each local weekday (rows, Monday
+## first) and hour of the day (columns), from the hourly rollups between start
+## and end (naive UTC, either may be None). The share is of the time there
+## were readings for, so hours the monitor was down for don't count as off.
+## Rollups from before that time was kept count as a whole hour. Hours without
+## readings are NaN.
+def availability_heatmap(start: datetime = None, end: datetime = None) -> np.ndarray:
+  query = db.session.query(HourlyRollup.start, HourlyRollup.minutes_on,
+                           HourlyRollup.minutes)
+  if start is not None:
+    query = query.filter(HourlyRollup.start >= start)
+  if end is not None:
+    query = query.filter(HourlyRollup.start <= end)
+  rows = iter(query.yield_per(ROW_CHUNK))
+
+  minutes_on = np.zeros((7, 24))
+  minutes_seen = np.zeros((7, 24))
+  while True:
+    chunk = list(islice(rows, ROW_CHUNK))
+    if not chunk:
+      break
+    local = [to_local(row.start) for row in chunk]
+    weekdays = np.array([when.weekday() for when in local])
+    hours = np.array([when.hour for when in local])
+    np.add.at(minutes_on, (weekdays, hours),
+              np.array([row.minutes_on for row in chunk], dtype=float))
+    np.add.at(minutes_seen, (weekdays, hours),
+              np.array([60 if row.minutes is None else row.minutes
+                        for row in chunk], dtype=float))
+
+  with np.errstate(invalid='ignore', divide='ignore'):
+    return np.clip(minutes_on / minutes_seen, 0, 1)
+
+##------------------------------------------------------------------------------
+## Summary of how long the water was off for, over the outages that started
+## between start and end (naive UTC, either may be None). An outage lasts
+## until the water comes back on, or until the last reading if it hasn't yet.
+## Durations are in hours.
+def outage_report(start: datetime = None, end: datetime = None) -> dict:
+  query = WaterInterval.query
+  if start is not None:
+    query = query.filter(WaterInterval.start >= start)
+  if end is not None:
+    query = query.filter(WaterInterval.start <= end)
+  intervals = query.order_by(WaterInterval.start).all()
+  if not intervals:
+    return {'count': 0}
+
+  starts = np.array([i.start for i in intervals], dtype='datetime64[s]')
+  ends = np.array([i.end for i in intervals], dtype='datetime64[s]')
+  off = np.array([not i.on for i in intervals])
+  # Each interval lasts until the next one starts
+  until = np.concatenate((starts[1:], ends[-1:]))
+  durations = (until - starts)[off].astype(float) / 3600
+  if len(durations) == 0:
+    return {'count': 0}
+
+  longest = int(np.argmax(durations))
+  return {
+    'count': len(durations),
+    'total_hours': float(durations.sum()),
+    'mean_hours': float(durations.mean()),
+    'median_hours': float(np.median(durations)),
+    'p90_hours': float(np.percentile(durations, 90)),
+    'longest_hours': float(durations[longest]),
+    'longest_start': str(starts[off][longest]),
+  }
+
+##------------------------------------------------------------------------------
+## The weekday hours where what actually happened differs from the schedule
+## by more than DEVIATION_THRESHOLD. The schedule is the hours the water is
+## supposed to be on, in local time, by weekday (Monday is 0), for example
+## {0: [(4, 8)], 3: [(4, 8), (20, 22)]}. The site's comes from EXPECTED_SCHEDULE
+## in .env.py. Empty without a schedule.
+def schedule_deviations(heatmap: np.ndarray, schedule: dict) -> list:
+  if not schedule:
+    # Nothing to compare against
+    return []
+  expected = expected_heatmap(schedule)
+  deviation = heatmap - expected
+  flagged = np.argwhere(np.abs(deviation) > DEVIATION_THRESHOLD)
+  return [{'weekday': WEEKDAYS[day],
+           'hour': int(hour),
+           'expected': bool(expected[day, hour]),
+           'availability': float(heatmap[day, hour])}
+          for day, hour in flagged]
+
+# A schedule as a 7x24 array of 1 (on) and 0 (off)
+def expected_heatmap(schedule: dict) -> np.ndarray:
+  expected = np.zeros((7, 24))
+  for day, hours in schedule.items():
+    day = int(day)
+    for first, last in hours:
+      expected[day, first:last] = 1
+  return expected
+
+# Rollups are stored in naive UTC
+def to_local(when: datetime) -> datetime:
+  return when.replace(tzinfo=tz.tzutc()).astimezone(ROLLUP_TIMEZONE)
@@ -0,0 +1,360 @@
+import csv, json
+from datetime import datetime
+from itertools import groupby
+from os import path, makedirs
+
+import click
+import numpy as np
+from dateutil import parser, tz
+from flask.cli import with_appcontext
+
+from . import db, DEFAULT_SENSOR_ID
+from .models import MonitorReading, CalibrationReading, Sensor,\
+                    HourlyRollup, DailyRollup, WaterInterval
+from .rollups import ROLLUPS, ROLLUP_TIMEZONE, merge_rollups
+from .analytics import update_intervals
+
+## Columnar archives of the recorded readings.
+## An archive holds every column of the MonitorReading and CalibrationReading
+## tables as its own NumPy array, along with a manifest.json that describes
+## them (and the sensor registry the readings refer to). The rollups and on/off
+## intervals are archived too, since they keep the history of readings that
+## have been deleted (see retention.py). An archive is either:
+##  - a directory of .npy files, one per column, which np.load() can memory
+##    map so years of readings are read straight from the file as needed, or
+##  - a single compressed .npz file, which is smaller but has to be read in.
+## load_archive() reads either one for offline analysis:
+##   readings = load_archive('archive')['monitor_reading']
+##   readings['pressure'].mean()
+## Missing values are NaN. Times are naive UTC datetime64[us].
+
+## GLOBALS
+ARCHIVE_FORMAT = 1
+ARCHIVE_TABLES = {
+  'monitor_reading': (MonitorReading, {'sensor_id': 'int32',
+                                       'datetime': 'datetime64[us]',
+                                       'rawvalue': 'float64',
+                                       'voltage': 'float64',
+                                       'pressure': 'float64'}),
+  'calibration_reading': (CalibrationReading, {'datetime': 'datetime64[us]',
+                                               'rawvalue': 'float64',
+                                               'voltage': 'float64',
+                                               'pressure': 'float64'}),
+  'hourly_rollup': (HourlyRollup, {'start': 'datetime64[us]',
+                                   'count': 'int64',
+                                   'min_pressure': 'float64',
+                                   'max_pressure': 'float64',
+                                   'mean_pressure': 'float64',
+                                   'minutes_on': 'float64',
+                                   'minutes': 'float64'}),
+  'daily_rollup': (DailyRollup, {'start': 'datetime64[us]',
+                                 'count': 'int64',
+                                 'min_pressure': 'float64',
+                                 'max_pressure': 'float64',
+                                 'mean_pressure': 'float64',
+                                 'minutes_on': 'float64',
+                                 'minutes': 'float64'}),
+  'water_interval': (WaterInterval, {'start': 'datetime64[us]',
+                                     'end': 'datetime64[us]',
+                                     'on': 'bool'}),
+}
+# Tables that summarise the readings, restored as they are rather than worked
+# out again from the (compressed) readings
+SUMMARY_TABLES = ('hourly_rollup', 'daily_rollup', 'water_interval')
+ARCHIVE_CHUNK = 50000 # rows read or written at a time
+
+##------------------------------------------------------------------------------
+## Export
+
+## Write every row of the archived tables to `destination`, a directory of
+## .npy files or (with compress) a .npz file. Returns the number of rows of
+## each table.
+def export_archive(destination: str, compress: bool = False) -> dict:
+  manifest = {'format': ARCHIVE_FORMAT,
+              'exported': datetime.utcnow().isoformat() + 'Z',
+              'sensors': [{'id': s.id, 'name': s.name, 'url': s.url,
+                           'channel': s.channel}
+                          for s in Sensor.query.order_by(Sensor.id)],
+              'tables': {}}
+  if not compress:
+    makedirs(destination, exist_ok=True)
+
+  arrays = {}
+  for table, (model, columns) in ARCHIVE_TABLES.items():
+    count = model.query.count()
+    manifest['tables'][table] = {'rows': count, 'columns': columns}
+    for column, dtype in columns.items():
+      if compress:
+        array = np.empty(count, dtype=dtype)
+      else:
+        # Written straight into the file so the table never has to fit in memory
+        array = np.lib.format.open_memmap(column_file(destination, table, column),
+                                          mode='w+', dtype=dtype, shape=(count,))
+      arrays[f"{table}.{column}"] = array
+    fill_columns(model, columns, count,
+                 {column: arrays[f"{table}.{column}"] for column in columns})
+
+  if compress:
+    arrays['manifest'] = np.array(json.dumps(manifest))
+    np.savez_compressed(destination, **arrays)
+  else:
+    for array in arrays.values():
+      array.flush()
+    with open(path.join(destination, 'manifest.json'), 'w') as file:
+      json.dump(manifest, file, indent=2)
+  return {table: info['rows'] for table, info in manifest['tables'].items()}
+
+# Copy the columns of `count` rows of model, in id order, into the arrays
+def fill_columns(model, columns, count, arrays):
+  fields = [getattr(model, column) for column in columns]
+  rows = db.session.query(*fields).order_by(model.id).yield_per(ARCHIVE_CHUNK)
+  position = 0
+  chunk = []
+  for row in rows:
+    if position + len(chunk) >= count:
+      break # rows added since counting are left for the next export
+    chunk.append(row)
+    if len(chunk) == ARCHIVE_CHUNK:
+      position = store_chunk(chunk, columns, arrays, position)
+      chunk = []
+  store_chunk(chunk, columns, arrays, position)
+
+def store_chunk(chunk, columns, arrays, position) -> int:
+  end = position + len(chunk)
+  for i, (column, dtype) in enumerate(columns.items()):
+    values = [row[i] for row in chunk]
+    if dtype.startswith('float'):
+      values = [np.nan if value is None else value for value in values]
+    elif dtype.startswith('datetime'):
+      values = [np.datetime64('NaT') if value is None
+                else np.datetime64(value.replace(tzinfo=None), 'us')
+                for value in values]
+    arrays[column][position:end] = np.array(values, dtype=dtype)
+  return end
+
+def column_file(directory: str, table: str, column: str) -> str:
+  return path.join(directory, f"{table}.{column}.npy")
+
+@click.command('export-archive')
+@click.argument('destination')
+@click.option('--compress', is_flag=True,
+              help="Write one compressed .npz file instead of a directory of "
+                   "memory mappable .npy files.")
+@with_appcontext
+def export_archive_command(destination, compress):
+  """Export all readings and summaries to a columnar archive at DESTINATION."""
+  counts = export_archive(destination, compress)
+  click.echo(f"Exported {counts['monitor_reading']} readings and "
+             f"{counts['calibration_reading']} calibration readings.")
+
+##------------------------------------------------------------------------------
+## Import
+
+## Read an archive made by export_archive(). Returns the manifest and
+## {table: {column: array}}. The arrays of a directory archive are memory
+## mapped (read only) unless mmap is False.
+def load_archive(source: str, mmap: bool = True):
+  if path.isdir(source):
+    with open(path.join(source, 'manifest.json')) as file:
+      manifest = json.load(file)
+    mode = 'r' if mmap else None
+    tables = {table: {column: np.load(column_file(source, table, column),
+                                      mmap_mode=mode)
+                      for column in info['columns']}
+              for table, info in manifest['tables'].items()}
+  else:
+    with np.load(source) as archive:
+      manifest = json.loads(str(archive['manifest']))
+      tables = {table: {column: archive[f"{table}.{column}"]
+                        for column in info['columns']}
+                for table, info in manifest['tables'].items()}
+  if manifest.get('format') != ARCHIVE_FORMAT:
+    raise ValueError(f"Unknown archive format: {manifest.get('format')}")
+  return manifest, tables
+
+## Bulk load an archive into the database. The readings go in with one
+## executemany per chunk, all in one transaction. The archived rollups and
+## intervals are restored as they are, since they were built from every
+## reading and the archived readings are only the ones compression kept.
+## Where the database has a rollup or intervals of its own for the same time,
+## those are kept instead. Only the readings the archive has no rollup for are
+## added to the rollups, and the intervals are only extended past the last one
+## stored, like readings coming in from the Pi.
+## Returns the number of rows of each table.
+def import_archive(source: str) -> dict:
+  manifest, tables = load_archive(source)
+
+  for sensor in manifest['sensors']:
+    if Sensor.query.get(sensor['id']) is None:
+      db.session.add(Sensor(**sensor))
+  db.session.flush()
+
+  readings = tables.get('monitor_reading')
+  order = main_readings(readings) if readings else np.array([], dtype=int)
+  first = readings['datetime'][order[0]].astype('datetime64[us]').item()\
+          if len(order) else None
+
+  counts = {}
+  covered = {}
+  for table in SUMMARY_TABLES:
+    if table in tables:
+      counts[table] = import_summaries(table, tables[table])
+      model = ARCHIVE_TABLES[table][0]
+      if model in ROLLUPS:
+        starts = tables[table]['start']
+        covered[model] = set(starts[~np.isnat(starts)].astype('datetime64[us]').tolist())
+  for table, columns in tables.items():
+    if table not in ARCHIVE_TABLES or table in SUMMARY_TABLES:
+      continue
+    model = ARCHIVE_TABLES[table][0]
+    count = len(next(iter(columns.values()), []))
+    for start in range(0, count, ARCHIVE_CHUNK):
+      rows = archive_rows(columns, start, start + ARCHIVE_CHUNK)
+      db.session.execute(model.__table__.insert(), rows)
+    counts[table] = count
+
+  if len(order):
+    merge_readings(readings, order, first, covered)
+  db.session.commit()
+  return counts
+
+# Indexes of the readings of the main sensor with a pressure, oldest first
+def main_readings(columns) -> np.ndarray:
+  dates = columns['datetime']
+  keep = (columns['sensor_id'] == DEFAULT_SENSOR_ID)\
+         & ~np.isnan(columns['pressure']) & ~np.isnat(dates)
+  order = np.flatnonzero(keep)
+  return order[np.argsort(dates[order], kind='stable')]
+
+# Add the archived rows of a summary table that don't overlap the database's
+# own: the rollups of buckets it has no rollup of, and the intervals from
+# before or after the ones it has. Returns the number of rows added.
+def import_summaries(table, columns) -> int:
+  model = ARCHIVE_TABLES[table][0]
+  starts = columns['start']
+  keep = ~np.isnat(starts)
+  if model in ROLLUPS:
+    stored = [row.start for row in db.session.query(model.start)]
+    keep &= ~np.isin(starts, np.array(stored, dtype='datetime64[us]'))
+  else:
+    first, last = db.session.query(db.func.min(model.start),
+                                   db.func.max(model.end)).one()
+    if first is not None:
+      keep &= (columns['end'] <= np.datetime64(first, 'us'))\
+              | (starts >= np.datetime64(last, 'us'))
+  kept = np.flatnonzero(keep)
+  for start in range(0, len(kept), ARCHIVE_CHUNK):
+    chunk = kept[start:start + ARCHIVE_CHUNK]
+    rows = archive_rows({column: array[chunk] for column, array in columns.items()},
+                        0, len(chunk))
+    db.session.execute(model.__table__.insert(), rows)
+  return len(kept)
+
+# Add the imported readings at `order` to the rollups and intervals, a chunk
+# at a time, leaving out the buckets in `covered` ({model: starts}) that the
+# archive has rollups of. This does not commit.
+def merge_readings(columns, order, first: datetime, covered: dict):
+  previous = db.session.query(MonitorReading.datetime)\
+                       .filter(MonitorReading.sensor_id == DEFAULT_SENSOR_ID)\
+                       .filter(MonitorReading.datetime < first)\
+                       .order_by(MonitorReading.datetime.desc())\
+                       .first()
+  previous = previous.datetime if previous else None
+  for start in range(0, len(order), ARCHIVE_CHUNK):
+    chunk = order[start:start + ARCHIVE_CHUNK]
+    rows = list(zip(columns['datetime'][chunk].astype('datetime64[us]').tolist(),
+                    columns['pressure'][chunk].tolist()))
+    merge_rollups(rows, previous, covered)
+    update_intervals(rows)
+    db.session.flush()
+    previous = rows[-1][0]
+
+# Rows start to end of the column arrays as dicts, with NaN/NaT as None
+def archive_rows(columns, start, end) -> list:
+  values = {}
+  for column, array in columns.items():
+    chunk = array[start:end]
+    if chunk.dtype.kind == 'M':
+      # NaT comes out as None
+      values[column] = chunk.astype('datetime64[us]').tolist()
+    elif chunk.dtype.kind == 'f':
+      values[column] = [None if value != value else value for value in chunk.tolist()]
+    else:
+      values[column] = chunk.tolist()
+  names = list(values)
+  return [dict(zip(names, row)) for row in zip(*values.values())]
+
+@click.command('import-archive')
+@click.argument('source')
+@click.option('--append', is_flag=True,
+              help="Import even though the database already has readings. "
+                   "Rollups and on/off intervals the database has for the "
+                   "same time are kept instead of the archived ones.")
+@with_appcontext
+def import_archive_command(source, append):
+  """Load a columnar archive made by export-archive from SOURCE."""
+  if MonitorReading.query.first() is not None and not append:
+    raise click.ClickException("The database already has readings. "
+                               "Use --append to import anyway.")
+  counts = import_archive(source)
+  click.echo(f"Imported {counts.get('monitor_reading', 0)} readings and "
+             f"{counts.get('calibration_reading', 0)} calibration readings.")
+
+##------------------------------------------------------------------------------
+## Load the <psi>.csv files written by pi_app/take_reading.py into the
+## CalibrationReading table. The pressure is the one read from the gauge.
+## take_reading.py writes the local time of the Pi, which is taken to be
+## ROLLUP_TIMEZONE. Returns the number of readings loaded.
+def import_calibration_csv(filenames) -> int:
+  rows = []
+  for filename in filenames:
+    with open(filename, newline='', encoding='utf-8') as file:
+      for record in csv.DictReader(file):
+        local = parser.parse(record['Timestamp']).replace(tzinfo=ROLLUP_TIMEZONE)
+        rows.append({
+          'datetime': local.astimezone(tz.tzutc()).replace(tzinfo=None),
+          'rawvalue': float(record['Read Value']),
+          'voltage': float(record['Voltage [V]']),
+          'pressure': float(record['Pressure [psi]']),
+        })
+  if rows:
+    db.session.execute(CalibrationReading.__table__.insert(), rows)
+    db.session.commit()
+  return len(rows)
+
+## Write the CalibrationReading table out as <psi>.csv files in the format of
+## pi_app/take_reading.py, one per gauge pressure, for pi_app/calibration.py
+## to fit. Returns the number of files written.
+def export_calibration_csv(directory: str) -> int:
+  makedirs(directory, exist_ok=True)
+  readings = CalibrationReading.query.order_by(CalibrationReading.pressure,
+                                               CalibrationReading.datetime)
+  count = 0
+  for pressure, group in groupby(readings, key=lambda r: r.pressure):
+    filename = path.join(directory, f"{pressure:g}.csv")
+    with open(filename, 'w', newline='', encoding='utf-8') as file:
+      writer = csv.writer(file)
+      writer.writerow(["Timestamp", "Read Count", "Read Value",
+                       "Pressure [psi]", "Voltage [V]"])
+      for i, r in enumerate(group):
+        local = r.datetime.replace(tzinfo=tz.tzutc()).astimezone(ROLLUP_TIMEZONE)
+        writer.writerow([local.replace(tzinfo=None), i, r.rawvalue,
+                         f"{pressure:g}", r.voltage])
+    count += 1
+  return count
+
+@click.command('export-calibration')
+@click.argument('directory')
+@with_appcontext
+def export_calibration_command(directory):
+  """Write the calibration readings to DIRECTORY as take_reading.py CSV files."""
+  count = export_calibration_csv(directory)
+  click.echo(f"Wrote {count} calibration files.")
+
+@click.command('import-calibration')
+@click.argument('filenames', nargs=-1, required=True)
+@with_appcontext
+def import_calibration_command(filenames):
+  """Load calibration CSV files written by take_reading.py."""
+  count = import_calibration_csv(filenames)
+  click.echo(f"Imported {count} calibration readings.")
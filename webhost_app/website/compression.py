@@ -0,0 +1,113 @@
+from datetime import timedelta
+
+## Swinging door compression of the recorded readings.
+## Most of the time the pressure is flat (the water is either off or steadily
+## on), so most readings can be rebuilt by drawing a line between the readings
+## on either side of them. Those readings are not stored. A reading is only
+## kept when a straight line from the last kept reading can no longer pass
+## within COMPRESSION_TOLERANCE of every reading since, which keeps every on/off
+## edge as sharp as it was measured.
+##
+## Reference:
+## Bristol, E. H. "Swinging Door Trending: Adaptive Trend Recording?" ISA 1990
+
+## GLOBALS
+COMPRESSION_TOLERANCE = 0.5 # psi. 0 turns compression off.
+# Always keep at least one reading this often, so a reading stored long ago
+# isn't the only thing describing a long flat stretch.
+MAX_COMPRESSION_GAP = timedelta(hours=6)
+
+##------------------------------------------------------------------------------
+## The swinging door. `archive` is the last reading that is kept for good and
+## `snapshot` is the newest reading. The snapshot is stored too (so the newest
+## reading is always in the database) but only provisionally (it is marked as
+## such in the MonitorReading table): if the next reading shows it was on the
+## line, it gets replaced.
+##
+## Each point is a (datetime, pressure) pair. Start the door with reset() on a
+## kept reading, then add() each newer reading. add() returns whether the
+## previous snapshot has to be kept.
+class SwingingDoor:
+  def __init__(self, tolerance: float = COMPRESSION_TOLERANCE,
+               max_gap: timedelta = MAX_COMPRESSION_GAP):
+    self.tolerance = tolerance
+    self.max_gap = max_gap
+    self.reset()
+
+  ## Start over from a kept reading (or from nothing)
+  def reset(self, archive=None):
+    self.archive = archive
+    self.snapshot = None
+    self.upper = float('-inf') # steepest slope the upper door has to allow
+    self.lower = float('inf') # shallowest slope the lower door has to allow
+
+  def add(self, point) -> bool:
+    keep_snapshot = False
+    if self.snapshot is not None and self._closes(point):
+      # The door closed, so the snapshot starts a new line
+      keep_snapshot = True
+      self.reset(self.snapshot)
+
+    self._swing(point)
+    self.snapshot = point
+    return keep_snapshot
+
+  # Would the door have to close to cover this point?
+  def _closes(self, point) -> bool:
+    if self.tolerance <= 0:
+      return True
+    if point[0] - self.archive[0] > self.max_gap:
+      return True
+    upper, lower = self._slopes(point)
+    return max(self.upper, upper) > min(self.lower, lower)
+
+  def _swing(self, point):
+    upper, lower = self._slopes(point)
+    self.upper = max(self.upper, upper)
+    self.lower = min(self.lower, lower)
+
+  # Slopes from the archive pivots (archive pressure +/- tolerance) to point
+  def _slopes(self, point):
+    elapsed = (point[0] - self.archive[0]).total_seconds()
+    if elapsed <= 0:
+      return float('inf'), float('-inf')
+    upper = (point[1] - self.archive[1] - self.tolerance) / elapsed
+    lower = (point[1] - self.archive[1] + self.tolerance) / elapsed
+    return upper, lower
+
+## The doors for the readings recorded by data_fetch, one per sensor. They
+## only live in this process (there is only one, see uwsgi-app.ini), and are
+## picked up again from the stored readings after a restart.
+doors = {}
+
+def door_for(sensor_id: int) -> SwingingDoor:
+  door = doors.get(sensor_id)
+  if door is None:
+    door = doors[sensor_id] = SwingingDoor()
+  return door
+
+##------------------------------------------------------------------------------
+## Rebuild values at the given times from compressed readings by drawing a
+## straight line between the stored readings on either side. The stored
+## dates must be sorted. Times outside of the stored readings get None, and
+## so do times between stored readings more than max_gap apart or without a
+## value, since the door never leaves gaps that long (see MAX_COMPRESSION_GAP)
+## and nothing was measured there.
+def interpolate(dates, values, times, max_gap: timedelta = MAX_COMPRESSION_GAP) -> list:
+  result = []
+  i = 0
+  for when in times:
+    while i < len(dates) - 1 and dates[i + 1] < when:
+      i += 1
+    if not dates or when < dates[0] or when > dates[-1]:
+      result.append(None)
+    elif dates[i] == when or i == len(dates) - 1:
+      result.append(values[i])
+    elif dates[i + 1] - dates[i] > max_gap\
+         or values[i] is None or values[i + 1] is None:
+      result.append(None)
+    else:
+      span = (dates[i + 1] - dates[i]).total_seconds()
+      fraction = (when - dates[i]).total_seconds() / span
+      result.append(values[i] + (values[i + 1] - values[i]) * fraction)
+  return result
@@ -1,42 +1,312 @@
 import requests
-from datetime import datetime
-from . import db
+import numpy as np
+from datetime import datetime, timezone
+from threading import Lock, Thread
+from itertools import groupby
+from sqlalchemy.sql import func
+from . import db, DEFAULT_SENSOR_ID
 from .models import MonitorReading
+from .rollups import merge_rollups
+from .analytics import update_intervals
+from .render_cache import plot_cache
+from .compression import door_for
+from .live import publish_readings
+from .sensors import sensor_source
+from .metrics import Counter, Histogram
 
 ## GLOBALS
-DATA_SOURCE_URL = 'http://192.168.058/json'
+HISTORY_BATCH_SIZE = 5000 # readings requested from the Pi per request
 TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
+FETCH_TIMEOUT = (3, 10) # seconds to (connect, read) before giving up on the Pi
 
+# One pooled HTTP session reuses the connection to the Pi between readings.
+session = requests.Session()
+# Held while a background refresh is running so that only one runs at a time.
+refresh_lock = Lock()
+# Held while recording readings, so that readings arriving from different
+# threads can't both pass the duplicate check or interleave in the door.
+ingest_lock = Lock()
+FETCH_SECONDS = Histogram('webhost_fetch_seconds',
+                          "Time taken to fetch readings from a Pi.")
+FETCH_FAILURES = Counter('webhost_fetch_failures_total',
+                         "Fetches from a Pi that failed.")
+INSERT_SECONDS = Histogram('webhost_db_insert_seconds',
+                           "Time taken to add a batch of readings to the "
+                           "database (with the rollups) and commit it.")
 
-def cron_reading(app):
-  app.app_context().push()
-  record_new_reading(DATA_SOURCE_URL)
-  print("Recorded a new reading through cron.")
 
 ##------------------------------------------------------------------------------
 ## Acquire data from the remote system via web request
-def get_new_reading(address: str) -> MonitorReading:
-  r = requests.get(address)
-  theJSON = r.json()
+def get_new_reading(address: str, sensor_id: int = DEFAULT_SENSOR_ID) -> MonitorReading:
+  theJSON = fetch_json(address)
   # TODO Test for no response!
   print(f"Time String from JSON: {theJSON[0]}")
   timestamp_string = theJSON[0].split('.')[0]
   datetime_object = datetime.strptime(timestamp_string, TIMESTAMP_FORMAT)
   print(f"datetime object: {datetime_object}")
-  reading = MonitorReading( datetime=datetime_object,
+  reading = MonitorReading( sensor_id=sensor_id,
+                            datetime=datetime_object,
                             rawvalue=theJSON[1],
                             voltage=theJSON[2],
                             pressure=theJSON[3])
   return reading
 
 ##------------------------------------------------------------------------------
-## Acquire data from the remote system via web request and record in DB
-def record_new_reading(address: str) -> MonitorReading:
-  r = get_new_reading(address)
+## Acquire a batch of readings stored on the remote system since the given
+## UNIX time. `channels` maps the ADC inputs of the remote system to sensor
+## ids (by default only the first input, for the main sensor). Returns the
+## readings as dicts ready to be inserted into the MonitorReading table, the
+## time to ask for the next batch from, and how many readings were sent
+## (counting those from inputs without a sensor, which are dropped).
+def get_reading_batch(address: str, since: float, limit: int = HISTORY_BATCH_SIZE,
+                      channels: dict = None):
+  if channels is None:
+    channels = {0: DEFAULT_SENSOR_ID}
+  theJSON = fetch_json(address, {'since': since, 'limit': limit})
 
-  db.session.add(r)
+  readings = [reading for reading in theJSON['readings']
+              if reading_channel(reading) in channels]
+  timestamps = parse_timestamps([reading[0] for reading in readings])
+  rows = [{'sensor_id': channels[reading_channel(reading)],
+           'datetime': timestamp,
+           'rawvalue': reading[1],
+           'voltage': reading[2],
+           'pressure': reading[3]}
+          for timestamp, reading in zip(timestamps, readings)]
+  return rows, theJSON['since'], len(theJSON['readings'])
+
+# GET a JSON document from a Pi, timing it (and counting failures) for /metrics
+def fetch_json(address: str, params: dict = None):
+  try:
+    with FETCH_SECONDS.time():
+      r = session.get(address, params=params, timeout=FETCH_TIMEOUT)
+      r.raise_for_status()
+      return r.json()
+  except Exception:
+    FETCH_FAILURES.inc()
+    raise
+
+##------------------------------------------------------------------------------
+## Record a batch of readings (dicts of MonitorReading columns) in a single
+## transaction. Readings without a sensor_id are from the main sensor.
+## Readings that aren't newer than the newest reading received from the same
+## sensor (or are repeated in the batch) are skipped. The readings are inserted
+## with one executemany rather than as ORM objects, and the rollups are
+## updated once for the whole batch. Readings that are compressed away (see
+## compression.py) still count in the rollups. The rollups and intervals only
+## cover the main sensor. Returns the number of new readings received.
+def record_readings(rows) -> int:
+  with ingest_lock:
+    with INSERT_SECONDS.time():
+      received = insert_readings(rows)
+    # Push them to the open pages (in the lock, so they arrive in order)
+    publish_readings(received)
+
+  # Anything rendered from the old data is now out of date
+  if received:
+    plot_cache.clear()
+  return len(received)
+
+# Returns the new readings, oldest first for each sensor
+def insert_readings(rows) -> list:
+  # Drop duplicates within the batch and put it in order of sensor and time
+  unique = {}
+  for row in rows:
+    row = dict(row)
+    row.setdefault('sensor_id', DEFAULT_SENSOR_ID)
+    unique[(row['sensor_id'], row['datetime'])] = row
+  rows = [unique[key] for key in sorted(unique)]
+
+  received = []
+  for sensor_id, sensor_rows in groupby(rows, key=lambda row: row['sensor_id']):
+    received += insert_sensor_readings(sensor_id, list(sensor_rows))
   db.session.commit()
+  return received
+
+# Add the readings of one sensor, sorted oldest first. Doesn't commit.
+# Returns the ones that hadn't been received before.
+def insert_sensor_readings(sensor_id: int, rows) -> list:
+  # Most readings are compressed away, so the ones received before can't be
+  # looked up. The newest one received is always stored though (see
+  # compress_readings()), and the Pis send their readings in order, so
+  # anything up to it has been received already.
+  newest = db.session.query(func.max(MonitorReading.datetime))\
+                     .filter(MonitorReading.sensor_id == sensor_id)\
+                     .scalar()
+  if newest is not None:
+    rows = [row for row in rows if row['datetime'] > newest]
+  if not rows:
+    return []
+  received = rows
+
+  if sensor_id == DEFAULT_SENSOR_ID:
+    # The rollups need to know when the reading before the batch was taken
+    previous = db.session.query(MonitorReading.datetime)\
+                         .filter(MonitorReading.sensor_id == sensor_id)\
+                         .filter(MonitorReading.datetime < rows[0]['datetime'])\
+                         .order_by(MonitorReading.datetime.desc())\
+                         .first()
+
+    # The rollups and intervals are built from every reading, before any are
+    # compressed away
+    measured = [(row['datetime'], row['pressure']) for row in rows
+                if row['pressure'] is not None]
+    merge_rollups(measured, previous.datetime if previous else None)
+    update_intervals(measured)
+
+  rows, superseded = compress_readings(rows, sensor_id)
+  if superseded is not None:
+    # The provisional reading stored before is either replaced or kept for good
+    provisional = MonitorReading.query.filter_by(sensor_id=sensor_id,
+                                                 provisional=True)
+    if superseded:
+      provisional.delete()
+    else:
+      provisional.update({'provisional': False})
+  if rows:
+    db.session.execute(MonitorReading.__table__.insert(), rows)
+  return received
+
+##------------------------------------------------------------------------------
+## Run new readings (sorted oldest first) through the swinging door and return
+## copies of the ones that need to be stored. The newest reading is always
+## stored, marked provisional, but it may turn out to be unneeded once the
+## next reading comes in. Also returns what happens to the provisional reading
+## stored before: True if it is replaced, False if it is kept for good and
+## None if it still stands. Each sensor has its own door. Call with
+## ingest_lock held.
+def compress_readings(rows, sensor_id: int = DEFAULT_SENSOR_ID):
+  door = door_for(sensor_id)
+  if door.archive is None:
+    restore_door(door, sensor_id)
+
+  stored_snapshot = door.snapshot
+  had_snapshot = stored_snapshot is not None
+  snapshot_row = None
+  keep = []
+  for row in rows:
+    latest = door.snapshot or door.archive
+    if row['pressure'] is None or (latest and row['datetime'] <= latest[0]):
+      # Empty readings (and any the door is already past) are stored as they are
+      keep.append(dict(row, provisional=False))
+      continue
+    if door.archive is None:
+      # The very first reading starts the first line
+      door.reset((row['datetime'], row['pressure']))
+      keep.append(dict(row, provisional=False))
+      continue
+
+    if door.add((row['datetime'], row['pressure'])):
+      if snapshot_row is not None:
+        keep.append(dict(snapshot_row, provisional=False))
+      else:
+        # The snapshot stored by an earlier batch is kept after all
+        stored_snapshot = None
+    snapshot_row = row
+
+  if snapshot_row is None:
+    # Nothing went through the door, so the stored snapshot still stands
+    return keep, None
+  keep.append(dict(snapshot_row, provisional=True))
+  if not had_snapshot:
+    return keep, None
+  return keep, stored_snapshot is not None
+
+# Pick the door up again from the newest stored reading (after a restart).
+# The readings the door dropped before it are gone, so a provisional reading
+# can't be checked against them any more and is kept for good.
+def restore_door(door, sensor_id: int):
+  MonitorReading.query.filter_by(sensor_id=sensor_id, provisional=True)\
+                      .update({'provisional': False})
+  newest = MonitorReading.query.filter_by(sensor_id=sensor_id)\
+                               .filter(MonitorReading.pressure.isnot(None))\
+                               .order_by(MonitorReading.datetime.desc())\
+                               .first()
+  if newest is not None:
+    door.reset((newest.datetime, newest.pressure))
+
+##------------------------------------------------------------------------------
+## Keep requesting batches of readings from the remote system, starting after
+## the newest reading in the database from its sensors, until it has nothing
+## newer. `channels` is as for get_reading_batch(). Returns the number of
+## readings recorded.
+def catch_up(address: str, channels: dict = None) -> int:
+  if channels is None:
+    channels = {0: DEFAULT_SENSOR_ID}
+  sort_field = MonitorReading.datetime.desc()
+  last_reading = MonitorReading.query\
+                   .filter(MonitorReading.sensor_id.in_(channels.values()))\
+                   .order_by(sort_field)\
+                   .first()
+  since = 0
+  if last_reading:
+    since = last_reading.datetime.replace(tzinfo=timezone.utc).timestamp()
+
+  total = 0
+  while True:
+    rows, since, count = get_reading_batch(address, since, channels=channels)
+    total += record_readings(rows)
+    if count < HISTORY_BATCH_SIZE:
+      return total
+
+## Catch up on the Pi a sensor is on, recording the readings of all of the
+## sensors on it. Returns the number of readings recorded.
+def catch_up_sensor(sensor_id: int = DEFAULT_SENSOR_ID) -> int:
+  url, channels = sensor_source(sensor_id)
+  return catch_up(f"{url}/history", channels)
+
+##------------------------------------------------------------------------------
+## Acquire data from the remote system via web request and record in DB.
+## Readings from before it that haven't been recorded yet are skipped from
+## then on (see record_readings()), so this is only for a sensor without any.
+def record_new_reading(address: str, sensor_id: int = DEFAULT_SENSOR_ID) -> MonitorReading:
+  r = get_new_reading(address, sensor_id)
+  record_readings([{'sensor_id': r.sensor_id,
+                    'datetime': r.datetime,
+                    'rawvalue': r.rawvalue,
+                    'voltage': r.voltage,
+                    'pressure': r.pressure}])
   return r
 
+##------------------------------------------------------------------------------
+## Catch up on the Pi a sensor is on in a background thread, so the caller (a
+## page view) doesn't have to wait on the Pi. This picks up everything the Pi
+## recorded while it wasn't being polled, not just its newest reading. If a
+## refresh is already running, this does nothing, so many visitors arriving
+## at once only cause one fetch. Returns whether a refresh was started.
+def refresh_in_background(app, sensor_id: int = DEFAULT_SENSOR_ID) -> bool:
+  if not refresh_lock.acquire(blocking=False):
+    return False
+  try:
+    Thread(target=background_refresh, args=(app, sensor_id), daemon=True).start()
+  except:
+    refresh_lock.release()
+    raise
+  return True
+
+def background_refresh(app, sensor_id: int):
+  try:
+    with app.app_context():
+      count = catch_up_sensor(sensor_id)
+      print(f"Recorded {count} new readings in the background.")
+  except Exception as e:
+    print(f"Background reading failed: {e}")
+  finally:
+    refresh_lock.release()
+
+# The ADC input a reading sent by the remote system came from. Readings from
+# a Pi from before it had several inputs don't say, and are all from the
+# first one.
+def reading_channel(reading) -> int:
+  return reading[4] if len(reading) > 4 else 0
+
+# Parse the timestamp strings sent by the remote system into naive UTC
+# datetimes, the whole batch in one pass by NumPy. Fractions of a second and
+# the zone (always UTC) are left off, as TIMESTAMP_FORMAT does.
+def parse_timestamps(timestamps) -> list:
+  seconds = np.array([timestamp[:19] for timestamp in timestamps],
+                     dtype='datetime64[s]')
+  return seconds.tolist()
+
 if __name__ == '__main__':
   pass
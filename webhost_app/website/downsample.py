@@ -0,0 +1,97 @@
+from datetime import datetime
+
+## Reduce a time series to a fixed number of points before handing it to
+## plotly. Every chart gets at most `threshold` points no matter how long the
+## window is, so the size of the page stays flat as history grows.
+
+## GLOBALS
+DEFAULT_METHOD = 'lttb'
+
+##------------------------------------------------------------------------------
+## Largest-Triangle-Three-Buckets
+## https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf
+## The first and last points are always kept. The rest of the series is split
+## into (threshold - 2) buckets, and from each bucket the point forming the
+## largest triangle with the previously selected point and the average of the
+## next bucket is kept. This preserves the visual shape (peaks and edges) of
+## the series much better than simple decimation.
+def lttb(dates, values, threshold: int):
+  count = len(dates)
+  if threshold >= count or threshold < 3:
+    return list(dates), list(values)
+
+  x = [_as_number(date) for date in dates]
+  y = values
+
+  sampled = [0]
+  bucket_size = (count - 2) / (threshold - 2)
+  a = 0
+  for i in range(threshold - 2):
+    # Range of the current bucket
+    start = int(i * bucket_size) + 1
+    end = int((i + 1) * bucket_size) + 1
+
+    # Average point of the next bucket
+    next_start = end
+    next_end = min(int((i + 2) * bucket_size) + 1, count)
+    next_count = next_end - next_start
+    avg_x = sum(x[next_start:next_end]) / next_count
+    avg_y = sum(y[next_start:next_end]) / next_count
+
+    # Pick the point in this bucket with the largest triangle area
+    max_area = -1
+    max_index = start
+    for j in range(start, end):
+      area = abs((x[a] - avg_x) * (y[j] - y[a]) -
+                 (x[a] - x[j]) * (avg_y - y[a]))
+      if area > max_area:
+        max_area = area
+        max_index = j
+    sampled.append(max_index)
+    a = max_index
+
+  sampled.append(count - 1)
+  return [dates[i] for i in sampled], [values[i] for i in sampled]
+
+##------------------------------------------------------------------------------
+## Min/Max per bucket
+## The series is split into (threshold / 2) buckets and both the smallest and
+## largest value in each bucket are kept in their original order. Nothing is
+## averaged away, so every spike or drop still shows up on the chart.
+def min_max(dates, values, threshold: int):
+  count = len(dates)
+  if threshold >= count or threshold < 2:
+    return list(dates), list(values)
+
+  buckets = threshold // 2
+  bucket_size = count / buckets
+  sampled = []
+  for i in range(buckets):
+    start = int(i * bucket_size)
+    end = int((i + 1) * bucket_size)
+    bucket = range(start, end)
+    low = min(bucket, key=values.__getitem__)
+    high = max(bucket, key=values.__getitem__)
+    sampled.extend(sorted({low, high}))
+
+  return [dates[i] for i in sampled], [values[i] for i in sampled]
+
+DOWNSAMPLERS = {
+  'lttb': lttb,
+  'minmax': min_max,
+}
+
+##------------------------------------------------------------------------------
+## Downsample the series with the named method.
+def downsample(dates, values, threshold: int, method: str = DEFAULT_METHOD):
+  try:
+    downsampler = DOWNSAMPLERS[method]
+  except KeyError:
+    raise ValueError(f"Unknown downsampling method: {method}")
+  return downsampler(dates, values, threshold)
+
+# LTTB needs the x-axis as a plain number to compute areas.
+def _as_number(value) -> float:
+  if isinstance(value, datetime):
+    return value.timestamp()
+  return float(value)
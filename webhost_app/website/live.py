@@ -0,0 +1,108 @@
+import json
+from queue import Queue, Full, Empty
+from threading import Lock
+from dateutil import tz
+
+from .rollups import ROLLUP_TIMEZONE, naive_utc
+
+## Live push of new readings to the open pages, as Server-Sent Events (see
+## /api/stream in views.py).
+## Recording readings publishes them here once, already encoded, and every
+## open stream gets them from a small queue of its own. So however many pages
+## are open, a reading costs one encode and no database queries or Pi fetches
+## per viewer. A viewer that can't keep up (its queue fills) is dropped, and
+## its browser reconnects on its own.
+## Each open stream holds a server thread, and the streams only get the
+## readings recorded by the poller of their own process, so the app is served
+## by one threaded process (see uwsgi-app.ini) with the poller running in it.
+
+## GLOBALS
+MAX_STREAMS = 20 # open streams at once. Keep below the threads in uwsgi-app.ini.
+STREAM_QUEUE = 100 # events held for a stream before it is dropped
+KEEPALIVE = 15 # seconds between keepalive comments on a quiet stream
+RECONNECT_DELAY = 5 # seconds the browser waits before reconnecting
+DISPLAY_FORMAT = '%b %d, %Y %-I:%M:%S %p %Z' # as TIMESTAMP_FORMAT in views.py
+
+##------------------------------------------------------------------------------
+## Hands every published event to each subscriber's queue. Shared between the
+## threads of a worker process, so the subscribers are only touched with the
+## lock held.
+class Broadcaster:
+  def __init__(self, max_subscribers: int, queue_size: int):
+    self.max_subscribers = max_subscribers
+    self.queue_size = queue_size
+    self._subscribers = set()
+    self._lock = Lock()
+
+  ## A new queue that gets every event from now on, or None if there are
+  ## already max_subscribers.
+  def subscribe(self) -> Queue:
+    with self._lock:
+      if len(self._subscribers) >= self.max_subscribers:
+        return None
+      queue = Queue(self.queue_size)
+      self._subscribers.add(queue)
+      return queue
+
+  def unsubscribe(self, queue: Queue):
+    with self._lock:
+      self._subscribers.discard(queue)
+
+  def publish(self, event: str):
+    with self._lock:
+      subscribers = list(self._subscribers)
+    for queue in subscribers:
+      try:
+        queue.put_nowait(event)
+      except Full:
+        # Too far behind. Throw away what it has and tell it to stop.
+        self.unsubscribe(queue)
+        with queue.mutex:
+          queue.queue.clear()
+        queue.put_nowait(None)
+
+  def __len__(self) -> int:
+    return len(self._subscribers)
+
+## The streams of this process
+broadcaster = Broadcaster(MAX_STREAMS, STREAM_QUEUE)
+
+##------------------------------------------------------------------------------
+## Publish newly recorded readings (dicts of MonitorReading columns) as one
+## 'readings' event of columns:
+##  sensor    - sensor ids
+##  time      - local ISO 8601 times, as the plots on the home page have them
+##  timestamp - the same times, formatted for display
+##  pressure  - psi (null if the Pi had no reading)
+## Nothing is encoded when no one is listening.
+def publish_readings(rows):
+  if not rows or not len(broadcaster):
+    return
+  local = [naive_utc(row['datetime']).replace(tzinfo=tz.tzutc())
+                                     .astimezone(ROLLUP_TIMEZONE)
+           for row in rows]
+  data = {'sensor': [row['sensor_id'] for row in rows],
+          'time': [when.isoformat() for when in local],
+          'timestamp': [when.strftime(DISPLAY_FORMAT) for when in local],
+          'pressure': [row['pressure'] for row in rows]}
+  broadcaster.publish(f"event: readings\ndata: {json.dumps(data)}\n\n")
+
+##------------------------------------------------------------------------------
+## The body of an event stream: every event published while it is open, with
+## keepalive comments in between so proxies don't close a quiet connection
+## and a closed one is noticed. Ends (and unsubscribes) when the client goes
+## away or falls behind.
+def stream(queue: Queue):
+  try:
+    yield f"retry: {RECONNECT_DELAY*1000}\n\n"
+    while True:
+      try:
+        event = queue.get(timeout=KEEPALIVE)
+      except Empty:
+        yield ": keepalive\n\n"
+        continue
+      if event is None:
+        return
+      yield event
+  finally:
+    broadcaster.unsubscribe(queue)
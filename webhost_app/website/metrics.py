@@ -0,0 +1,24 @@
+from functools import partial
+import prometheus_client
+from prometheus_client import Counter, generate_latest, CONTENT_TYPE_LATEST
+
+## Metrics for /metrics, in the Prometheus text exposition format, kept by
+## prometheus_client. Recording a value is an add under a lock, so it is cheap
+## enough to leave in the hot paths.
+## Each process keeps its own metrics and a scrape only sees the process that
+## answers it, which is why the app is served by a single process (see
+## uwsgi-app.ini).
+
+## GLOBALS
+# Upper bounds (seconds) of the histogram buckets. Fine at the bottom for
+# database queries, up to whole seconds for fetches from the Pi.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10)
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# Histograms of durations, with the buckets above
+Histogram = partial(prometheus_client.Histogram, buckets=BUCKETS)
+
+## Returns every metric in the text format
+def render() -> bytes:
+  return generate_latest()
@@ -1,22 +1,98 @@
 from time import timezone
 from flask_sqlalchemy.model import Model
-from . import db
+from . import db, DEFAULT_SENSOR_ID
 from flask_login import UserMixin
 from sqlalchemy.sql import func
 
+##------------------------------------------------------------------------------
+## The pressure sensors that readings are recorded from. Each one is an input
+## (channel) of the ADC on a Pi that is reached at `url` (the address of the
+## Pi, without a path). The sensor with DEFAULT_SENSOR_ID is the main water
+## supply. See sensors.py
+class Sensor(db.Model):
+  id = db.Column(db.Integer, primary_key=True)
+  name = db.Column(db.String(150), unique=True)
+  url = db.Column(db.String(250))
+  channel = db.Column(db.Integer, default=0)
+  def __repr__(self) -> str:
+    return(f"Sensor(id:{self.id}, "
+           f"name:{self.name}, "
+           f"url:{self.url}, "
+           f"channel:{self.channel})")
+
 class MonitorReading(db.Model):
+  # Pages show the readings of one sensor over a window of time, so the
+  # readings are indexed by sensor and time together. That keeps the window a
+  # single range of the index however many sensors there are.
+  __table_args__ = (
+    db.Index('ix_monitor_reading_sensor_id_datetime', 'sensor_id', 'datetime'),
+  )
   id = db.Column(db.Integer, primary_key=True)
+  sensor_id = db.Column(db.Integer, db.ForeignKey('sensor.id'), nullable=False,
+                        default=DEFAULT_SENSOR_ID,
+                        server_default=str(DEFAULT_SENSOR_ID))
+  # The newest reading of a sensor, stored until the next one shows whether
+  # compression keeps it (see compression.py)
+  provisional = db.Column(db.Boolean, nullable=False, default=False,
+                          server_default='0')
   # TODO Correct this. The name "datetime" conflicts with library
-  datetime = db.Column(db.DateTime(timezone=True), default=func.now())
+  # Indexed since every page load queries a time window of readings.
+  datetime = db.Column(db.DateTime(timezone=True), default=func.now(), index=True)
   rawvalue = db.Column(db.Integer)
   voltage = db.Column(db.Float)
   pressure = db.Column(db.Float)
   def __repr__(self) -> str:
-    return(f"MonitorReading(datetime:{self.datetime}, "
+    return(f"MonitorReading(sensor_id:{self.sensor_id}, "
+           f"datetime:{self.datetime}, "
            f"rawvalue:{self.rawvalue}, "
            f"voltage:{self.voltage}, "
            f"pressure:{self.pressure})")
 
+##------------------------------------------------------------------------------
+## Pre-aggregated readings. Each row summarizes all of the MonitorReadings of
+## the main sensor (DEFAULT_SENSOR_ID) taken within the bucket starting at
+## `start` (naive UTC, like the readings).
+## These are kept up to date as readings are recorded. See rollups.py
+class RollupMixin:
+  id = db.Column(db.Integer, primary_key=True)
+  start = db.Column(db.DateTime, unique=True, index=True)
+  count = db.Column(db.Integer, default=0)
+  min_pressure = db.Column(db.Float)
+  max_pressure = db.Column(db.Float)
+  mean_pressure = db.Column(db.Float)
+  minutes_on = db.Column(db.Float, default=0)# time above MIN_PRESSURE_FOR_ON
+  # Time the readings cover, out of the length of the bucket. None for rollups
+  # from before this was kept.
+  minutes = db.Column(db.Float)
+  def __repr__(self) -> str:
+    return(f"{type(self).__name__}(start:{self.start}, "
+           f"count:{self.count}, "
+           f"min:{self.min_pressure}, "
+           f"max:{self.max_pressure}, "
+           f"mean:{self.mean_pressure}, "
+           f"minutes_on:{self.minutes_on}, "
+           f"minutes:{self.minutes})")
+
+class HourlyRollup(RollupMixin, db.Model):
+  pass
+
+class DailyRollup(RollupMixin, db.Model):
+  pass
+
+##------------------------------------------------------------------------------
+## Stretches of time the water was on (or off), as worked out from the readings
+## of the main sensor by analytics.py. `end` is the last reading seen in the same state, so it
+## grows as readings come in until the water changes state.
+class WaterInterval(db.Model):
+  id = db.Column(db.Integer, primary_key=True)
+  start = db.Column(db.DateTime, index=True)
+  end = db.Column(db.DateTime)
+  on = db.Column(db.Boolean)
+  def __repr__(self) -> str:
+    return(f"WaterInterval(start:{self.start}, "
+           f"end:{self.end}, "
+           f"on:{self.on})")
+
 class CalibrationReading(db.Model):
   id = db.Column(db.Integer, primary_key=True)
   # TODO Correct this. The name "datetime" conflicts with library
@@ -0,0 +1,212 @@
+import asyncio, random, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import Thread
+
+from . import db
+from .data_fetch import catch_up
+from .sensors import sensors_by_source
+from .metrics import Counter
+
+## Polls every Pi in the sensor registry for new readings.
+## The poller runs an asyncio event loop in a thread of its own. Every
+## POLL_INTERVAL it starts a poll of each Pi that is due, without waiting on
+## the polls it started before, so a slow or dead Pi never holds up the others.
+## The fetching and recording itself is blocking (requests and SQLAlchemy), so
+## it runs in a pool of MAX_CONCURRENT_POLLS threads, which also bounds how
+## many Pis are polled at once.
+##
+## A failed poll is retried a few times with exponential backoff. A Pi that
+## still fails is left alone for a while (doubling each time, up to
+## MAX_BACKOFF) before being polled again. How each Pi is doing is kept in
+## its SourceHealth, which /api/sources reports.
+
+## GLOBALS
+POLL_INTERVAL = 10 # seconds between polls of each Pi
+MAX_CONCURRENT_POLLS = 8 # Pis polled at the same time
+SOURCE_TIMEOUT = 30 # seconds a poll (a whole catch up) may take
+SOURCE_TIMEOUTS = {} # {url: seconds} for Pis that need longer (or shorter)
+POLL_RETRIES = 2 # retries of a failed poll before backing off
+RETRY_DELAY = 1 # seconds before the first retry, doubled for each one after
+MAX_BACKOFF = 15*60 # longest wait (seconds) before polling a failing Pi again
+OVERRUNS = Counter('webhost_poll_overruns_total',
+                   "Polls skipped because the last poll of the Pi was still running.")
+
+##------------------------------------------------------------------------------
+## How polling a Pi is going. Times are UNIX times in seconds.
+class SourceHealth:
+  def __init__(self, url: str):
+    self.url = url
+    self.status = 'pending' # 'ok', 'retrying' or 'failing' after polling
+    self.failures = 0 # polls in a row that failed, after their retries
+    self.last_attempt = None
+    self.last_success = None
+    self.last_error = None
+    self.last_duration = None # seconds the last successful poll took
+    self.next_poll = 0
+    self.readings = 0 # readings recorded since starting
+    self.overruns = 0 # polls skipped because the last one was still running
+
+  def as_dict(self) -> dict:
+    return {'url': self.url,
+            'status': self.status,
+            'failures': self.failures,
+            'last_attempt': iso_time(self.last_attempt),
+            'last_success': iso_time(self.last_success),
+            'last_error': self.last_error,
+            'last_duration': self.last_duration,
+            'next_poll': iso_time(self.next_poll),
+            'readings': self.readings,
+            'overruns': self.overruns}
+
+##------------------------------------------------------------------------------
+class Poller:
+  def __init__(self, app, interval: float = POLL_INTERVAL,
+               concurrency: int = MAX_CONCURRENT_POLLS):
+    self.app = app
+    self.interval = interval
+    self.concurrency = concurrency
+    self.health = {}
+    self._in_flight = set()
+    self._loop = None
+    self._thread = None
+    self._executor = None
+    self._stopping = None
+
+  def start(self):
+    if self._thread is not None and self._thread.is_alive():
+      return
+    self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                        thread_name_prefix='poll')
+    self._loop = asyncio.new_event_loop()
+    # Made before the thread starts (and in the loop it belongs to) so that
+    # stop() can always set it
+    self._stopping = self._loop.run_until_complete(new_event())
+    self._thread = Thread(target=self._loop.run_until_complete,
+                          args=(self._run(),), name='poller', daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    if self._thread is None:
+      return
+    self._loop.call_soon_threadsafe(self._stopping.set)
+    self._thread.join()
+    self._executor.shutdown(wait=False)
+    self._thread = None
+
+  ## The health of every Pi that has been polled, as dicts
+  def report(self) -> list:
+    return [health.as_dict() for health in list(self.health.values())]
+
+  async def _run(self):
+    semaphore = asyncio.Semaphore(self.concurrency)
+    tasks = set()
+    while not self._stopping.is_set():
+      started = time.monotonic()
+      try:
+        sources = await self._call(self._sources)
+      except Exception as e:
+        print(f"Could not read the sensor registry: {e}")
+        sources = {}
+
+      now = time.time()
+      for url, channels in sources.items():
+        health = self.health.setdefault(url, SourceHealth(url))
+        if url in self._in_flight:
+          health.overruns += 1
+          OVERRUNS.inc()
+          continue
+        if now < health.next_poll:
+          continue
+        self._in_flight.add(url)
+        task = asyncio.ensure_future(self._poll(semaphore, health, channels))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+      # Wait for the next round (or to be stopped)
+      delay = self.interval - (time.monotonic() - started)
+      try:
+        await asyncio.wait_for(self._stopping.wait(), max(delay, 0))
+      except asyncio.TimeoutError:
+        pass
+
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+  # Poll one Pi, retrying with backoff, and keep its health up to date
+  async def _poll(self, semaphore, health: SourceHealth, channels: dict):
+    timeout = SOURCE_TIMEOUTS.get(health.url, SOURCE_TIMEOUT)
+    # The catch up of the last attempt. One that timed out keeps running in its
+    # thread until the request times out too, and the Pi stays in flight
+    # until it has finished.
+    running = None
+    try:
+      for attempt in range(POLL_RETRIES + 1):
+        if running is not None and not running.done():
+          await asyncio.wait([asyncio.wrap_future(running)])
+        health.last_attempt = time.time()
+        try:
+          async with semaphore:
+            started = time.monotonic()
+            running = self._executor.submit(self._catch_up, health.url, channels)
+            count = await asyncio.wait_for(asyncio.wrap_future(running), timeout)
+        except Exception as e:
+          health.last_error = f"{type(e).__name__}: {e}"
+          health.status = 'retrying'
+          if attempt < POLL_RETRIES:
+            await asyncio.sleep(RETRY_DELAY * 2**attempt * random.uniform(1, 1.5))
+          continue
+
+        health.status = 'ok'
+        health.failures = 0
+        health.last_success = time.time()
+        health.last_duration = time.monotonic() - started
+        health.readings += count
+        health.next_poll = 0
+        return
+
+      # Still failing. Leave this Pi alone for a while.
+      health.status = 'failing'
+      health.failures += 1
+      backoff = min(MAX_BACKOFF, self.interval * 2**health.failures)
+      health.next_poll = time.time() + backoff
+      print(f"Polling {health.url} failed ({health.last_error}). "
+            f"Trying again in {backoff:.0f} s.")
+    finally:
+      if running is None or running.done():
+        self._in_flight.discard(health.url)
+      else:
+        loop = asyncio.get_running_loop()
+        running.add_done_callback(lambda future: loop.call_soon_threadsafe(
+          self._in_flight.discard, health.url))
+
+  # Run a blocking function in the thread pool
+  async def _call(self, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                            func, *args)
+
+  def _sources(self) -> dict:
+    with self.app.app_context():
+      try:
+        return sensors_by_source()
+      finally:
+        db.session.remove()
+
+  # Pick up everything the Pi recorded since our last reading from it, so
+  # nothing is lost if a poll was missed.
+  def _catch_up(self, url: str, channels: dict) -> int:
+    with self.app.app_context():
+      try:
+        return catch_up(f"{url}/history", channels)
+      finally:
+        db.session.remove()
+
+async def new_event() -> asyncio.Event:
+  return asyncio.Event()
+
+# UNIX time as ISO 8601 UTC, or None
+def iso_time(when: float) -> str:
+  if not when:
+    return None
+  return datetime.utcfromtimestamp(when).isoformat() + 'Z'
@@ -0,0 +1,44 @@
+from collections import OrderedDict
+from threading import Lock
+
+## Cache of rendered page fragments (like the plot HTML). The data behind the
+## plots only changes when a new reading is recorded, so there is no reason to
+## rebuild and serialize the figures on every page view in between.
+
+## GLOBALS
+PLOT_CACHE_SIZE = 8 # entries
+
+##------------------------------------------------------------------------------
+## A small least-recently-used cache. It is shared between the threads of a
+## worker process, so every access holds the lock.
+class RenderCache:
+  def __init__(self, max_entries: int):
+    self.max_entries = max_entries
+    self._entries = OrderedDict()
+    self._lock = Lock()
+
+  def get(self, key):
+    with self._lock:
+      if key not in self._entries:
+        return None
+      self._entries.move_to_end(key)
+      return self._entries[key]
+
+  def put(self, key, value):
+    with self._lock:
+      self._entries[key] = value
+      self._entries.move_to_end(key)
+      # Evict the least recently used entries
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+## The rendered home page plots. Keyed on the newest reading id and the plotted
+## windows, and cleared whenever a new reading is recorded.
+plot_cache = RenderCache(PLOT_CACHE_SIZE)
@@ -0,0 +1,182 @@
+import time
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+
+import click
+from flask.cli import with_appcontext
+
+from . import db, DEFAULT_SENSOR_ID
+from .models import MonitorReading, HourlyRollup
+from .render_cache import plot_cache
+
+## How long the recorded data is kept.
+## The raw readings of the main sensor are only kept for RAW_RETENTION_DAYS and
+## the hourly rollups for HOURLY_RETENTION_DAYS. The daily rollups and the
+## on/off intervals are small and kept forever, so the long term trends survive
+## the raw readings they were built from. The rollups and intervals only cover
+## the main sensor, so the readings of the other sensors are kept forever too,
+## as they would be lost otherwise.
+##
+## Old rows are deleted a chunk at a time, each in its own short transaction,
+## with a pause in between so page loads and the poller never wait on the
+## database for long. The freed pages are then handed back to the file system
+## with an incremental vacuum, which only works once the database has been
+## switched to incremental auto vacuum (new databases are, older ones need
+## `flask apply-retention --enable-incremental-vacuum` once).
+
+## GLOBALS
+RAW_RETENTION_DAYS = 90
+HOURLY_RETENTION_DAYS = 2*365
+RETENTION_INTERVAL = 60*60 # seconds between runs in the background
+DELETE_CHUNK = 2000 # rows deleted per transaction
+CHUNK_PAUSE = 0.05 # seconds between chunks, to let others at the database
+VACUUM_PAGES = 1000 # pages freed per incremental vacuum step
+# Held while deleting, so the background job and the admin page don't both
+# delete at once.
+retention_lock = Lock()
+
+##------------------------------------------------------------------------------
+## Delete everything that has gone past its retention period. Returns the
+## number of rows deleted from each table.
+def apply_retention(now: datetime = None) -> dict:
+  now = now or datetime.utcnow()
+  deleted = {
+    'readings': delete_before(MonitorReading, MonitorReading.datetime,
+                              now - timedelta(days=RAW_RETENTION_DAYS),
+                              MonitorReading.sensor_id == DEFAULT_SENSOR_ID),
+    'hourly_rollups': delete_before(HourlyRollup, HourlyRollup.start,
+                                    now - timedelta(days=HOURLY_RETENTION_DAYS)),
+  }
+  if any(deleted.values()):
+    incremental_vacuum()
+  return deleted
+
+##------------------------------------------------------------------------------
+## Delete the rows of model where column is before cutoff (and that match the
+## other criteria given), DELETE_CHUNK rows per transaction. Returns the number
+## of rows deleted.
+def delete_before(model, column, cutoff: datetime, *criteria) -> int:
+  deleted = 0
+  while True:
+    ids = [row.id for row in db.session.query(model.id)
+                                       .filter(column < cutoff, *criteria)
+                                       .limit(DELETE_CHUNK)]
+    if not ids:
+      break
+    model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+    db.session.commit()
+    deleted += len(ids)
+    if len(ids) < DELETE_CHUNK:
+      break
+    time.sleep(CHUNK_PAUSE)
+
+  if deleted and model is MonitorReading:
+    # The plots may have shown some of these
+    plot_cache.clear()
+  return deleted
+
+##------------------------------------------------------------------------------
+## Give the free pages of the database back to the file system, a few at a
+## time. Does nothing unless incremental auto vacuum is on. Returns whether it
+## is.
+def incremental_vacuum() -> bool:
+  with db.engine.connect() as connection:
+    if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+      return False
+    free = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+    while free > 0:
+      connection.exec_driver_sql(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+      remaining = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+      if remaining >= free:
+        # Not getting anywhere (the database is busy). Leave it for next time.
+        break
+      free = remaining
+      time.sleep(CHUNK_PAUSE)
+  return True
+
+## Switch the database to incremental auto vacuum. This takes a full VACUUM,
+## which rewrites the whole file and locks it while it runs, so it is only
+## done when asked for.
+def enable_incremental_vacuum():
+  with db.engine.connect() as connection:
+    connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+    connection.exec_driver_sql("VACUUM")
+
+@click.command('apply-retention')
+@click.option('--enable-incremental-vacuum', 'enable', is_flag=True,
+              help="Switch the database to incremental vacuum first. "
+                   "This locks the database while the whole file is rewritten.")
+@with_appcontext
+def apply_retention_command(enable):
+  """Delete readings and rollups that are past their retention period."""
+  if enable:
+    enable_incremental_vacuum()
+    click.echo("Incremental vacuum is on.")
+  with retention_lock:
+    deleted = apply_retention()
+  click.echo(f"Deleted {deleted['readings']} readings and "
+             f"{deleted['hourly_rollups']} hourly rollups.")
+
+##------------------------------------------------------------------------------
+## Applies the retention periods in a background thread every `interval`
+## seconds.
+class RetentionWorker:
+  def __init__(self, app, interval: float = RETENTION_INTERVAL):
+    self.app = app
+    self.interval = interval
+    self._stop = Event()
+    self._thread = None
+
+  def start(self):
+    if self._thread is not None and self._thread.is_alive():
+      return
+    self._stop.clear()
+    self._thread = Thread(target=self._run, name='retention', daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+
+  def _run(self):
+    while not self._stop.is_set():
+      with retention_lock, self.app.app_context():
+        try:
+          deleted = apply_retention()
+          if any(deleted.values()):
+            print(f"Retention deleted {deleted}")
+        except Exception as e:
+          print(f"Applying retention failed: {e}")
+        finally:
+          db.session.remove()
+      self._stop.wait(self.interval)
+
+##------------------------------------------------------------------------------
+## Delete the raw readings of the main sensor from before cutoff in a background
+## thread, so the page that asked doesn't wait on it. The rollups are kept.
+## Returns False (and does nothing) if deleting is already going on.
+def prune_in_background(app, cutoff: datetime) -> bool:
+  if not retention_lock.acquire(blocking=False):
+    return False
+  try:
+    Thread(target=background_prune, args=(app, cutoff), daemon=True).start()
+  except:
+    retention_lock.release()
+    raise
+  return True
+
+def background_prune(app, cutoff: datetime):
+  try:
+    with app.app_context():
+      try:
+        count = delete_before(MonitorReading, MonitorReading.datetime, cutoff,
+                              MonitorReading.sensor_id == DEFAULT_SENSOR_ID)
+        incremental_vacuum()
+        print(f"Pruned {count} readings from before {cutoff}.")
+      finally:
+        db.session.remove()
+  except Exception as e:
+    print(f"Pruning failed: {e}")
+  finally:
+    retention_lock.release()
@@ -0,0 +1,169 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+from dateutil import tz
+import click
+from flask.cli import with_appcontext
+
+from . import db, READING_DELTA, MIN_PRESSURE_FOR_ON, DEFAULT_SENSOR_ID
+from .models import MonitorReading, HourlyRollup, DailyRollup
+
+## Hourly and daily summaries of the readings. These are updated a reading at
+## a time as readings are recorded so that long range charts and availability
+## summaries can read a few hundred rows instead of scanning every reading.
+
+## GLOBALS
+# Days are counted in the local timezone so that a "day" on the charts
+# matches a day for the people using the water.
+ROLLUP_TIMEZONE = tz.gettz('America/New_York')
+# A reading counts for the time since the reading before it, but no more than
+# this. Anything longer is treated as an outage of the monitor, not the water.
+MAX_SAMPLE_GAP = timedelta(minutes=2*READING_DELTA)
+
+##------------------------------------------------------------------------------
+## Bucket boundaries. All of these take and return naive UTC datetimes, which
+## is how the readings are stored.
+def hour_start(when: datetime) -> datetime:
+  return when.replace(minute=0, second=0, microsecond=0)
+
+def day_start(when: datetime) -> datetime:
+  # The timezone offset is always whole hours, so every reading in an hour
+  # starts the same day. Converting timezones is slow, so do it once per hour.
+  return _day_start_of_hour(hour_start(when))
+
+@lru_cache(maxsize=1024)
+def _day_start_of_hour(hour: datetime) -> datetime:
+  local = hour.replace(tzinfo=tz.tzutc()).astimezone(ROLLUP_TIMEZONE)
+  midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+  return midnight.astimezone(tz.tzutc()).replace(tzinfo=None)
+
+ROLLUPS = {
+  HourlyRollup: hour_start,
+  DailyRollup: day_start,
+}
+
+##------------------------------------------------------------------------------
+## Add a batch of (datetime, pressure) readings, sorted oldest first, to the
+## rollups. `previous` is the timestamp of the reading recorded before the
+## batch (None if there was none). The batch is summarized in memory first, so
+## each rollup it touches is read and written once no matter how many readings
+## fall in it. The buckets in `covered` ({model: starts}) are left alone.
+## This does not commit. The caller commits along with the readings.
+def merge_rollups(rows, previous: datetime = None, covered: dict = None):
+  for model, built in aggregate(rows, previous).items():
+    for start in (covered or {}).get(model, ()):
+      built.pop(start, None)
+    if not built:
+      continue
+    existing = model.query.filter(model.start >= min(built))\
+                          .filter(model.start <= max(built))
+    existing = {rollup.start: rollup for rollup in existing}
+    for start, rollup in built.items():
+      if start in existing:
+        combine(existing[start], rollup)
+      else:
+        db.session.add(rollup)
+
+##------------------------------------------------------------------------------
+## Build the rollups missing from the readings in the database. Needed once for
+## databases that were recording readings before rollups existed.
+## The rollups already stored are left as they are: they were built from every
+## reading as it came in, while the readings dropped by compression (see
+## compression.py) or deleted by retention (see retention.py) are gone, so
+## they can't be worked out again. Returns the number of (hourly, daily)
+## rollups created.
+def rebuild_rollups():
+  rows = db.session.query(MonitorReading.datetime, MonitorReading.pressure)\
+                   .filter(MonitorReading.sensor_id == DEFAULT_SENSOR_ID)\
+                   .filter(MonitorReading.pressure.isnot(None))\
+                   .order_by(MonitorReading.datetime)\
+                   .yield_per(10000)
+  counts = []
+  for model, built in aggregate(rows).items():
+    stored = {row.start for row in db.session.query(model.start)}
+    missing = [rollup for start, rollup in built.items() if start not in stored]
+    db.session.add_all(missing)
+    counts.append(len(missing))
+  db.session.commit()
+  return tuple(counts)
+
+@click.command('rebuild-rollups')
+@with_appcontext
+def rebuild_rollups_command():
+  """Build the rollups missing over the time the recorded readings cover."""
+  hours, days = rebuild_rollups()
+  click.echo(f"Built {hours} hourly and {days} daily missing rollups.")
+
+##------------------------------------------------------------------------------
+## Helpers
+
+# Summarize (datetime, pressure) rows, sorted oldest first, into new rollups.
+# Returns {model: {start: rollup}}. The sums are kept in plain lists of
+# [count, min, max, total, minutes_on, minutes] while going through the rows, since
+# setting attributes on the ORM objects for every reading is slow.
+def aggregate(rows, previous: datetime = None) -> dict:
+  sums = {model: {} for model in ROLLUPS}
+  for when, pressure in rows:
+    when = naive_utc(when)
+    minutes = sample_minutes(when, previous)
+    previous = when
+    on = pressure > MIN_PRESSURE_FOR_ON
+
+    for model, bucket_start in ROLLUPS.items():
+      start = bucket_start(when)
+      s = sums[model].get(start)
+      if s is None:
+        sums[model][start] = [1, pressure, pressure, pressure,
+                              minutes if on else 0, minutes]
+        continue
+      s[0] += 1
+      if pressure < s[1]: s[1] = pressure
+      if pressure > s[2]: s[2] = pressure
+      s[3] += pressure
+      if on: s[4] += minutes
+      s[5] += minutes
+
+  rollups = {model: {} for model in ROLLUPS}
+  for model, buckets in sums.items():
+    for start, (count, low, high, total, minutes_on, minutes) in buckets.items():
+      rollups[model][start] = model(start=start,
+                                    count=count,
+                                    min_pressure=low,
+                                    max_pressure=high,
+                                    mean_pressure=total/count,
+                                    minutes_on=minutes_on,
+                                    minutes=minutes)
+  return rollups
+
+# Fold one rollup of the same bucket into another
+def combine(rollup, other):
+  if not other.count:
+    return
+  if rollup.count:
+    total = rollup.count + other.count
+    rollup.min_pressure = min(rollup.min_pressure, other.min_pressure)
+    rollup.max_pressure = max(rollup.max_pressure, other.max_pressure)
+    rollup.mean_pressure = (rollup.mean_pressure*rollup.count +
+                            other.mean_pressure*other.count) / total
+  else:
+    rollup.min_pressure = other.min_pressure
+    rollup.max_pressure = other.max_pressure
+    rollup.mean_pressure = other.mean_pressure
+  rollup.count += other.count
+  rollup.minutes_on += other.minutes_on
+  # Older rollups don't know the time they cover, so adding to it is no help
+  if rollup.minutes is not None and other.minutes is not None:
+    rollup.minutes += other.minutes
+  else:
+    rollup.minutes = None
+
+# How many minutes a reading taken at `when` stands for.
+def sample_minutes(when: datetime, previous: datetime = None) -> float:
+  if previous is None or naive_utc(previous) >= when:
+    return READING_DELTA
+  gap = min(when - naive_utc(previous), MAX_SAMPLE_GAP)
+  return gap.total_seconds() / 60
+
+def naive_utc(when: datetime) -> datetime:
+  if when.tzinfo is not None:
+    when = when.astimezone(tz.tzutc()).replace(tzinfo=None)
+  return when
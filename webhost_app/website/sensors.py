@@ -0,0 +1,73 @@
+import click
+from flask.cli import with_appcontext
+
+from . import db, DEFAULT_SENSOR_ID
+from .models import Sensor
+
+## The registry of pressure sensors readings are recorded from.
+## Each sensor is an input of the ADC on a Pi (see CHANNELS in
+## pi_app/pressInterface.py), so one Pi can serve several sensors and several
+## Pis can be polled. A Pi sends the readings of all of its inputs together and
+## they are recorded against the sensor registered for each input. Inputs
+## without a registered sensor are ignored.
+
+## GLOBALS
+DEFAULT_SENSOR_NAME = 'Main'
+DEFAULT_SENSOR_URL = 'http://pressure-pi' # the Pi the main sensor is on
+# Registered for the main sensor by older versions, and not a valid address
+OLD_DEFAULT_SENSOR_URLS = ('http://192.168.058',)
+
+##------------------------------------------------------------------------------
+## Make sure the main sensor is registered. Readings from before there were
+## several sensors are recorded against it.
+def register_default_sensor():
+  sensor = Sensor.query.get(DEFAULT_SENSOR_ID)
+  if sensor is None:
+    db.session.add(Sensor(id=DEFAULT_SENSOR_ID,
+                          name=DEFAULT_SENSOR_NAME,
+                          url=DEFAULT_SENSOR_URL,
+                          channel=0))
+    db.session.commit()
+  elif sensor.url in OLD_DEFAULT_SENSOR_URLS:
+    sensor.url = DEFAULT_SENSOR_URL
+    db.session.commit()
+
+## Where the Pi a sensor is on serves its newest reading
+def latest_reading_url(sensor_id: int = DEFAULT_SENSOR_ID) -> str:
+  return f"{Sensor.query.get(sensor_id).url}/json"
+
+## The Pi a sensor is on and the sensors on it, as (url, {channel: sensor id})
+def sensor_source(sensor_id: int = DEFAULT_SENSOR_ID):
+  url = Sensor.query.get(sensor_id).url
+  return url, sensors_by_source()[url]
+
+##------------------------------------------------------------------------------
+## The registered sensors grouped by the Pi they are on, as
+## {url: {channel: sensor id}}
+def sensors_by_source() -> dict:
+  sources = {}
+  for sensor in Sensor.query.order_by(Sensor.id):
+    sources.setdefault(sensor.url, {})[sensor.channel] = sensor.id
+  return sources
+
+@click.command('add-sensor')
+@click.argument('name')
+@click.argument('url')
+@click.option('--channel', default=0, help="ADC input (0 to 3) the sensor is on.")
+@with_appcontext
+def add_sensor_command(name, url, channel):
+  """Register the sensor NAME on input --channel of the Pi at URL."""
+  url = url.rstrip('/')
+  if Sensor.query.filter_by(url=url, channel=channel).first():
+    raise click.ClickException(f"{url} channel {channel} is already registered.")
+  sensor = Sensor(name=name, url=url, channel=channel)
+  db.session.add(sensor)
+  db.session.commit()
+  click.echo(f"Registered {sensor}.")
+
+@click.command('list-sensors')
+@with_appcontext
+def list_sensors_command():
+  """List the registered sensors."""
+  for sensor in Sensor.query.order_by(Sensor.id):
+    click.echo(f"{sensor.id:>3} {sensor.name:<20} {sensor.url} channel {sensor.channel}")
@@ -1,26 +1,52 @@
+import csv, io, json
 from datetime import datetime, timedelta
-from dateutil import tz
+from dateutil import tz, parser
 from collections import namedtuple
+from math import isnan
 
-from flask import Blueprint, render_template, request, flash
+from flask import Blueprint, render_template, request, flash, jsonify, abort
+from flask import current_app, Response, stream_with_context
 from flask_login import login_required, current_user
-import plotly.io as pio
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-
-from . import db
-from .models import MonitorReading
-from .data_fetch import record_new_reading
+from sqlalchemy.sql import func
+
+from . import db, MIN_PRESSURE_FOR_ON, DEFAULT_SENSOR_ID
+from .models import MonitorReading, HourlyRollup, DailyRollup, Sensor
+from .models import CalibrationReading
+from .data_fetch import record_new_reading, refresh_in_background, get_new_reading
+from .data_fetch import catch_up_sensor
+from .downsample import downsample
+from .render_cache import plot_cache
+from .retention import prune_in_background, RAW_RETENTION_DAYS
+from .compression import interpolate, MAX_COMPRESSION_GAP
+from .sensors import latest_reading_url
+from . import analytics, live, metrics
+
+## Rollup tables that can be served by the readings API
+API_RESOLUTIONS = {
+  'hour': HourlyRollup,
+  'day': DailyRollup,
+}
+API_MAX_POINTS = 100000 # most points the API will interpolate
+EXPORT_CHUNK = 5000 # readings fetched from the database (and sent) at a time
+EXPORT_COLUMNS = ('id', 'sensor_id', 'datetime', 'rawvalue', 'voltage', 'pressure')
+EXPORT_TYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
 
 ## Define a named tuple to hold data for display on page
-DisplayData = namedtuple("DisplayData", "printable_pressure on_now reading")
+DisplayData = namedtuple("DisplayData", "printable_pressure on_now stale reading")
 
 ## GLOBALS
-DATA_SOURCE_URL = 'http://pressure-pi/json'
 READING_DELTA = 15# minutes
-MIN_PRESSURE_FOR_ON = 30#psi
+PLOT_WINDOW = timedelta(weeks=1)# widest window of raw readings on the home page
+DAY_WINDOW = timedelta(hours=24)# window of the first plot on the home page
+PEAK_WINDOW = timedelta(days=30)# window of daily peaks on the home page
+PLOT_POINTS = 500# most points sent to the browser per chart
+PLOT_DOWNSAMPLE = 'lttb'# see downsample.DOWNSAMPLERS
 # TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
 TIMESTAMP_FORMAT = '%b %d, %Y %-I:%M:%S %p %Z'
+HOME_QUERY_SECONDS = metrics.Histogram('webhost_home_query_seconds',
+  "Time taken by the database queries for the home page plots.")
+PLOT_RENDER_SECONDS = metrics.Histogram('webhost_plot_render_seconds',
+  "Time taken to render a plot to HTML.")
 
 views = Blueprint('views', __name__)
 
@@ -31,36 +57,43 @@ def home():
   # Get data common to home and admin page
   page_data = common_page_data()
 
-  ## Query database for data to plot and generate the plot
-  # First get the reading dates
-  # TODO od these queries to only grab the last week's worth of data
-  date_data = [reading.datetime for reading in MonitorReading.query.all()]
-
-  # Timestamps from database are in UTC.
-  # make sure dates are timezone aware
-  dates = []
-
-  for date in date_data:
-    dates.append(date.replace(tzinfo=tz.tzutc()))
-  date_data = dates
-
   # Format last timestamp for display
   current_timestamp = utc2local(page_data.reading.datetime)
   printable_timestamp = current_timestamp.strftime(TIMESTAMP_FORMAT)
   # print(f"Formatted Current Timestamp: {printable_timestamp}")
 
-  # Now get the pressures
-  pressure_data = [reading.pressure for reading in MonitorReading.query.all()]
-
-  # generate the plots with this data
-  plot_elements = generate_plots(date_data, pressure_data)
+  # The plots only change when a reading is recorded or old readings fall out
+  # of the window, so reuse the last render if nothing new has come in since
+  # and the window has moved on by less than READING_DELTA.
+  now = datetime.utcnow()
+  window_end = now.replace(minute=now.minute - now.minute % READING_DELTA,
+                           second=0, microsecond=0)
+  cache_key = (latest_reading_id(), window_end, PLOT_WINDOW, PEAK_WINDOW)
+  plot_elements = plot_cache.get(cache_key)
+  if plot_elements is None:
+    ## Query database for data to plot and generate the plot
+    with HOME_QUERY_SECONDS.time():
+      # Only grab the window of readings that will actually be plotted.
+      date_data, pressure_data = query_plot_window(PLOT_WINDOW)
+      # Long range plots come from the pre-aggregated daily rollups.
+      peak_dates, peak_pressures = query_daily_peaks(PEAK_WINDOW)
+
+    # generate the plots with this data
+    plot_elements = generate_plots(date_data, pressure_data,
+                                   peak_dates, peak_pressures)
+    plot_cache.put(cache_key, plot_elements)
 
   return render_template("home.html.j2",
                          user=current_user,
                          on_now=page_data.on_now,
                          current_pressure=page_data.printable_pressure,
                          current_timestamp=printable_timestamp,
-                         plotData=plot_elements)
+                         stale=page_data.stale,
+                         plotData=plot_elements,
+                         main_sensor=DEFAULT_SENSOR_ID,
+                         min_pressure=MIN_PRESSURE_FOR_ON,
+                         plot_windows=[DAY_WINDOW.total_seconds(),
+                                       PLOT_WINDOW.total_seconds()])
 
 @views.route('/about')
 def about():
@@ -80,22 +113,49 @@ def admin():
 
     # ----- Handle the "Force Reading" Button
     if button_clicked == 'forceReading':
-      # Force a reading
+      # Fetch everything the Pi has recorded since the last reading we have
       print('Forcing a reading.')
-      record_new_reading(DATA_SOURCE_URL)
-      # Notify the user that the reading was taken
-      flash(f"A reading was taken. The pressure is "
-            f"{page_data.printable_pressure} psi.", category='success')
-            #TODO This uses the pressure that was previously passed in
-            # instead of the newly read presssure. Need to fix this.
+      try:
+        count = catch_up_sensor()
+      except Exception as e:
+        flash(f"Could not get readings from the sensor: {e}", category='error')
+      else:
+        page_data = common_page_data()
+        # Notify the user that the reading was taken
+        flash(f"{count} new readings were recorded. The pressure is "
+              f"{page_data.printable_pressure} psi.", category='success')
     # ----- Handle the "Calibration Reading" Button
     elif button_clicked == 'calibrateReading':
-      # Call the calibrate-reading method
-      flash('A calibration reading was taken.', category='success')
+      # Record what the sensor reads now against the pressure read off the
+      # gauge. These are fitted by pi_app/calibration.py (see
+      # `flask export-calibration`).
+      try:
+        gauge_pressure = float(request.form['manualPressure'])
+      except (KeyError, ValueError):
+        flash('Enter the pressure read from the gauge.', category='error')
+      else:
+        try:
+          r = get_new_reading(latest_reading_url())
+        except Exception as e:
+          flash(f"Could not get a reading from the sensor: {e}", category='error')
+        else:
+          db.session.add(CalibrationReading(datetime=r.datetime,
+                                            rawvalue=r.rawvalue,
+                                            voltage=r.voltage,
+                                            pressure=gauge_pressure))
+          db.session.commit()
+          flash(f"A calibration reading was taken at {gauge_pressure} psi "
+                f"(raw value {r.rawvalue:.0f}).", category='success')
     elif button_clicked == 'pruneDatabase':
+      # Deleted a chunk at a time in the background, so this page (and
+      # everyone else's) doesn't wait on it. The rollups are kept.
       cutoff_date = datetime.strptime(request.form['pruneBefore'], '%Y-%m-%d')
-      MonitorReading.query.filter(MonitorReading.datetime < cutoff_date).delete()
-      db.session.commit()
+      if prune_in_background(current_app._get_current_object(), cutoff_date):
+        flash(f"Deleting the raw readings from before {cutoff_date:%b %d, %Y}. "
+              f"The hourly and daily summaries are kept.", category='success')
+      else:
+        flash('Old readings are already being deleted. Try again later.',
+              category='error')
     # ----- Unidentified Button...
     else:
       flash('Unsure what reading to take.', category='error')
@@ -104,28 +164,225 @@ def admin():
                           user=current_user,
                           on_now=page_data.on_now,
                           current_pressure=page_data.printable_pressure,
-                          reading=page_data.reading)
+                          current_timestamp=utc2local(page_data.reading.datetime)\
+                                              .strftime(TIMESTAMP_FORMAT),
+                          stale=page_data.stale,
+                          reading=page_data.reading,
+                          raw_retention_days=RAW_RETENTION_DAYS,
+                          main_sensor=DEFAULT_SENSOR_ID,
+                          min_pressure=MIN_PRESSURE_FOR_ON)
+
+##------------------------------------------------------------------------------
+## JSON time series of the readings for dashboards that draw their own plots.
+##  from/to    - ISO 8601 timestamps bounding the readings (default: the last
+##               PLOT_WINDOW up to now). Timestamps without a zone are UTC.
+##               A date alone as `to` includes all of that day.
+##  since_id   - only return raw readings recorded after this reading id. A
+##               client can pass back `last_id` from its previous response to
+##               get only the new points.
+##  sensor     - id of the sensor (default: the main one). See sensors.py
+##  resolution - 'raw' (default) for the readings themselves, or 'hour'/'day'
+##               for the rollups (of the main sensor only).
+##  interval   - seconds. Rebuild raw readings at this fixed interval from the
+##               compressed readings that are stored (see compression.py).
+## Data is returned in columns (one list per field) to keep the payload small.
+## The ETag only depends on the newest reading and the query, so a client that
+## already has the current data gets a 304 without touching the readings.
+@views.route('/api/readings')
+def api_readings():
+  last_id = latest_reading_id()
+  etag = f"{last_id}-{request.query_string.decode()}"
+  if etag in request.if_none_match:
+    return '', 304
+
+  sensor_id = request.args.get('sensor', DEFAULT_SENSOR_ID, type=int)
+  if Sensor.query.get(sensor_id) is None:
+    abort(404, f"Unknown sensor: {sensor_id}")
+  resolution = request.args.get('resolution', 'raw')
+  if resolution != 'raw' and resolution not in API_RESOLUTIONS:
+    abort(400, f"Unknown resolution: {resolution}")
+  if resolution != 'raw' and sensor_id != DEFAULT_SENSOR_ID:
+    abort(400, "Rollups are only kept for the main sensor")
+  since_id = request.args.get('since_id', type=int)
+  start = parse_api_time('from')
+  end = parse_api_time('to')
+  if start is None and since_id is None:
+    start = datetime.utcnow() - PLOT_WINDOW
+
+  interval = request.args.get('interval', type=float)
+  if interval is not None and interval <= 0:
+    abort(400, "interval must be more than 0 seconds")
+
+  if resolution == 'raw' and interval:
+    data = query_interpolated(start, end, since_id, timedelta(seconds=interval),
+                              sensor_id)
+  elif resolution == 'raw':
+    data = query_readings(start, end, since_id, sensor_id)
+  else:
+    data = query_rollups(API_RESOLUTIONS[resolution], start, end)
+  data['sensor'] = sensor_id
+  data['resolution'] = resolution
+  data['last_id'] = last_id
+
+  response = jsonify(data)
+  response.set_etag(etag)
+  return response
+
+##------------------------------------------------------------------------------
+## JSON report of when the water was actually available between from and to
+## (ISO 8601, default: all recorded history).
+##  heatmap    - 7 rows (Monday first) of 24 hours, the share of each local
+##               hour the water was on. null where there were no readings.
+##  outages    - statistics on how long the water was off for
+##  deviations - hours where the supply differed from EXPECTED_SCHEDULE (set
+##               in .env.py, see .env.py.example)
+## Like the readings API, the ETag follows the newest reading.
+@views.route('/api/availability')
+def api_availability():
+  last_id = latest_reading_id()
+  etag = f"{last_id}-{request.query_string.decode()}"
+  if etag in request.if_none_match:
+    return '', 304
+
+  start = parse_api_time('from')
+  end = parse_api_time('to')
+  heatmap = analytics.availability_heatmap(start, end)
+
+  response = jsonify({
+    'heatmap': [[None if isnan(value) else float(value) for value in day]
+                for day in heatmap],
+    'outages': analytics.outage_report(start, end),
+    'deviations': analytics.schedule_deviations(
+                    heatmap, current_app.config.get('EXPECTED_SCHEDULE', {})),
+    'last_id': last_id,
+  })
+  response.set_etag(etag)
+  return response
+
+##------------------------------------------------------------------------------
+## Download the readings of a sensor as a file.
+##  from/to - ISO 8601 times bounding the readings (default: all of them).
+##            Times without a zone are UTC. A date alone as `to` includes all
+##            of that day.
+##  sensor  - id of the sensor (default: the main one)
+##  format  - 'csv' (default) or 'ndjson' (one JSON object per line)
+## The rows are read EXPORT_CHUNK at a time and sent as they are read, so the
+## export takes the same memory however many readings there are.
+@views.route('/export')
+@login_required
+def export():
+  sensor_id = request.args.get('sensor', DEFAULT_SENSOR_ID, type=int)
+  if Sensor.query.get(sensor_id) is None:
+    abort(404, f"Unknown sensor: {sensor_id}")
+  export_format = request.args.get('format', 'csv')
+  if export_format not in EXPORT_TYPES:
+    abort(400, f"Unknown format: {export_format}")
+  start = parse_api_time('from')
+  end = parse_api_time('to')
+
+  columns = [getattr(MonitorReading, column) for column in EXPORT_COLUMNS]
+  query = db.session.query(*columns)\
+                    .filter(MonitorReading.sensor_id == sensor_id)
+  if start is not None:
+    query = query.filter(MonitorReading.datetime >= start)
+  if end is not None:
+    query = query.filter(MonitorReading.datetime <= end)
+  rows = query.order_by(MonitorReading.datetime)\
+              .yield_per(EXPORT_CHUNK)
+
+  if export_format == 'csv':
+    chunks = export_csv(rows)
+  else:
+    chunks = export_ndjson(rows)
+  filename = f"readings_{sensor_id}_{datetime.utcnow():%Y%m%d%H%M%S}.{export_format}"
+  # The query runs as the response is sent, so the request (and its database
+  # session) has to stay around until then.
+  return Response(stream_with_context(chunks),
+                  mimetype=EXPORT_TYPES[export_format],
+                  headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# The rows as CSV, a header line and then EXPORT_CHUNK rows at a time.
+# Times are ISO 8601 UTC.
+def export_csv(rows):
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  writer.writerow(EXPORT_COLUMNS)
+  for count, row in enumerate(rows, 1):
+    writer.writerow(export_row(row))
+    if count % EXPORT_CHUNK == 0:
+      yield buffer.getvalue()
+      buffer.seek(0)
+      buffer.truncate()
+  yield buffer.getvalue()
+
+# The rows as JSON objects, one per line, sent EXPORT_CHUNK at a time
+def export_ndjson(rows):
+  lines = []
+  for row in rows:
+    lines.append(json.dumps(dict(zip(EXPORT_COLUMNS, export_row(row)))) + '\n')
+    if len(lines) == EXPORT_CHUNK:
+      yield ''.join(lines)
+      lines = []
+  yield ''.join(lines)
+
+def export_row(row) -> list:
+  values = list(row)
+  values[2] = row.datetime.replace(tzinfo=None).isoformat() + 'Z'
+  return values
+
+##------------------------------------------------------------------------------
+## Server-Sent Events stream of the readings as they are recorded (see
+## live.py). The home page adds them to its plots without reloading.
+@views.route('/api/stream')
+def api_stream():
+  queue = live.broadcaster.subscribe()
+  if queue is None:
+    abort(503, "Too many open streams")
+  return Response(live.stream(queue),
+                  mimetype='text/event-stream',
+                  headers={'Cache-Control': 'no-cache',
+                           # Stop proxies (nginx) from holding events back
+                           'X-Accel-Buffering': 'no'})
+
+##------------------------------------------------------------------------------
+## JSON report of how polling each Pi is going (see poller.py). Empty when the
+## poller isn't running in this process.
+@views.route('/api/sources')
+def api_sources():
+  poller = current_app.extensions.get('poller')
+  return jsonify({'sources': poller.report() if poller else []})
+
+##------------------------------------------------------------------------------
+## Timings and counts of the hot paths of this process, for Prometheus to
+## scrape (see metrics.py)
+@views.route('/metrics')
+def metrics_page():
+  return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 ##------------------------------------------------------------------------------
 ## Package common data elements needed for page display
-## This will provide the last reading in the database if it was
-## taken within the last 15 min. This will prevent hammering the
-## Data Acquisition System. This won't be needed if I get the DAQ
-## taking measurements regularly
+## This will provide the last reading in the database. If it wasn't taken
+## within the last 15 min, the readings the Pi has recorded since are fetched
+## in the background and the page is marked as stale. The page never waits on
+## the Data Acquisition System unless there are no readings at all yet.
 def common_page_data() -> DisplayData:
-  # Get last reading from DB
+  # Get last reading of the main sensor from DB. Readings the Pi couldn't
+  # take a pressure for are skipped, since there is nothing to show.
   sort_field = MonitorReading.datetime.desc()
-  last_reading = MonitorReading.query.order_by(sort_field).first()
+  last_reading = MonitorReading.query.filter_by(sensor_id=DEFAULT_SENSOR_ID)\
+                                     .filter(MonitorReading.pressure.isnot(None))\
+                                     .order_by(sort_field)\
+                                     .first()
   now = datetime.utcnow().replace(tzinfo=tz.tzutc())
 
-  # TODO: Improve later.
-  # The following is very duplicative. It can probably be done
-  # better. I force the database data into the structure to make
-  # sure the timestamp is treated as a datetime object. It works for now.
-
   if not last_reading:
-    # There was no reading. Force one.
-    last_reading = record_new_reading(DATA_SOURCE_URL)
+    # There was no reading. Get what the Pi has, or force one if it has none.
+    catch_up_sensor()
+    last_reading = MonitorReading.query.filter_by(sensor_id=DEFAULT_SENSOR_ID)\
+                                       .filter(MonitorReading.pressure.isnot(None))\
+                                       .order_by(sort_field)\
+                                       .first()\
+                   or record_new_reading(latest_reading_url())
 
   # Put the last reading into the Structure
   r = MonitorReading(	datetime=last_reading.datetime,
@@ -134,37 +391,177 @@ def common_page_data() -> DisplayData:
                       pressure=last_reading.pressure)
 
   # Was the reading recent?
+  stale = False
   if r.datetime.replace(tzinfo=tz.tzutc()) < (now - timedelta(minutes=READING_DELTA)):
-    # Take a new reading if not.
-    last_reading = record_new_reading(DATA_SOURCE_URL)
-
-  # Put the last reading into the Structure
-  r = MonitorReading(	datetime=last_reading.datetime,
-                      rawvalue=last_reading.rawvalue,
-                      voltage=last_reading.voltage,
-                      pressure=last_reading.pressure)
+    # Serve what we have and get a new reading for the next visitor.
+    stale = True
+    refresh_in_background(current_app._get_current_object())
 
   ## Prepare everything to go into the page templates.
-  # Format the pressure value
-  printable_pressure = f"{r.pressure:5.2f}"
+  # Format the pressure value (a reading just forced from the Pi may not have
+  # one)
+  printable_pressure = "  n/a"
+  if r.pressure is not None:
+    printable_pressure = f"{r.pressure:5.2f}"
 
   # Determine if water is "on"
   on_now = False
-  if r.pressure > MIN_PRESSURE_FOR_ON:
+  if r.pressure is not None and r.pressure > MIN_PRESSURE_FOR_ON:
     on_now = True
   # Package everything up
   data = DisplayData(	printable_pressure=printable_pressure,
                       on_now=on_now,
+                      stale=stale,
                       reading=r)
   return data
 
+##------------------------------------------------------------------------------
+## The id of the newest reading in the database. This changes whenever a
+## reading is recorded, which makes it a cheap version number for the data.
+def latest_reading_id() -> int:
+  return db.session.query(func.max(MonitorReading.id)).scalar()
+
+##------------------------------------------------------------------------------
+## Get the dates and pressures of the readings of a sensor taken within the
+## given window of time before now. Only the two plotted columns are selected
+## and the query is a single range of the (sensor_id, datetime) index, so this
+## costs the same no matter how much history or how many sensors there are.
+def query_plot_window(window: timedelta, sensor_id: int = DEFAULT_SENSOR_ID):
+  cutoff_date = datetime.utcnow() - window
+  rows = db.session.query(MonitorReading.datetime, MonitorReading.pressure)\
+                   .filter(MonitorReading.sensor_id == sensor_id)\
+                   .filter(MonitorReading.datetime > cutoff_date)\
+                   .filter(MonitorReading.pressure.isnot(None))\
+                   .order_by(MonitorReading.datetime)\
+                   .all()
+
+  # Timestamps from database are in UTC.
+  # make sure dates are timezone aware
+  dates = [row.datetime.replace(tzinfo=tz.tzutc()) for row in rows]
+  pressures = [row.pressure for row in rows]
+  return dates, pressures
+
+##------------------------------------------------------------------------------
+## Get the start of each day and the peak pressure recorded that day for the
+## days within the given window of time before now.
+def query_daily_peaks(window: timedelta):
+  cutoff_date = datetime.utcnow() - window
+  rows = db.session.query(DailyRollup.start, DailyRollup.max_pressure)\
+                   .filter(DailyRollup.start > cutoff_date)\
+                   .order_by(DailyRollup.start)\
+                   .all()
+
+  dates = [row.start.replace(tzinfo=tz.tzutc()) for row in rows]
+  pressures = [row.max_pressure for row in rows]
+  return dates, pressures
+
+##------------------------------------------------------------------------------
+## Raw readings of a sensor between start and end (naive UTC, either may be
+## None) and after since_id, as columns. Times are UNIX timestamps in seconds.
+def query_readings(start: datetime, end: datetime, since_id: int,
+                   sensor_id: int = DEFAULT_SENSOR_ID) -> dict:
+  query = db.session.query(MonitorReading.id,
+                           MonitorReading.datetime,
+                           MonitorReading.pressure)\
+                    .filter(MonitorReading.sensor_id == sensor_id)
+  if start is not None:
+    query = query.filter(MonitorReading.datetime >= start)
+  if end is not None:
+    query = query.filter(MonitorReading.datetime <= end)
+  if since_id is not None:
+    query = query.filter(MonitorReading.id > since_id)
+  rows = query.order_by(MonitorReading.datetime).all()
+
+  return {
+    'id': [row.id for row in rows],
+    'time': [utc_timestamp(row.datetime) for row in rows],
+    'pressure': [row.pressure for row in rows],
+  }
+
+##------------------------------------------------------------------------------
+## Readings rebuilt at every `interval` between start and end, by drawing
+## straight lines between the stored (compressed) readings. Only the time and
+## pressure columns are returned. Without an end, the series stops at the
+## newest stored reading.
+def query_interpolated(start: datetime, end: datetime, since_id: int,
+                       interval: timedelta,
+                       sensor_id: int = DEFAULT_SENSOR_ID) -> dict:
+  # Stored readings are never further apart than MAX_COMPRESSION_GAP, so
+  # looking that far outside the window finds the readings on either side.
+  data = query_readings(start - MAX_COMPRESSION_GAP if start else None,
+                        end + MAX_COMPRESSION_GAP if end else None,
+                        since_id, sensor_id)
+  dates = [datetime.utcfromtimestamp(t) for t in data['time']]
+  if not dates:
+    return {'time': [], 'pressure': []}
+
+  first = start or dates[0]
+  last = end or dates[-1]
+  steps = int((last - first) / interval) + 1
+  if steps > API_MAX_POINTS:
+    abort(400, f"interval would return more than {API_MAX_POINTS} points")
+  times = [first + interval*i for i in range(steps)]
+  pressures = interpolate(dates, data['pressure'], times)
+  return {
+    'time': [utc_timestamp(when) for when in times],
+    'pressure': pressures,
+  }
+
+##------------------------------------------------------------------------------
+## Rollups of the given model between start and end, as columns. Times are the
+## UNIX timestamps (seconds) of the start of each bucket.
+def query_rollups(model, start: datetime, end: datetime) -> dict:
+  query = model.query
+  if start is not None:
+    query = query.filter(model.start >= start)
+  if end is not None:
+    query = query.filter(model.start <= end)
+  rows = query.order_by(model.start).all()
+
+  return {
+    'time': [utc_timestamp(row.start) for row in rows],
+    'count': [row.count for row in rows],
+    'min': [row.min_pressure for row in rows],
+    'max': [row.max_pressure for row in rows],
+    'mean': [row.mean_pressure for row in rows],
+    'minutes_on': [row.minutes_on for row in rows],
+    'minutes': [row.minutes for row in rows],
+  }
+
+# Read an ISO 8601 time from the request arguments as naive UTC.
+def parse_api_time(name: str) -> datetime:
+  value = request.args.get(name)
+  if not value:
+    return None
+  try:
+    when = parser.isoparse(value)
+  except ValueError:
+    abort(400, f"Could not read '{name}' as an ISO 8601 time: {value}")
+  if name == 'to' and is_date_only(value):
+    # Up to the end of that day, not its first moment
+    when += timedelta(days=1) - timedelta(microseconds=1)
+  if when.tzinfo is not None:
+    when = when.astimezone(tz.tzutc()).replace(tzinfo=None)
+  return when
+
+def is_date_only(value: str) -> bool:
+  try:
+    parser.isoparser().parse_isodate(value)
+  except ValueError:
+    return False
+  return True
+
+# Readings are stored as naive UTC
+def utc_timestamp(when: datetime) -> int:
+  return int(when.replace(tzinfo=tz.tzutc()).timestamp())
+
 ##------------------------------------------------------------------------------
 ## This is the function that uses plotly to generate the plot(s). It outputs
 ## a string of HTML that can be inserted in the final page. This is not
 ## standalone though and will require that the using page include the plotly js
 ## script to display.
 
-def generate_plots(dates, pressures) -> str:
+def generate_plots(dates, pressures, peak_dates, peak_pressures) -> str:
 
 # Reference
 # https://plotly.com/python/time-series/
@@ -184,9 +581,15 @@ def generate_plots(dates, pressures) -> str:
 #     ]
 # )
 
+  # plotly takes a long time to import, so it is only loaded the first time
+  # plots are made rather than whenever the app starts.
+  import plotly.io as pio
+  import plotly.graph_objects as go
+
   ## Setup data
   # Convert objects to local timezone
   dates = list(map(utc2local, dates))
+  peak_dates = list(map(utc2local, peak_dates))
   # get the current time and localize it
   now = utc2local(datetime.utcnow().replace(tzinfo=tz.tzutc()))
 
@@ -196,7 +599,7 @@ def generate_plots(dates, pressures) -> str:
   ## PLOT1: For the 1st plot, plot only the last 24 hours
   # Instead of filtering, I could just set the plot range:
   # https://plotly.com/python/time-series/#time-series-plot-with-custom-date-range
-  cutoff_date = now - timedelta(hours=24)
+  cutoff_date = now - DAY_WINDOW
 
   # Filter the data
   new_list = [[j,i] for i, j in zip(pressures, dates) if j > cutoff_date]
@@ -208,6 +611,12 @@ def generate_plots(dates, pressures) -> str:
     # common page data function.
     filtered_dates, filtered_pressures = [now], [0]
 
+  # Reduce the number of points sent to the browser
+  filtered_dates, filtered_pressures = downsample(filtered_dates,
+                                                  filtered_pressures,
+                                                  PLOT_POINTS,
+                                                  PLOT_DOWNSAMPLE)
+
   # setup the figure
   fig = go.Figure()
   fig.update_layout(height=500,
@@ -227,7 +636,9 @@ def generate_plots(dates, pressures) -> str:
                                 "Pressure: %{y:.2f} psi"
                                 "<extra></extra>",
                   )
-  fig.add_scatter(x=filtered_dates, y=[MIN_PRESSURE_FOR_ON]*len(filtered_dates),
+  # The threshold is a flat line, so only its end points are needed.
+  fig.add_scatter(x=[filtered_dates[0], filtered_dates[-1]],
+                  y=[MIN_PRESSURE_FOR_ON]*2,
                   name="Minimum Pressure Needed",
                   mode="lines")
 
@@ -237,12 +648,13 @@ def generate_plots(dates, pressures) -> str:
                             xanchor="left",
                             x=0.7))
 
-  plot_elements = plot_elements+pio.to_html(fig,
-                              include_plotlyjs=False,
-                              full_html=False)
+  with PLOT_RENDER_SECONDS.time():
+    plot_elements = plot_elements+pio.to_html(fig,
+                                include_plotlyjs=False,
+                                full_html=False)
 
   ## PLOT2: For the 2nd plot, show data for the last week
-  cutoff_date = now - timedelta(weeks=1)
+  cutoff_date = now - PLOT_WINDOW
 
   new_list = [[j,i] for i, j in zip(pressures, dates) if j > cutoff_date]
   if len(new_list) > 0:
@@ -253,6 +665,12 @@ def generate_plots(dates, pressures) -> str:
     # common page data function.
     filtered_dates, filtered_pressures = [now], [0]
 
+  # Reduce the number of points sent to the browser
+  filtered_dates, filtered_pressures = downsample(filtered_dates,
+                                                  filtered_pressures,
+                                                  PLOT_POINTS,
+                                                  PLOT_DOWNSAMPLE)
+
   fig = go.Figure()
   fig.update_layout(height=500, title="Data for the last week.")
   fig.update_layout(yaxis=dict(title="Pressure [psi]",
@@ -270,7 +688,9 @@ def generate_plots(dates, pressures) -> str:
                                 "Pressure: %{y:.2f} psi"
                                 "<extra></extra>",
                   )
-  fig.add_scatter(x=filtered_dates, y=[MIN_PRESSURE_FOR_ON]*len(filtered_dates),
+  # The threshold is a flat line, so only its end points are needed.
+  fig.add_scatter(x=[filtered_dates[0], filtered_dates[-1]],
+                  y=[MIN_PRESSURE_FOR_ON]*2,
                   name="Minimum Pressure Needed",
                   mode="lines")
 
@@ -280,11 +700,48 @@ def generate_plots(dates, pressures) -> str:
                             xanchor="left",
                             x=0.7))
 
-  plot_elements = plot_elements+pio.to_html(fig,
-                              include_plotlyjs=False,
-                              full_html=False)
+  with PLOT_RENDER_SECONDS.time():
+    plot_elements = plot_elements+pio.to_html(fig,
+                                include_plotlyjs=False,
+                                full_html=False)
+
+  ## PLOT3: For the 3rd show the last month, but only pick the peak from each day
+  if len(peak_dates) > 0:
+    filtered_dates, filtered_pressures = peak_dates, peak_pressures
+  else:
+    filtered_dates, filtered_pressures = [now], [0]
+
+  fig = go.Figure()
+  fig.update_layout(height=500, title="Peak pressure per day for the last month.")
+  fig.update_layout(yaxis=dict(title="Pressure [psi]",
+                              fixedrange=True),
+                    xaxis=dict(tickangle = 80,
+                              dtick=24*60*60*1000)) # Time in milliseconds
+  fig.update_xaxes(tickformat="%b %d, %Y")
+
+  fig.add_scatter(x=filtered_dates, y=filtered_pressures,
+                  name="Peak Pressure",
+                  mode="lines+markers",
+                  line_color="#17B897",
+                  hovertemplate="%{x| %m/%d/%Y}<br>"
+                                "Peak Pressure: %{y:.2f} psi"
+                                "<extra></extra>",
+                  )
+  fig.add_scatter(x=[filtered_dates[0], filtered_dates[-1]],
+                  y=[MIN_PRESSURE_FOR_ON]*2,
+                  name="Minimum Pressure Needed",
+                  mode="lines")
+
+  fig.update_layout(legend=dict(
+                            yanchor="top",
+                            y=1.2,
+                            xanchor="left",
+                            x=0.7))
 
-  ## PLOT3: For the 3rd show the last month, but only pick the peak from each day...?
+  with PLOT_RENDER_SECONDS.time():
+    plot_elements = plot_elements+pio.to_html(fig,
+                                include_plotlyjs=False,
+                                full_html=False)
 
   return plot_elements
 